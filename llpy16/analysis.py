@@ -0,0 +1,366 @@
+# -*- coding: utf-8 -*-
+"""
+Static analysis of assembled programs: worst case stack depth per entry
+point and a map of the memory the program uses.
+"""
+import re
+from .assembler import Instruction, Label, hexify
+from .passes import basic_blocks, is_data
+
+MEMORY_SIZE = 0x10000
+IMAGE_KINDS = set(['code', 'data'])
+# an interrupt pushes PC and A before the handler runs
+INTERRUPT_FRAME = 2
+# how often an instruction may be revisited with a growing stack before the
+# depth is considered unbounded
+MAX_VISITS = 32
+# registers a routine may change, in the order they are saved
+REGISTERS = ('A', 'B', 'C', 'X', 'Y', 'Z', 'I', 'J', 'EX')
+# opcodes that set EX besides their b operand
+SETS_EX = set(['ADD', 'SUB', 'MUL', 'MLI', 'DIV', 'DVI', 'SHR', 'ASR', 'SHL', 'ADX', 'SBX'])
+# special opcodes that write their operand
+WRITES_OPERAND = set(['IAG', 'HWN'])
+
+ADDRESS = re.compile(r'^\[\s*(0x[0-9a-fA-F]+|\d+)\s*(?:\+\s*(\w+)\s*)?\]$')
+# a word of a table of jump targets, [table] or [table + index]
+TABLE_ENTRY = re.compile(r'^\[\s*([A-Za-z_]\w*)\s*(?:\+\s*\w+\s*)?\]$')
+
+
+class Unbounded(Exception):
+    pass
+
+
+class Region(object):
+    def __init__(self, start, size, kind, name):
+        self.start = start
+        self.size = size
+        self.kind = kind
+        self.name = name
+
+    @property
+    def end(self):
+        return self.start + self.size
+
+    def overlaps(self, other):
+        return self.start < other.end and other.start < self.end
+
+    def __str__(self):
+        if self.size:
+            span = '0x%04x-0x%04x' % (self.start, self.end - 1)
+        else:
+            span = '0x%04x+?     ' % self.start
+        return '%s %6s  %-8s %s' % (span, self.size or '?', self.kind, self.name)
+
+
+class Analysis(object):
+    """
+    Analysis of the sections of an Assembler, see Assembler.get_sections.
+    """
+    def __init__(self, sections, regions=()):
+        self.items = [item for section in sections for item in section]
+        self.labels = {}
+        self.addresses = {}
+        self.warnings = []
+        address = 0
+        for index, item in enumerate(self.items):
+            if isinstance(item, Label):
+                self.labels[item.name] = index
+                self.addresses[item.name] = address
+            address += item.size
+        self.image_size = address
+        self.sections = sections
+        self.declared = list(regions)
+        self._depths = {}
+        self._in_progress = set()
+        self._clobbers = {}
+        self._tables = {}
+        self.entry_points = self._find_entry_points()
+
+    def table_targets(self, operand):
+        """
+        Labels a jump through the memory operand may go to, if it reads a
+        labeled table: the labels stored in the table with DAT or written to
+        it (SET [table + n], label). None if there are none.
+        """
+        match = TABLE_ENTRY.match(str(operand))
+        if not match or match.group(1) not in self.labels:
+            return None
+        table = match.group(1)
+        if table not in self._tables:
+            targets = set()
+            for item in self.items[self.labels[table] + 1:]:
+                if not isinstance(item, Instruction) or item.opcode != 'DAT':
+                    break
+                targets.update(str(arg) for arg in item.args if str(arg) in self.labels)
+            for item in self.items:
+                if (isinstance(item, Instruction) and item.opcode == 'SET' and str(item.args[1]) in self.labels and
+                        TABLE_ENTRY.match(str(item.args[0])) and
+                        TABLE_ENTRY.match(str(item.args[0])).group(1) == table):
+                    targets.add(str(item.args[1]))
+            self._tables[table] = sorted(targets) or None
+        return self._tables[table]
+
+    # Stack depth
+
+    def _find_entry_points(self):
+        entry_points = [('main', None, 'main')]
+        seen = set()
+        for item in self.items:
+            if not isinstance(item, Instruction) or not item.args:
+                continue
+            target = str(item.args[-1])
+            if target not in self.labels or target in seen:
+                continue
+            if item.opcode == 'JSR':
+                entry_points.append((target, target, 'function'))
+                seen.add(target)
+            elif item.opcode == 'IAS':
+                entry_points.append((target, target, 'interrupt'))
+                seen.add(target)
+        return entry_points
+
+    def stack_depth(self, label):
+        """
+        Worst case number of words routine label (None for the main program)
+        pushes, including the return addresses of nested calls. Returns None
+        if the depth is unbounded.
+        """
+        if label not in self._depths:
+            if label in self._in_progress:
+                self.warnings.append('recursive call to %s' % label)
+                return None
+            self._in_progress.add(label)
+            try:
+                self._depths[label] = self._walk(0 if label is None else self.labels[label])
+            except Unbounded:
+                self._depths[label] = None
+            finally:
+                self._in_progress.discard(label)
+        return self._depths[label]
+
+    def _walk(self, start):
+        deepest = 0
+        best = {}
+        visits = {}
+        work = [(start, 0)]
+        while work:
+            index, depth = work.pop()
+            if index >= len(self.items) or best.get(index, -1) >= depth:
+                continue
+            visits[index] = visits.get(index, 0) + 1
+            if visits[index] > MAX_VISITS:
+                raise Unbounded()
+            best[index] = depth
+            deepest = max(deepest, depth)
+            item = self.items[index]
+            if not isinstance(item, Instruction):
+                work.append((index + 1, depth))
+                continue
+            if item.opcode == 'DAT':
+                continue
+            args = [str(arg).upper() for arg in item.args]
+            if item.opcode == 'JSR':
+                target = str(item.args[0])
+                if target in self.labels:
+                    callee = self.stack_depth(target)
+                    if callee is None:
+                        raise Unbounded()
+                else:
+                    self.warnings.append('indirect call %r, depth of callee unknown' % str(item))
+                    callee = 0
+                deepest = max(deepest, depth + 1 + callee)
+            if args and args[-1] == 'POP':
+                depth -= 1
+            if len(args) == 2 and args[0] == 'PUSH':
+                depth += 1
+            deepest = max(deepest, depth)
+            if item.opcode == 'RFI':
+                continue
+            if item.opcode in ('ADD', 'SUB') and args[0] == 'SP':
+                if not str(item.args[1]).isdigit() and not isinstance(item.args[1], (int, long)):
+                    raise Unbounded()
+                amount = int(item.args[1])
+                depth += -amount if item.opcode == 'ADD' else amount
+            elif item.opcode == 'SET' and args[0] == 'SP':
+                self.warnings.append('%r changes SP, depth of following code unknown' % str(item))
+                continue
+            if item.jump_target is not None:
+                target = str(item.args[1])
+                if args[1] == 'POP':
+                    pass
+                elif target in self.labels:
+                    work.append((self.labels[target], depth))
+                elif self.table_targets(target):
+                    work.extend((self.labels[label], depth) for label in self.table_targets(target))
+                else:
+                    self.warnings.append('indirect jump %r, following code not analyzed' % str(item))
+                if index and isinstance(self.items[index - 1], Instruction) and self.items[index - 1].is_conditional:
+                    work.append((index + 1, depth))
+                continue
+            work.append((index + 1, depth))
+            if item.is_conditional:
+                # the test may skip the next instruction
+                work.append((index + 2, depth))
+        return deepest
+
+    # Clobbered registers
+
+    def clobbers(self, label):
+        """
+        Registers (and EX) the routine label and the routines it calls may
+        change, in REGISTERS order. Registers that are pushed and popped again
+        count as changed. Hardware interrupts and calls or jumps that cannot
+        be followed (see table_targets) change everything.
+        """
+        if label not in self._clobbers:
+            # recursive calls are assumed to change everything
+            self._clobbers[label] = set(REGISTERS)
+            self._clobbers[label] = self._written(self.labels[label])
+        return [register for register in REGISTERS if register in self._clobbers[label]]
+
+    def _written(self, start):
+        written = set()
+        seen = set()
+        work = [start]
+        while work:
+            index = work.pop()
+            if index >= len(self.items) or index in seen:
+                continue
+            seen.add(index)
+            item = self.items[index]
+            if not isinstance(item, Instruction):
+                work.append(index + 1)
+                continue
+            if item.opcode == 'DAT' or item.opcode == 'RFI':
+                continue
+            args = [str(arg).upper() for arg in item.args]
+            if item.opcode == 'JSR':
+                target = str(item.args[0])
+                if target not in self.labels:
+                    return set(REGISTERS)
+                written.update(self.clobbers(target))
+            elif item.opcode == 'HWI':
+                return set(REGISTERS)
+            elif item.opcode == 'HWQ':
+                written.update(('A', 'B', 'C', 'X', 'Y'))
+            elif item.opcode in WRITES_OPERAND:
+                written.add(args[0])
+            elif len(args) == 2 and not item.is_conditional:
+                written.add(args[0])
+            if item.opcode in SETS_EX:
+                written.add('EX')
+            if item.opcode in ('STI', 'STD'):
+                written.update(('I', 'J'))
+            if item.jump_target is not None:
+                target = str(item.args[1])
+                if args[1] == 'POP':
+                    pass
+                elif target in self.labels:
+                    work.append(self.labels[target])
+                elif self.table_targets(target):
+                    work.extend(self.labels[label] for label in self.table_targets(target))
+                else:
+                    return set(REGISTERS)
+                if index and isinstance(self.items[index - 1], Instruction) and self.items[index - 1].is_conditional:
+                    work.append(index + 1)
+                continue
+            work.append(index + 1)
+            if item.is_conditional:
+                work.append(index + 2)
+        return written & set(REGISTERS)
+
+    def worst_case_stack(self):
+        """
+        Worst case depth of the main program plus the deepest interrupt
+        handler (interrupts are queued while a handler runs). None if
+        unbounded.
+        """
+        main = self.stack_depth(None)
+        handlers = [self.stack_depth(label) for label, _, kind in self.entry_points if kind == 'interrupt']
+        if main is None or None in handlers:
+            return None
+        if handlers:
+            return main + INTERRUPT_FRAME + max(handlers)
+        return main
+
+    # Memory map
+
+    def memory_map(self):
+        """
+        List of Regions used by the program: the program image (code and DAT
+        blocks), absolute memory the code accesses, regions declared by
+        extensions and the stack.
+        """
+        regions = []
+        address = 0
+        for block, _ in basic_blocks(self.sections):
+            size = sum(item.size for item in block)
+            name = block[0].name if isinstance(block[0], Label) else 'main'
+            kind = 'data' if is_data(block) else 'code'
+            if regions and kind == 'code' and regions[-1].kind == 'code' and not isinstance(block[0], Label):
+                regions[-1].size += size
+            elif size:
+                regions.append(Region(address, size, kind, name))
+            address += size
+        regions.extend(self._absolute_regions())
+        for name, start, size in self.declared:
+            regions.append(Region(start, size, 'declared', name))
+        depth = self.worst_case_stack()
+        if depth is None:
+            self.warnings.append('stack depth is unbounded')
+        elif depth:
+            regions.append(Region(MEMORY_SIZE - depth, depth, 'stack', 'worst case'))
+        regions.sort(key=lambda region: (region.start, region.kind))
+        for index, region in enumerate(regions):
+            for other in regions[index + 1:]:
+                kinds = set([region.kind, other.kind])
+                if (region.size and other.size and region.overlaps(other) and
+                        not kinds <= IMAGE_KINDS and kinds & (IMAGE_KINDS | set(['stack']))):
+                    self.warnings.append('%s %s overlaps %s %s' % (region.kind, region.name, other.kind, other.name))
+        return regions
+
+    def _absolute_regions(self):
+        direct = set()
+        indexed = {}
+        for item in self.items:
+            if not isinstance(item, Instruction) or item.opcode == 'DAT':
+                continue
+            for arg in item.args:
+                match = ADDRESS.match(hexify(arg))
+                if not match:
+                    continue
+                address = int(match.group(1), 0)
+                if match.group(2):
+                    indexed[address] = match.group(2)
+                else:
+                    direct.add(address)
+        regions = []
+        for address in sorted(direct):
+            if regions and regions[-1].end == address:
+                regions[-1].size += 1
+            else:
+                regions.append(Region(address, 1, 'absolute', ''))
+        for region in regions:
+            region.name = '%d words accessed directly' % region.size
+        for address, register in sorted(indexed.items()):
+            regions.append(Region(address, 0, 'indexed', 'indexed by %s' % register))
+        return regions
+
+    def write_report(self, stream):
+        stream.write('Stack depth (words, worst case)\n')
+        for name, label, kind in self.entry_points:
+            depth = self.stack_depth(label)
+            stream.write('  %-40s %8s  %s\n' % (name, 'unbounded' if depth is None else depth, kind))
+        worst = self.worst_case_stack()
+        stream.write('  %-40s %8s\n' % ('total', 'unbounded' if worst is None else worst))
+        stream.write('\nMemory map (image is %d words)\n' % self.image_size)
+        for region in self.memory_map():
+            stream.write('  %s\n' % region)
+        if self.warnings:
+            stream.write('\nWarnings\n')
+            for warning in sorted(set(self.warnings)):
+                stream.write('  %s\n' % warning)
+
+
+def analyze(assembler):
+    return Analysis(assembler.get_sections(), assembler.regions)
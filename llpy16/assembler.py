@@ -1,5 +1,9 @@
 # -*- coding: utf-8 -*-
 from contextlib import contextmanager
+import hashlib
+import re
+import shutil
+import tempfile
 
 
 def instruction(value, doc=''):
@@ -28,6 +32,133 @@ def hexify(thing):
             return '[0x%04x]' % int(thing[1:-1])
     return str(thing)
 
+# base cycle counts, operands that take a next word add one cycle each
+CYCLES = {
+    'SET': 1, 'ADD': 2, 'SUB': 2, 'MUL': 2, 'MLI': 2, 'DIV': 3, 'DVI': 3,
+    'MOD': 3, 'MDI': 3, 'AND': 1, 'BOR': 1, 'XOR': 1, 'SHR': 1, 'ASR': 1,
+    'SHL': 1, 'IFB': 2, 'IFC': 2, 'IFE': 2, 'IFN': 2, 'IFG': 2, 'IFA': 2,
+    'IFL': 2, 'IFU': 2, 'ADX': 3, 'SBX': 3, 'STI': 2, 'STD': 2,
+    'JSR': 3, 'INT': 4, 'IAG': 1, 'IAS': 1, 'RFI': 3, 'IAQ': 2, 'HWN': 2,
+    'HWQ': 4, 'HWI': 4,
+}
+
+SPECIAL_OPCODES = ('JSR', 'INT', 'IAG', 'IAS', 'RFI', 'IAQ', 'HWN', 'HWQ', 'HWI')
+
+INLINE_OPERANDS = ('A', 'B', 'C', 'X', 'Y', 'Z', 'I', 'J', 'PUSH', 'POP', 'PEEK', 'SP', 'PC', 'EX')
+
+IDENTIFIER = re.compile(r'\b[A-Za-z_]\w*')
+
+# bytes of spooled output kept in memory before it goes to a temporary file
+SPOOL_MEMORY = 1 << 20
+# number of main body lines collected before they are spooled
+SPOOL_CHUNK = 1024
+
+def operand_words(operand, short_literal=False):
+    """
+    Number of extra words operand needs. Literals from -1 to 30 fit in the
+    instruction word if they are the a operand (short_literal).
+    """
+    if not isinstance(operand, (int, long)):
+        text = str(operand).strip()
+        if text.isdigit():
+            operand = int(text)
+        elif text.upper() in INLINE_OPERANDS:
+            return 0
+        elif text[:1] == '[' and text[-1:] == ']' and text[1:-1].strip().upper() in INLINE_OPERANDS:
+            return 0
+        else:
+            return 1
+    if short_literal and (-1 <= operand <= 30 or operand == 0xffff):
+        return 0
+    return 1
+
+
+class Label(object):
+    size = 0
+    cycles = 0
+
+    def __init__(self, name):
+        self.name = name
+
+    def __str__(self):
+        return ':%s' % self.name
+
+
+class Instruction(object):
+    def __init__(self, opcode, args, source=None):
+        self.opcode = opcode
+        self.args = args
+        # (filename, line) of the code this was compiled from, if known
+        self.source = source
+
+    def __str__(self):
+        return '%s %s' % (self.opcode, ', '.join(map(hexify, self.args)))
+
+    def __eq__(self, other):
+        return isinstance(other, Instruction) and str(self) == str(other)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash(str(self))
+
+    @property
+    def size(self):
+        if self.opcode == 'DAT':
+            return sum(len(arg) if isinstance(arg, basestring) and not arg.isdigit() else 1 for arg in self.args)
+        size = 1
+        for index, arg in enumerate(self.args):
+            size += operand_words(arg, short_literal=index == len(self.args) - 1)
+        return size
+
+    @property
+    def cycles(self):
+        if self.opcode not in CYCLES:
+            return 0
+        return CYCLES[self.opcode] + self.size - 1
+
+    @property
+    def is_conditional(self):
+        return self.opcode.startswith('IF')
+
+    @property
+    def jump_target(self):
+        """
+        The label this instruction unconditionally jumps to (when not
+        preceded by a conditional), POP for returns or None.
+        """
+        if self.opcode == 'SET' and len(self.args) == 2 and str(self.args[0]).upper() == 'PC':
+            return str(self.args[1])
+        return None
+
+    @property
+    def is_terminator(self):
+        return self.jump_target is not None or self.opcode == 'RFI'
+
+    @property
+    def references(self):
+        """
+        Names of the labels the operands refer to.
+        """
+        names = set()
+        if self.opcode == 'DAT':
+            return names
+        for arg in self.args:
+            if isinstance(arg, (int, long)):
+                continue
+            for name in IDENTIFIER.findall(str(arg)):
+                if name.upper() not in INLINE_OPERANDS and name.upper() != 'PICK':
+                    names.add(name)
+        return names
+
+
+def render(section):
+    return ''.join('%s\n' % item for item in section)
+
+def section_digest(section):
+    return hashlib.sha1(render(section)).hexdigest()
+
 
 class Assembler(object):
     halt_label = '__halt'
@@ -40,23 +171,160 @@ class Assembler(object):
         'I', 'J'
     ]
 
-    def __init__(self):
+    def __init__(self, spool=False, section_filter=None):
+        """
+        If spool is set, finished labeled blocks and the main body are
+        rendered to temporary files right away instead of being kept, which
+        keeps memory use flat for large programs. The sections of a spooling
+        assembler cannot be changed, so only passes that look at one section
+        at a time can run: section_filter, if given, is applied to every
+        section and every chunk of the main body before it is written (see
+        llpy16.passes.PassManager.section_filter).
+        """
         self._current = self._body = []
         self._labels = []
+        self.regions = []
+        # (filename, line) instructions written are tagged with
+        self.location = None
+        self._body_spool = self._label_spool = None
+        self._section_filter = section_filter
+        if spool:
+            self._body_spool = tempfile.SpooledTemporaryFile(SPOOL_MEMORY)
+            self._label_spool = tempfile.SpooledTemporaryFile(SPOOL_MEMORY)
+        # digests of spooled sections by the labels they define
+        self._spooled = {}
+        self._spooled_references = set()
+        # names of the labels written so far and of the ones written twice
+        self._defined = set()
+        self.duplicates = set()
         with self.label(self.halt_label):
             self.goto_label(self.halt_label)
 
     def get_assembled(self):
-        program = self._body + ['', ''] + [y for x in self._labels for y in x + ['']]
-        return '\n'.join(program)
+        stream = tempfile.SpooledTemporaryFile(SPOOL_MEMORY)
+        self.write_assembled(stream)
+        stream.seek(0)
+        return stream.read()[:-1]
+
+    def write_assembled(self, sink):
+        """
+        Write the program to the file-like object sink, one section at a
+        time.
+        """
+        if self._body_spool is not None:
+            self._body_spool.seek(0)
+            shutil.copyfileobj(self._body_spool, sink)
+        sink.write(render(self._filtered(self._body)))
+        sink.write('\n\n')
+        if self._label_spool is not None:
+            self._label_spool.seek(0)
+            shutil.copyfileobj(self._label_spool, sink)
+        for section in self._labels:
+            sink.write(render(self._filtered(section)))
+            sink.write('\n')
+
+    def _filtered(self, section):
+        if self._section_filter is None:
+            return section
+        return self._section_filter(section)
+
+    @property
+    def spooling(self):
+        return self._body_spool is not None
+
+    def get_sections(self):
+        """
+        The main body followed by all labeled blocks, as lists of Label and
+        Instruction objects.
+        """
+        if self.spooling:
+            raise RuntimeError("The sections of a spooling assembler are not available")
+        return [self._body] + self._labels
+
+    def set_sections(self, sections):
+        if self.spooling:
+            raise RuntimeError("The sections of a spooling assembler cannot be changed")
+        self._body = sections[0]
+        self._labels = list(sections[1:])
+
+    def append_section(self, section):
+        for item in section:
+            self._define(item)
+        self._labels.append(section)
+
+    def _define(self, item):
+        if isinstance(item, Label):
+            if item.name in self._defined:
+                self.duplicates.add(item.name)
+            self._defined.add(item.name)
+
+    def section_digests(self):
+        """
+        Digest of the section defining each label, see section_digest.
+        """
+        digests = dict(self._spooled)
+        for section in [self._body] + self._labels:
+            digest = None
+            for item in section:
+                if isinstance(item, Label):
+                    digest = digest or section_digest(section)
+                    digests[item.name] = digest
+        return digests
+
+    def references(self):
+        """
+        Names of all labels referenced by the program.
+        """
+        names = set(self._spooled_references)
+        for section in [self._body] + self._labels:
+            for item in section:
+                if isinstance(item, Instruction):
+                    names |= item.references
+        return names
+
+    def _spool_section(self, section):
+        # the digest is of the code as written, like the ones of objects
+        digest = section_digest(section)
+        section = self._filtered(section)
+        for item in section:
+            if isinstance(item, Label):
+                self._spooled[item.name] = digest
+            else:
+                self._spooled_references |= item.references
+        self._label_spool.write(render(section))
+        self._label_spool.write('\n')
+
+    def _spool_body(self):
+        body = self._filtered(self._body)
+        # keep the last instruction and the conditionals guarding it, the
+        # filter may still change them with what follows
+        keep = max(len(body) - 1, 0)
+        while keep > 0 and isinstance(body[keep - 1], Instruction) and body[keep - 1].is_conditional:
+            keep -= 1
+        for entry in body[:keep]:
+            if isinstance(entry, Instruction):
+                self._spooled_references |= entry.references
+            else:
+                self._spooled[entry.name] = None
+        self._body_spool.write(render(body[:keep]))
+        self._body[:] = body[keep:]
+
+    def _append(self, item):
+        self._define(item)
+        self._current.append(item)
+        if self._body_spool is not None and self._current is self._body and len(self._body) >= SPOOL_CHUNK:
+            self._spool_body()
 
     # Low Level API
 
     def write_instruction(self, instruction, *args):
-        self._current.append('%s %s' % (instruction, ', '.join(map(hexify, args))))
+        self._append(Instruction(instruction, args, self.location))
 
     def write_label(self, label):
-        self._current.append(':%s' % label)
+        self._append(Label(label))
+
+    def write_item(self, item):
+        self._append(item)
 
     SET = instruction('SET')
     ADD = instruction('ADD')
@@ -108,7 +376,10 @@ class Assembler(object):
         self.write_label(name)
         try:
             yield
-            self._labels.append(body)
+            if self._label_spool is not None:
+                self._spool_section(body)
+            else:
+                self._labels.append(body)
         finally:
             self._current = old
 
@@ -120,6 +391,13 @@ class Assembler(object):
         for reg in reversed(registers):
             self.pop_stack(reg)
 
+    def reserve_region(self, name, start, size):
+        """
+        Record that size words of memory from start are used by name, for the
+        memory map of llpy16.analysis.
+        """
+        self.regions.append((name, start, size))
+
     def goto_label(self, label):
         self.SET(self.program_counter, label)
 
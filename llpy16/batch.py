@@ -0,0 +1,129 @@
+# -*- coding: utf-8 -*-
+"""
+Compile many programs in one invocation across a pool of processes.
+
+The stdlib objects are (re)built once up front into a cache directory
+(CACHE_DIRECTORY in the output directory by default) and every worker
+process loads them, the extension modules and an index of all import paths
+a single time. Every program is written to its own output file and a
+failing program does not abort the batch.
+"""
+import multiprocessing
+import os
+import traceback
+from timeit import default_timer
+from . import STDLIB_PATH
+from .compiler import CompilerError, build_objects, compile_program
+from .context import ImportIndex
+from .objects import LinkError
+
+OUTPUT_EXTENSION = '.dasm'
+CACHE_DIRECTORY = '.llpy16-objects'
+
+_index = None
+_object_dir = None
+
+
+class Result(object):
+    def __init__(self, source, output, seconds, error=None):
+        self.source = source
+        self.output = output
+        self.seconds = seconds
+        self.error = error
+
+    def __str__(self):
+        if self.error:
+            return 'FAILED %s: %s' % (self.source, self.error)
+        return 'ok     %s -> %s (%.2fs)' % (self.source, self.output, self.seconds)
+
+
+def read_manifest(filename):
+    """
+    Read a manifest: one source per line, optionally followed by its output
+    file. Empty lines and lines starting with # are ignored, relative paths
+    are relative to the manifest.
+    """
+    base = os.path.dirname(filename)
+    jobs = []
+    with open(filename) as fobj:
+        for line in fobj:
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            bits = line.split()
+            source = os.path.join(base, bits[0])
+            output = os.path.join(base, bits[1]) if len(bits) > 1 else None
+            jobs.append((source, output))
+    return jobs
+
+def source_path(source):
+    return os.path.dirname(source) or '.'
+
+def _init_worker(paths, object_dir):
+    global _index, _object_dir
+    _index = ImportIndex([STDLIB_PATH] + paths + ([object_dir] if object_dir else []))
+    _object_dir = object_dir
+
+def _compile_one(job):
+    source, output, optimization, verify, stream = job
+    start = default_timer()
+    try:
+        with open(source) as fobj:
+            assembler = compile_program(
+                fobj.read(), [source_path(source)], optimization, verify, index=_index, spool=stream,
+                filename=source, object_dir=_object_dir
+            )
+        with open(output, 'w') as fobj:
+            assembler.write_assembled(fobj)
+    except Exception as exc:
+        error = '%s: %s' % (exc.__class__.__name__, exc)
+        if not isinstance(exc, (CompilerError, LinkError, SyntaxError, ImportError, NameError, IOError)):
+            error += '\n' + traceback.format_exc()
+        return Result(source, output, default_timer() - start, error)
+    return Result(source, output, default_timer() - start)
+
+
+def compile_batch(jobs, output_dir=None, processes=None, optimization='1', verify=False, cache_dir=None,
+                  stream=False):
+    """
+    Compile jobs, a list of (source, output) pairs where output may be None
+    to write to output_dir (or next to the source) with the .dasm extension.
+    The stdlib objects are built in cache_dir, CACHE_DIRECTORY in output_dir
+    if not given; without either the stdlib is compiled from source. stream
+    spools the outputs as they are compiled, see compile_program. Yields a
+    Result per job as they complete.
+    """
+    if cache_dir is None and output_dir:
+        cache_dir = os.path.join(output_dir, CACHE_DIRECTORY)
+    if cache_dir:
+        try:
+            build_objects(STDLIB_PATH, force=False, object_dir=cache_dir)
+        except (IOError, OSError):
+            # not writable, compile the stdlib from source
+            cache_dir = None
+    tasks = []
+    outputs = set()
+    for source, output in jobs:
+        if output is None:
+            base = os.path.splitext(source)[0] + OUTPUT_EXTENSION
+            output = os.path.join(output_dir, os.path.basename(base)) if output_dir else base
+        if output in outputs:
+            yield Result(source, output, 0, 'output %s is written by another source' % output)
+            continue
+        outputs.add(output)
+        tasks.append((source, output, optimization, verify, stream))
+    if output_dir and not os.path.isdir(output_dir):
+        os.makedirs(output_dir)
+    paths = sorted(set(source_path(task[0]) for task in tasks))
+    if processes == 1:
+        _init_worker(paths, cache_dir)
+        for task in tasks:
+            yield _compile_one(task)
+        return
+    pool = multiprocessing.Pool(processes, _init_worker, (paths, cache_dir))
+    try:
+        for result in pool.imap_unordered(_compile_one, tasks):
+            yield result
+    finally:
+        pool.close()
+        pool.join()
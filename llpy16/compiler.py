@@ -1,9 +1,16 @@
 # -*- coding: utf-8 -*-
 import ast
+from contextlib import contextmanager
+import os
 import sys
 from . import STDLIB_PATH
 from .assembler import Assembler
 from .context import Context
+from .evaluator import Evaluator, NotConstant
+from .objects import OBJECT_EXTENSION, LinkError, ObjectModule, link, load_object
+from .analysis import analyze
+from .passes import PassManager
+from .sourcemap import SourceReport
 
 
 class CompilerError(Exception):
@@ -38,20 +45,41 @@ def get_register_or_number(node, assembler):
 
 
 class Compiler(object):
-    def __init__(self, assembler, context):
+    def __init__(self, assembler, context, fold_calls=True, profiler=None):
         self.assembler = assembler
         self.context = context
+        self.fold_calls = fold_calls
+        self.profiler = profiler
+        self.filename = None
 
-    def compile(self, source):
-        node = ast.parse(source)
-        self.handle(node)
+    def compile(self, source, filename=None):
+        node = self.context.parse(source)
+        with self.located(node, filename):
+            self.handle(node)
+
+    @contextmanager
+    def located(self, node, filename=None):
+        """
+        Tag the instructions written in this block with the line of node (in
+        filename, if given, otherwise the current file).
+        """
+        previous = self.filename, self.assembler.location
+        if filename is not None:
+            self.filename = filename
+        if hasattr(node, 'lineno'):
+            self.assembler.location = (self.filename, node.lineno)
+        try:
+            yield
+        finally:
+            self.filename, self.assembler.location = previous
 
     def handle(self, node):
         handler = getattr(self, 'handle_%s' % node.__class__.__name__, None)
         if handler is None:
             raise UnsupportedNode(node)
         else:
-            handler(node)
+            with self.located(node):
+                handler(node)
 
     def handle_Module(self, node):
         for child in node.body:
@@ -65,7 +93,7 @@ class Compiler(object):
             source = self.context.find_import(name, self.assembler)
             if source:
                 with self.context.namespace(name):
-                    self.compile(source)
+                    self.compile(source, self.context.sources.get(name))
 
     def handle_Expr(self, node):
         self.handle(node.value)
@@ -80,6 +108,8 @@ class Compiler(object):
                 return '[%s]' % resolve(thing.elts[0])
             else:
                 raise TypeError(thing)
+        if self.fold_calls and self.fold_call(node):
+            return
         function = self.context.resolve_function(node, self.assembler)
         if function:
             # handle args
@@ -92,24 +122,52 @@ class Compiler(object):
                 self.write_function(function)
                 function.deferred = False
 
+    def fold_call(self, node):
+        """
+        Evaluate a call to a pure user function with literal arguments at
+        compile time and emit the resulting register state. Returns True if
+        the call was folded.
+        """
+        try:
+            function = self.context.lookup_function(node)
+        except (NameError, TypeError):
+            return False
+        if function is None:
+            return False
+        evaluator = Evaluator(self.context, self.assembler.registers)
+        try:
+            state = evaluator.evaluate_call(function, node.args)
+        except NotConstant:
+            return False
+        for register, value in state:
+            self.assembler.SET(register, value)
+        return True
+
     def handle_FunctionDef(self, node):
         args = [arg.id for arg in node.args.args]
-        function = self.context.define_function(node.name, args, node)
+        function = self.context.define_function(node.name, args, node, filename=self.filename)
         if node.decorator_list:
             if len(node.decorator_list) > 1:
                 raise CompilerError("Functions can only have one decorator", node)
             self.write_function(function)
             decorator = node.decorator_list[0]
-            tree = ast.Call(
-                func=decorator,
-                args=[ast.List(elts=[ast.Name(id=function.name)])]
-            )
+            handler = ast.List(elts=[ast.Name(id=function.name)])
+            if isinstance(decorator, ast.Call):
+                # @decorator(args) calls decorator(args, [function])
+                tree = ast.Call(func=decorator.func, args=decorator.args + [handler], keywords=decorator.keywords)
+            else:
+                tree = ast.Call(func=decorator, args=[handler], keywords=[])
             self.handle(tree)
 
     def write_function(self, function):
-        with self.assembler.label(function.name):
+        with self.assembler.label(function.name), self.context.namespace(function.namespace), \
+                self.located(function.node, function.filename):
+            if self.profiler is not None:
+                self.profiler.enter(self.assembler, function.name)
             for child in function.node.body:
                 self.handle(child)
+            if self.profiler is not None:
+                self.profiler.leave(self.assembler, function.name)
             self.assembler.return_from_subroutine()
 
     def handle_Assign(self, node):
@@ -143,14 +201,163 @@ class Compiler(object):
         instruction(register, value)
 
 
-def do_compile(source, paths=None):
+def do_compile(source, paths=None, optimization='1', verify=False, report=None, analysis=None,
+               profiler=None, profile_map=None, filename=None, line_report=None, source_map=None, stream=False):
+    """
+    Compile source and write the assembly to stdout. optimization is one of
+    the levels in llpy16.passes.LEVELS, if report is a file-like object the
+    timing and size/cycle changes of every pass are written to it. If
+    analysis is a file-like object, the stack depth and memory map of the
+    program are written to it. If profiler (a llpy16.profiler.Profiler) is
+    given, the program is instrumented and the symbol map of the profile
+    counters is written to the file-like object profile_map. filename is the
+    file source was read from, line_report and source_map optional file-like
+    objects for the words and cycles per source line (see
+    llpy16.sourcemap). If stream is set, the output is spooled as it is
+    compiled where the optimization level allows it (see compile_program).
+    """
+    assembler = compile_program(source, paths, optimization, verify, report, analysis, spool=stream,
+                                profiler=profiler, filename=filename, line_report=line_report,
+                                source_map=source_map)
+    if profiler is not None and profile_map is not None:
+        profiler.write_map(assembler, profile_map)
+    assembler.write_assembled(sys.stdout)
+
+
+def compile_program(source, paths=None, optimization='1', verify=False, report=None, analysis=None,
+                    index=None, cache=None, context=None, spool=False, profiler=None, filename=None,
+                    line_report=None, source_map=None, object_dir=None):
+    """
+    Like do_compile, but returns the Assembler holding the program instead
+    of writing it. index is an optional llpy16.context.ImportIndex, cache an
+    optional llpy16.context.ModuleCache, object_dir the directory holding
+    the prebuilt objects (next to the sources if None). If context is given,
+    it is used instead of creating a new one. If spool is set and neither the
+    passes nor the reports need the whole program, the assembler spools its
+    output (see Assembler): at -O0 and -O1, whose peephole runs on each
+    section as it is spooled (see llpy16.passes.SECTION_PASSES). Extensions
+    such as interrupts.handler analyse the program as it is compiled and
+    assume the worst of spooled code, so interrupt entries save every
+    register then. profiler is an optional llpy16.profiler.Profiler to
+    instrument the program with. Modules whose objects define labels the
+    program defines too (see llpy16.objects.link) are compiled from source
+    instead.
+    """
+    if filename is None:
+        filename = '<source>'
+    if not paths:
+        paths = []
+
+    manager = PassManager.for_level(optimization, verify)
+    needs_sections = verify or any(option is not None for option in (
+        report, analysis, profiler, line_report, source_map
+    ))
+    section_filter = manager.section_filter()
+    spool = spool and section_filter is not None and not needs_sections
+    if context is None:
+        # prebuilt objects are not instrumented
+        context = Context([STDLIB_PATH] + paths, use_objects=profiler is None, index=index, cache=cache,
+                          object_dir=object_dir)
+
+    while True:
+        assembler = Assembler(spool=spool, section_filter=section_filter if spool else None)
+        compiler = Compiler(assembler, context, fold_calls=str(optimization) != '0', profiler=profiler)
+        if profiler is not None:
+            profiler.start(assembler, context)
+        compiler.compile(source, filename)
+        if not context.objects:
+            break
+        try:
+            link(assembler, context.objects)
+        except LinkError as exc:
+            clashing = exc.modules - context.source_modules
+            if not clashing:
+                raise
+            # the objects generated labels the program uses too
+            context.restart(clashing)
+            continue
+        break
+    if profiler is not None:
+        if profiler.blocks:
+            profiler.instrument_blocks(assembler)
+        profiler.write_region(assembler)
+    if not assembler.spooling:
+        manager.run(assembler)
+    if report is not None:
+        manager.write_report(report)
+    if analysis is not None:
+        analyze(assembler).write_report(analysis)
+    if line_report is not None or source_map is not None:
+        lines = SourceReport(assembler.get_sections())
+        if line_report is not None:
+            lines.write_report(line_report)
+        if source_map is not None:
+            lines.write_map(source_map)
+    return assembler
+
+
+def compile_object(name, paths=None):
+    """
+    Compile the module name into an ObjectModule. All functions of the
+    module are compiled, whether they are called or not. Imports of the
+    module are compiled from source into the object.
+    """
     if not paths:
         paths = []
 
     assembler = Assembler()
-    context = Context([STDLIB_PATH] + paths)
+    context = Context([STDLIB_PATH] + paths, use_objects=False)
 
     compiler = Compiler(assembler, context)
 
-    compiler.compile(source)
-    sys.stdout.write(assembler.get_assembled() + '\n')
+    source = context.find_import(name, assembler)
+    imports = []
+    with context.namespace(name):
+        if source:
+            tree = ast.parse(source)
+            imports = [alias.name for node in tree.body if isinstance(node, ast.Import) for alias in node.names]
+            with compiler.located(tree, context.sources.get(name)):
+                compiler.handle(tree)
+        functions = context.current_namespace.functions
+    for function_name in sorted(functions):
+        function = functions[function_name]
+        if function.deferred:
+            compiler.write_function(function)
+            function.deferred = False
+    exports = dict(
+        (function_name, {'label': function.name, 'args': function.args})
+        for function_name, function in functions.items()
+    )
+    sections = assembler.get_sections()
+    body = sections[0]
+    sections = [section for section in sections[1:] if section[0].name != assembler.halt_label]
+    return ObjectModule(name, body, sections, exports, imports, context.files)
+
+
+def build_objects(path, paths=None, force=True, object_dir=None):
+    """
+    Compile every .llpy16 module below path into an object next to its
+    source, or below object_dir if given. Unless force is set, modules with
+    a current object are skipped. Returns the names of the modules built.
+    """
+    built = []
+    for directory, _, filenames in os.walk(path):
+        for filename in sorted(filenames):
+            base, extension = os.path.splitext(filename)
+            if extension != '.llpy16':
+                continue
+            relative = os.path.relpath(os.path.join(directory, base), path)
+            name = '.'.join(relative.split(os.sep))
+            if object_dir is None:
+                filename = os.path.join(directory, base + OBJECT_EXTENSION)
+            else:
+                filename = os.path.join(object_dir, relative + OBJECT_EXTENSION)
+                if not os.path.isdir(os.path.dirname(filename)):
+                    os.makedirs(os.path.dirname(filename))
+            if not force and load_object(filename) is not None:
+                continue
+            obj = compile_object(name, [path] + (paths or []))
+            with open(filename, 'w') as fobj:
+                obj.dump(fobj)
+            built.append(name)
+    return built
@@ -5,14 +5,17 @@ from contextlib import contextmanager
 import os
 import imp
 from llpy16.assembler import hexify
+from llpy16.objects import OBJECT_EXTENSION, file_digest, load_object
 
 
 class Function(object):
-    def __init__(self, name, args, node, deferred=True):
+    def __init__(self, name, args, node, deferred=True, namespace='', filename=None):
         self.name = name
         self.args = args
         self.node = node
         self.deferred = deferred
+        self.namespace = namespace
+        self.filename = filename
 
 
 class Namespace(object):
@@ -42,14 +45,171 @@ class RegisterOperation(object):
         return '%s %s %s' % (hexify(self.left), self.operator, hexify(self.right))
 
 
+class ImportIndex(object):
+    """
+    Index of the files below a set of paths and cache of the extension and
+    object modules loaded from them, shared by many compilations (see
+    llpy16.batch) so they neither probe the file system for every import nor
+    reload modules.
+    """
+    def __init__(self, paths):
+        self._roots = []
+        self._files = set()
+        self._objects = {}
+        self._extensions = {}
+        for path in paths:
+            self.add_path(path)
+
+    def add_path(self, path):
+        # with a trailing separator, so /lib is not a prefix of /library/x
+        root = os.path.join(os.path.normpath(path), '')
+        if root in self._roots:
+            return
+        self._roots.append(root)
+        for directory, _, filenames in os.walk(path):
+            self._files.update(os.path.normpath(os.path.join(directory, filename)) for filename in filenames)
+
+    def exists(self, filename):
+        filename = os.path.normpath(filename)
+        if any(filename.startswith(root) for root in self._roots):
+            return filename in self._files
+        return os.path.exists(filename)
+
+    def load_extension(self, name, path):
+        if path not in self._extensions:
+            self._extensions[path] = imp.load_source(name, path)
+        return self._extensions[path]
+
+    def load_object(self, filename):
+        if filename not in self._objects:
+            self._objects[filename] = load_object(filename) if self.exists(filename) else None
+        return self._objects[filename]
+
+
+class ModuleCache(object):
+    """
+    Keeps extension modules, file digests, parsed sources and object modules
+    between compilations (see llpy16.server). Entries are reloaded when the
+    modification time or size of their file changes.
+
+    If builder is given, modules without a current object file are compiled
+    into objects with builder(name, paths) (see
+    llpy16.compiler.compile_object), which are kept until the digest of a
+    file they were compiled from changes.
+    """
+    def __init__(self, builder=None):
+        self._builder = builder
+        self._entries = {}
+        self._trees = {}
+        # (paths, object) by module source
+        self._built = {}
+
+    def _get(self, kind, path, load):
+        stat = os.stat(path)
+        key = (stat.st_mtime, stat.st_size)
+        entry = self._entries.get((kind, path))
+        if entry is None or entry[0] != key:
+            entry = (key, load(path))
+            self._entries[(kind, path)] = entry
+        return entry[1]
+
+    def load_extension(self, name, path):
+        return self._get('extension', path, lambda path: imp.load_source(name, path))
+
+    def digest(self, path):
+        return self._get('digest', path, file_digest)
+
+    def read(self, path):
+        def read(path):
+            with open(path) as fobj:
+                return fobj.read()
+        return self._get('source', path, read)
+
+    def parse(self, source):
+        if source not in self._trees:
+            self._trees[source] = ast.parse(source)
+        return self._trees[source]
+
+    def load_object(self, path):
+        if not os.path.exists(path):
+            return None
+        obj = self._get('object', path, load_object)
+        if obj is None or not self._current(obj):
+            return None
+        return obj
+
+    def build_object(self, name, path, paths):
+        """
+        The object of the module name compiled from the source path, None
+        without a builder.
+        """
+        if self._builder is None:
+            return None
+        built = self._built.get(path)
+        if built is None or built[0] != paths or not self._current(built[1]):
+            built = (paths, self._builder(name, paths))
+            self._built[path] = built
+        return built[1]
+
+    def _current(self, obj):
+        try:
+            return all(self.digest(path) == digest for path, digest in obj.files.items())
+        except OSError:
+            return False
+
+    def forget(self, keep):
+        """
+        Drop everything loaded from files that are missing or not in keep,
+        and the parsed sources none of the remaining files holds.
+        """
+        def kept(path):
+            return path in keep and os.path.exists(path)
+        for key in list(self._entries):
+            if not kept(key[1]):
+                del self._entries[key]
+        for path in list(self._built):
+            if not kept(path):
+                del self._built[path]
+        sources = set(entry[1] for (kind, _), entry in self._entries.items() if kind == 'source')
+        for source in list(self._trees):
+            if source not in sources:
+                del self._trees[source]
+
+
 class Context(object):
     _sep = '__'
 
-    def __init__(self, paths):
+    def __init__(self, paths, use_objects=True, index=None, cache=None, object_dir=None):
         self._paths = paths
+        self._index = index
+        self._exists = index.exists if index is not None else os.path.exists
+        self._load_object = index.load_object if index is not None else load_object
+        self._cache = cache
+        if cache is not None:
+            self._load_object = cache.load_object
+        self.use_objects = use_objects
+        # objects are looked up below object_dir instead of next to the sources
+        self.object_dir = object_dir
+        # modules compiled from source even if they have an object
+        self.source_modules = set()
+        self.restart()
+
+    def restart(self, source_modules=()):
+        """
+        Forget everything imported and defined, to compile the program again
+        with the modules in source_modules compiled from source.
+        """
+        self.source_modules.update(source_modules)
         self._namespaces = defaultdict(Namespace)
         self._current_namespace = ''
         self._modules = []
+        # object modules to link, see llpy16.objects
+        self.objects = []
+        # digests of all source files read, by path
+        self.files = {}
+        # source file of every module compiled from source, by module name
+        self.sources = {}
+        self._function_labels = set()
 
     # Public API
 
@@ -57,13 +217,17 @@ class Context(object):
         if name in self._modules:
             # already imported
             return
+        self._modules.append(name)
+        module_name = name
         bits = name.split('.')
         for path in self._paths:
             pypath = os.path.join(path, *bits) + '.py'
             llpath = os.path.join(path, *bits) + '.llpy16'
+            objpath = os.path.join(self.object_dir or path, *bits) + OBJECT_EXTENSION
             found = False
-            if os.path.exists(pypath):
-                module = imp.load_source(name, pypath)
+            if self._exists(pypath):
+                self.files[pypath] = self._digest(pypath)
+                module = self._load_extension(name, pypath)
                 with self.namespace(name):
                     for name in getattr(module, 'LLPY16_EXTS', []):
                         self.define_extension(name, getattr(module, name))
@@ -75,12 +239,36 @@ class Context(object):
                     if callable(initialize):
                         initialize(assembler, self)
                 found = True
-            if os.path.exists(llpath):
-                with open(llpath) as fobj:
-                    return fobj.read()
+            if self._exists(llpath):
+                obj = None
+                if self.use_objects and module_name not in self.source_modules:
+                    obj = self._find_object(module_name, llpath, objpath)
+                if obj is not None:
+                    self.link_object(obj, assembler)
+                    return
+                self.files[llpath] = self._digest(llpath)
+                self.sources[module_name] = llpath
+                return self._read(llpath)
             if found:
                 return
-        raise ImportError(name)
+        raise ImportError(module_name)
+
+    def link_object(self, obj, assembler):
+        """
+        Use a prebuilt object module instead of compiling the module source.
+        """
+        for name in obj.imports:
+            # modules imported by the module are visible to the importer
+            self.find_import(name, assembler)
+        with self.namespace(obj.name):
+            for name, export in obj.exports.items():
+                self.current_namespace.functions[name] = Function(
+                    export['label'], export['args'], None, False, obj.name
+                )
+        for item in obj.body:
+            assembler.write_item(item)
+        self.files.update(obj.files)
+        self.objects.append(obj)
 
     def define_extension(self, name, handler):
         self.current_namespace.extensions[name] = handler
@@ -94,9 +282,12 @@ class Context(object):
     def get_constant(self, name):
         return self.current_namespace.constants[name]
 
-    def define_function(self, name, args, node, deferred=True):
+    def define_function(self, name, args, node, deferred=True, filename=None):
         expanded_name = self.expand_name(name)
-        self.current_namespace.functions[name] = function = Function(expanded_name, args, node, deferred)
+        self.current_namespace.functions[name] = function = Function(
+            expanded_name, args, node, deferred, self._current_namespace, filename
+        )
+        self._function_labels.add(expanded_name)
         return function
 
     def get_function(self, name):
@@ -121,6 +312,20 @@ class Context(object):
             args, kwargs = self._call_to_args_kwargs(node)
             ext(assembler, self, *args, **kwargs)
 
+    def lookup_function(self, node):
+        """
+        Like resolve_function, but never invokes extensions. Returns None if
+        node calls an extension.
+        """
+        name, namespace = self.resolve_name(node.func)
+        with self.namespace(namespace):
+            if name in self.current_namespace.extensions:
+                return None
+            try:
+                return self.get_function(name)
+            except KeyError:
+                raise NameError('%s.%s' % (namespace, name))
+
     def expand_name(self, name):
         return self._current_namespace.replace('.', self._sep) + self._sep + name
 
@@ -133,8 +338,37 @@ class Context(object):
         finally:
             self._current_namespace = old
 
+    def parse(self, source):
+        if self._cache is not None:
+            return self._cache.parse(source)
+        return ast.parse(source)
+
     # Private API
 
+    def _find_object(self, name, llpath, objpath):
+        obj = self._load_object(objpath)
+        if obj is None and self._cache is not None:
+            obj = self._cache.build_object(name, llpath, self._paths)
+        return obj
+
+    def _digest(self, path):
+        if self._cache is not None:
+            return self._cache.digest(path)
+        return file_digest(path)
+
+    def _load_extension(self, name, path):
+        if self._cache is not None:
+            return self._cache.load_extension(name, path)
+        if self._index is not None:
+            return self._index.load_extension(name, path)
+        return imp.load_source(name, path)
+
+    def _read(self, path):
+        if self._cache is not None:
+            return self._cache.read(path)
+        with open(path) as fobj:
+            return fobj.read()
+
     @property
     def current_namespace(self):
         return self._namespaces[self._current_namespace]
@@ -198,6 +432,9 @@ class Context(object):
                             try:
                                 return self.get_function(name).name
                             except KeyError:
+                                if name in self._function_labels:
+                                    # decorated functions are passed by label
+                                    return name
                                 print self.current_namespace.functions
                                 raise NameError(name)
         args = map(_get_value, node.args)
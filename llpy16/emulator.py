@@ -0,0 +1,427 @@
+# -*- coding: utf-8 -*-
+"""
+DCPU-16 interpreter for assembled programs.
+
+The sections of an Assembler (see Assembler.get_sections) are laid out the
+way they would be assembled: DAT words are loaded into memory and every
+instruction runs from its address, so code that writes over itself is not
+supported.
+
+Hardware is a list of device objects with id, version and manufacturer
+attributes (32 bit numbers but version) that HWQ reports. HWI calls their
+interrupt(emulator) method, and devices that have a tick(emulator) method
+get it called after every instruction, which is where they can trigger
+interrupts of their own (see Emulator.trigger).
+
+Cycles are counted like Instruction.cycles, plus one for every instruction
+skipped by a failed test.
+
+execute compiles a program and runs it, differences compares the state two
+runs ended in.
+"""
+import re
+from .assembler import Label
+from .compiler import compile_program
+from .passes import measure
+
+MEMORY_SIZE = 0x10000
+WORD_MASK = 0xFFFF
+# registers in context order
+REGISTERS = ('A', 'B', 'C', 'X', 'Y', 'Z', 'I', 'J')
+SPECIAL = ('SP', 'PC', 'EX')
+# interrupts the queue holds before the DCPU-16 catches fire
+MAX_QUEUE = 256
+
+TERM = re.compile(r'\s*([+-])?\s*(0x[0-9a-fA-F]+|\d+|[A-Za-z_]\w*)\s*')
+
+
+class EmulatorError(Exception):
+    pass
+
+
+def _signed(value):
+    return value - 0x10000 if value & 0x8000 else value
+
+def _truncated(left, right):
+    # division rounding towards 0, as DVI and MDI do
+    quotient = abs(left) // abs(right)
+    return -quotient if (left < 0) != (right < 0) else quotient
+
+
+class Emulator(object):
+    def __init__(self, sections, hardware=()):
+        self.hardware = list(hardware)
+        self.memory = [0] * MEMORY_SIZE
+        self.registers = dict((register, 0) for register in REGISTERS + SPECIAL)
+        self.interrupt_address = 0
+        self.queueing = False
+        self.queue = []
+        self.cycles = 0
+        self.steps = 0
+        self.halted = False
+        # lowest address the stack reached, MEMORY_SIZE if it was never used
+        self.stack_bottom = MEMORY_SIZE
+        self.labels = {}
+        self._code = {}
+        self._load(sections)
+
+    def _load(self, sections):
+        items = []
+        address = 0
+        for section in sections:
+            for item in section:
+                if isinstance(item, Label):
+                    self.labels[item.name] = address
+                else:
+                    items.append((address, item))
+                address += item.size
+        if address > MEMORY_SIZE:
+            raise EmulatorError('program of %d words does not fit in memory' % address)
+        self.image_size = address
+        for address, item in items:
+            if item.opcode == 'DAT':
+                for word in self._data(item):
+                    self.memory[address] = word
+                    address += 1
+                continue
+            operands = [self._parse(arg) for arg in item.args]
+            self._code[address] = (item, operands, address + item.size)
+
+    def _data(self, item):
+        for arg in item.args:
+            if isinstance(arg, basestring) and not arg.isdigit():
+                for char in arg:
+                    yield ord(char)
+            else:
+                yield self._value(arg) & WORD_MASK
+
+    def _value(self, text):
+        """
+        Value of a constant expression: numbers, labels, + and -.
+        """
+        kind, value = self._parse(text)
+        if kind != 'literal':
+            raise EmulatorError('%r is not a constant' % text)
+        return value
+
+    def _parse(self, arg):
+        """
+        Turn an operand into (kind, value): ('register', name),
+        ('literal', number), ('memory', terms), ('push', None) or ('pop',
+        None). terms are (register or None, number) pairs that are added up.
+        PEEK and PICK are memory operands relative to SP.
+        """
+        if isinstance(arg, (int, long)):
+            return 'literal', arg & WORD_MASK
+        text = str(arg).strip()
+        upper = text.upper()
+        if upper in REGISTERS or upper in SPECIAL:
+            return 'register', upper
+        if upper == 'PUSH':
+            return 'push', None
+        if upper == 'POP':
+            return 'pop', None
+        if upper == 'PEEK':
+            return 'memory', [('SP', 0)]
+        if upper.startswith('PICK '):
+            return 'memory', [('SP', self._value(text[5:]))]
+        if text.startswith('[') and text.endswith(']'):
+            return 'memory', self._terms(text[1:-1])
+        terms = self._terms(text)
+        if any(register for register, _ in terms):
+            raise EmulatorError('%r is not a valid operand' % text)
+        return 'literal', sum(number for _, number in terms) & WORD_MASK
+
+    def _terms(self, text):
+        terms = []
+        position = 0
+        while position < len(text):
+            match = TERM.match(text, position)
+            if not match or (terms and not match.group(1)):
+                raise EmulatorError('cannot parse %r' % text)
+            position = match.end()
+            sign, token = match.groups()
+            if token.upper() in REGISTERS or token.upper() in SPECIAL:
+                if sign == '-':
+                    raise EmulatorError('cannot subtract a register in %r' % text)
+                terms.append((token.upper(), 0))
+            elif token[0].isdigit():
+                terms.append((None, -int(token, 0) if sign == '-' else int(token, 0)))
+            elif token in self.labels:
+                terms.append((None, -self.labels[token] if sign == '-' else self.labels[token]))
+            else:
+                raise EmulatorError('undefined label %r' % token)
+        return terms
+
+    # Operands
+
+    def _locate(self, operand):
+        """
+        Resolve an operand to (kind, where), running the stack side effects
+        of PUSH and POP.
+        """
+        kind, value = operand
+        if kind == 'memory':
+            address = 0
+            for register, number in value:
+                address += number
+                if register is not None:
+                    address += self.registers[register]
+            return 'memory', address & WORD_MASK
+        if kind == 'push':
+            self.registers['SP'] = (self.registers['SP'] - 1) & WORD_MASK
+            self.stack_bottom = min(self.stack_bottom, self.registers['SP'])
+            return 'memory', self.registers['SP']
+        if kind == 'pop':
+            address = self.registers['SP']
+            self.registers['SP'] = (address + 1) & WORD_MASK
+            return 'memory', address
+        return kind, value
+
+    def _read(self, location):
+        kind, where = location
+        if kind == 'register':
+            return self.registers[where]
+        if kind == 'memory':
+            return self.memory[where]
+        return where
+
+    def _write(self, location, value):
+        kind, where = location
+        value &= WORD_MASK
+        if kind == 'register':
+            self.registers[where] = value
+        elif kind == 'memory':
+            self.memory[where] = value
+        # writes to literals are ignored
+
+    def push(self, value):
+        self._write(self._locate(('push', None)), value)
+
+    def pop(self):
+        return self._read(self._locate(('pop', None)))
+
+    # Execution
+
+    def run(self, max_steps=100000):
+        """
+        Run until the program loops on a jump to itself (see
+        Assembler.halt_label). Raises EmulatorError after max_steps
+        instructions.
+        """
+        while not self.halted:
+            if self.steps >= max_steps:
+                raise EmulatorError('program did not halt after %d instructions' % max_steps)
+            self.step()
+        return self
+
+    def step(self):
+        address = self.registers['PC']
+        item, operands, following = self._fetch(address)
+        self.registers['PC'] = following
+        self.steps += 1
+        self.cycles += item.cycles
+        if item.opcode == 'SET' and operands[0] == ('register', 'PC') and self._jumps_to(operands[1], address):
+            self.halted = True
+            return
+        if item.opcode in ('JSR', 'INT', 'IAG', 'IAS', 'RFI', 'IAQ', 'HWN', 'HWQ', 'HWI'):
+            self._special(item.opcode, self._locate(operands[0]))
+        else:
+            # a is evaluated before b
+            a = self._locate(operands[1])
+            b = self._locate(operands[0])
+            if item.is_conditional:
+                if not self._test(item.opcode, self._read(b), self._read(a)):
+                    self._skip()
+            else:
+                self._basic(item.opcode, b, self._read(b), self._read(a))
+        for device in self.hardware:
+            if hasattr(device, 'tick'):
+                device.tick(self)
+        self._interrupt()
+
+    def _fetch(self, address):
+        try:
+            return self._code[address]
+        except KeyError:
+            raise EmulatorError('PC 0x%04x is not at an instruction' % address)
+
+    def _jumps_to(self, operand, address):
+        return operand == ('literal', address)
+
+    def _skip(self):
+        # a failed test skips the next instruction and the tests chained to it
+        while True:
+            item, _, following = self._fetch(self.registers['PC'])
+            self.registers['PC'] = following
+            self.cycles += 1
+            if not item.is_conditional:
+                return
+
+    def _test(self, opcode, b, a):
+        if opcode == 'IFB':
+            return (b & a) != 0
+        if opcode == 'IFC':
+            return (b & a) == 0
+        if opcode == 'IFE':
+            return b == a
+        if opcode == 'IFN':
+            return b != a
+        if opcode == 'IFG':
+            return b > a
+        if opcode == 'IFA':
+            return _signed(b) > _signed(a)
+        if opcode == 'IFL':
+            return b < a
+        if opcode == 'IFU':
+            return _signed(b) < _signed(a)
+        raise EmulatorError('unknown test %s' % opcode)
+
+    def _basic(self, opcode, location, b, a):
+        ex = None
+        if opcode == 'SET':
+            value = a
+        elif opcode == 'ADD':
+            value = b + a
+            ex = 1 if value > WORD_MASK else 0
+        elif opcode == 'SUB':
+            value = b - a
+            ex = WORD_MASK if value < 0 else 0
+        elif opcode == 'MUL':
+            value = b * a
+            ex = value >> 16
+        elif opcode == 'MLI':
+            value = _signed(b) * _signed(a)
+            ex = value >> 16
+        elif opcode == 'DIV':
+            value = b // a if a else 0
+            ex = (b << 16) // a if a else 0
+        elif opcode == 'DVI':
+            value = _truncated(_signed(b), _signed(a)) if a else 0
+            ex = _truncated(_signed(b) << 16, _signed(a)) if a else 0
+        elif opcode == 'MOD':
+            value = b % a if a else 0
+        elif opcode == 'MDI':
+            value = _signed(b) - _truncated(_signed(b), _signed(a)) * _signed(a) if a else 0
+        elif opcode == 'AND':
+            value = b & a
+        elif opcode == 'BOR':
+            value = b | a
+        elif opcode == 'XOR':
+            value = b ^ a
+        elif opcode in ('SHR', 'ASR', 'SHL') and a > 32:
+            # everything is shifted out
+            value = _signed(b) >> 16 if opcode == 'ASR' else 0
+            ex = value
+        elif opcode == 'SHR':
+            value = b >> a
+            ex = (b << 16) >> a
+        elif opcode == 'ASR':
+            value = _signed(b) >> a
+            ex = (_signed(b) << 16) >> a
+        elif opcode == 'SHL':
+            value = b << a
+            ex = value >> 16
+        elif opcode == 'ADX':
+            value = b + a + self.registers['EX']
+            ex = 1 if value > WORD_MASK else 0
+        elif opcode == 'SBX':
+            value = b - a + _signed(self.registers['EX'])
+            ex = WORD_MASK if value < 0 else (1 if value > WORD_MASK else 0)
+        elif opcode in ('STI', 'STD'):
+            value = a
+            step = 1 if opcode == 'STI' else -1
+            for register in ('I', 'J'):
+                self.registers[register] = (self.registers[register] + step) & WORD_MASK
+        else:
+            raise EmulatorError('unknown instruction %s' % opcode)
+        self._write(location, value)
+        if ex is not None:
+            self.registers['EX'] = ex & WORD_MASK
+
+    def _special(self, opcode, location):
+        if opcode == 'JSR':
+            target = self._read(location)
+            self.push(self.registers['PC'])
+            self.registers['PC'] = target
+        elif opcode == 'INT':
+            self.trigger(self._read(location))
+        elif opcode == 'IAG':
+            self._write(location, self.interrupt_address)
+        elif opcode == 'IAS':
+            self.interrupt_address = self._read(location)
+        elif opcode == 'RFI':
+            self.queueing = False
+            self.registers['A'] = self.pop()
+            self.registers['PC'] = self.pop()
+        elif opcode == 'IAQ':
+            self.queueing = self._read(location) != 0
+        elif opcode == 'HWN':
+            self._write(location, len(self.hardware))
+        elif opcode == 'HWQ':
+            device = self._device(self._read(location))
+            if device is not None:
+                for low, high, value in (('A', 'B', device.id), ('X', 'Y', device.manufacturer)):
+                    self.registers[low] = value & WORD_MASK
+                    self.registers[high] = (value >> 16) & WORD_MASK
+                self.registers['C'] = device.version & WORD_MASK
+        elif opcode == 'HWI':
+            device = self._device(self._read(location))
+            if device is not None:
+                device.interrupt(self)
+
+    def _device(self, index):
+        # nothing is connected past the last device
+        return self.hardware[index] if index < len(self.hardware) else None
+
+    def trigger(self, message):
+        """
+        Queue the interrupt message, as INT and devices do.
+        """
+        if len(self.queue) >= MAX_QUEUE:
+            raise EmulatorError('interrupt queue overflow')
+        self.queue.append(message)
+
+    def _interrupt(self):
+        if self.queueing or not self.queue:
+            return
+        message = self.queue.pop(0)
+        if not self.interrupt_address:
+            return
+        self.queueing = True
+        self.push(self.registers['PC'])
+        self.push(self.registers['A'])
+        self.registers['PC'] = self.interrupt_address
+        self.registers['A'] = message
+
+
+def execute(source, optimization, max_steps, hardware=()):
+    """
+    Compile source at the optimization level and run it with the devices in
+    hardware attached, returns the size of the program in words and the
+    Emulator it ran on.
+    """
+    assembler = compile_program(source, optimization=optimization, verify=True)
+    sections = assembler.get_sections()
+    emulator = Emulator(sections, hardware).run(max_steps)
+    return measure(sections)[0], emulator
+
+def differences(reference, emulator):
+    """
+    How the final state of emulator differs from the one of reference.
+    """
+    found = []
+    for register in REGISTERS + ('SP', 'EX'):
+        if emulator.registers[register] != reference.registers[register]:
+            found.append('%s is 0x%04x, expected 0x%04x' % (
+                register, emulator.registers[register], reference.registers[register]
+            ))
+    start = max(reference.image_size, emulator.image_size)
+    end = min(reference.stack_bottom, emulator.stack_bottom)
+    if emulator.memory[start:end] != reference.memory[start:end]:
+        for address in range(start, end):
+            if emulator.memory[address] != reference.memory[address]:
+                found.append('[0x%04x] is 0x%04x, expected 0x%04x' % (
+                    address, emulator.memory[address], reference.memory[address]
+                ))
+    return found
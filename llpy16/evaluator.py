@@ -0,0 +1,148 @@
+# -*- coding: utf-8 -*-
+"""
+Compile time evaluation of side-effect free user functions.
+
+A function is pure if its body only assigns registers (``Assign`` and
+``AugAssign``) and calls other pure functions. Calling it with literal
+arguments therefore always leaves the registers in the same state, which can
+be computed here and emitted as plain ``SET`` instructions instead of a
+``JSR`` to the function. EX is part of that state: the instructions the
+operators compile to set it as on the DCPU-16, so a folded call sets it to
+the value the last of them would have left.
+"""
+import ast
+
+WORD_MASK = 0xFFFF
+
+
+class NotConstant(Exception):
+    """
+    Raised when a call cannot be evaluated at compile time, either because
+    the function has side effects or because a value is unknown.
+    """
+
+
+# Operators return (value, EX), EX is None if the instruction leaves it alone
+
+def _add(left, right):
+    return (left + right) & WORD_MASK, 1 if left + right > WORD_MASK else 0
+
+def _sub(left, right):
+    return (left - right) & WORD_MASK, WORD_MASK if left < right else 0
+
+def _mul(left, right):
+    return (left * right) & WORD_MASK, ((left * right) >> 16) & WORD_MASK
+
+def _div(left, right):
+    if right == 0:
+        return 0, 0
+    return left // right, ((left << 16) // right) & WORD_MASK
+
+def _shl(left, right):
+    if right > 32:
+        return 0, 0
+    return (left << right) & WORD_MASK, ((left << right) >> 16) & WORD_MASK
+
+def _shr(left, right):
+    if right > 32:
+        return 0, 0
+    return left >> right, ((left << 16) >> right) & WORD_MASK
+
+OPERATORS = {
+    ast.Add: _add,
+    ast.Sub: _sub,
+    ast.Mult: _mul,
+    ast.Div: _div,
+    ast.LShift: _shl,
+    ast.RShift: _shr,
+    ast.BitOr: lambda left, right: (left | right, None),
+    ast.BitAnd: lambda left, right: (left & right, None),
+    ast.BitXor: lambda left, right: (left ^ right, None),
+}
+
+
+class Evaluator(object):
+    def __init__(self, context, registers):
+        self.context = context
+        self.registers = registers
+        self.state = {}
+        self.written = []
+        self._stack = []
+
+    def evaluate_call(self, function, args):
+        """
+        Evaluate a call to function with the given argument nodes and return a
+        list of (register, value) pairs describing the final state of every
+        register the call writes to, EX included.
+        """
+        self.call(function, [self.literal(arg) for arg in args])
+        return [(register, self.state[register]) for register in self.written]
+
+    def call(self, function, values):
+        if function.node is None or function.name in self._stack:
+            # prebuilt functions have no source to evaluate
+            raise NotConstant(function.name)
+        for register, value in zip(function.args, values):
+            self.write(register, value)
+        self._stack.append(function.name)
+        try:
+            with self.context.namespace(function.namespace):
+                for child in function.node.body:
+                    self.statement(child)
+        finally:
+            self._stack.pop()
+
+    def statement(self, node):
+        if isinstance(node, ast.Assign):
+            if len(node.targets) != 1:
+                raise NotConstant(node)
+            self.write(self.target(node.targets[0]), self.value(node.value))
+        elif isinstance(node, ast.AugAssign):
+            operator = OPERATORS.get(node.op.__class__)
+            if operator is None:
+                raise NotConstant(node)
+            register = self.target(node.target)
+            value, ex = operator(self.read(register), self.value(node.value))
+            self.write(register, value)
+            if ex is not None:
+                self.write('EX', ex)
+        elif isinstance(node, ast.Expr) and isinstance(node.value, ast.Call):
+            call = node.value
+            if call.keywords or getattr(call, 'starargs', None) or getattr(call, 'kwargs', None):
+                raise NotConstant(call)
+            try:
+                function = self.context.lookup_function(call)
+            except (NameError, TypeError):
+                raise NotConstant(call)
+            if function is None:
+                # extensions may emit arbitrary code
+                raise NotConstant(call)
+            self.call(function, [self.value(arg) for arg in call.args])
+        else:
+            raise NotConstant(node)
+
+    def target(self, node):
+        if not isinstance(node, ast.Name) or node.id not in self.registers:
+            raise NotConstant(node)
+        return node.id
+
+    def value(self, node):
+        if isinstance(node, ast.Name):
+            return self.read(self.target(node))
+        return self.literal(node)
+
+    def literal(self, node):
+        if isinstance(node, ast.Num) and isinstance(node.n, (int, long)) and 0 <= node.n <= WORD_MASK:
+            return node.n
+        raise NotConstant(node)
+
+    def read(self, register):
+        try:
+            return self.state[register]
+        except KeyError:
+            raise NotConstant(register)
+
+    def write(self, register, value):
+        if register not in self.state:
+            self.written.append(register)
+        self.state[register] = value
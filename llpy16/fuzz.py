@@ -0,0 +1,239 @@
+# -*- coding: utf-8 -*-
+"""
+Differential fuzzing of the optimizations.
+
+Random programs in the subset the compiler supports (register assignments,
+augmented assignments, calls of functions taking register arguments and
+stdlib calls) are compiled without optimizations and at every level under
+test (with the passes verified), run on llpy16.emulator and compared: the
+registers A to J, SP, EX and the memory outside the program images and the
+stack must end up the same.
+
+The language has no branches or loops of its own, they come from the stdlib
+routines the programs call: the mem block loops (the size is often in a
+register) and the fixed routines. Those runtimes are emitted whole, so
+there are always routines for prune to drop and jumps for layout to
+straighten. Every program also repeats a few statement sequences, which is
+what outline looks for.
+
+The change of the program size and of the cycles it ran for is collected
+per level, relative to -O0:
+
+    python -m llpy16.fuzz --count 500 -O 2 -O s
+
+A failing program is written out with its seed, --seed SEED --count 1 runs
+it again.
+"""
+import random
+import sys
+from .emulator import REGISTERS, differences, execute
+
+# mem writes to DATA_SIZE words from DATA_START
+DATA_START = 0x9000
+DATA_SIZE = 64
+AUGMENTED = ('+=', '-=', '*=', '/=', '<<=', '>>=', '|=', '&=', '^=')
+# numbers that tend to find carry and sign mistakes
+EDGE_NUMBERS = (0, 1, 2, 15, 16, 0x7FFF, 0x8000, 0xFFFF)
+MAX_ARGS = 2
+# block sizes: unrolled with SET, unrolled with STI and looping
+BLOCK_SIZES = ((0, 4), (5, 16), (17, 40))
+# fixed extensions and the number of distinct registers they take
+FIXED = (('div32', 3), ('mul32', 4), ('fmul16', 4), ('fdiv', 2), ('fmul', 2), ('sin', 2), ('cos', 2))
+
+
+class ProgramGenerator(object):
+    def __init__(self, rng, functions=4, statements=10, repeated=3):
+        self.rng = rng
+        self.functions = functions
+        self.statements = statements
+        self.repeated = repeated
+        self.sequences = []
+
+    def number(self):
+        choice = self.rng.random()
+        if choice < 0.3:
+            return self.rng.choice(EDGE_NUMBERS)
+        if choice < 0.7:
+            return self.rng.randint(0, 31)
+        return self.rng.randint(0, 0xFFFF)
+
+    def value(self):
+        if self.rng.random() < 0.5:
+            return self.rng.choice(REGISTERS)
+        return '%d' % self.number()
+
+    def simple(self):
+        """
+        An assignment or a mem.set.
+        """
+        kind = self.rng.random()
+        register = self.rng.choice(REGISTERS)
+        if kind < 0.35:
+            return '%s = %s' % (register, self.value())
+        if kind < 0.85:
+            operator = self.rng.choice(AUGMENTED)
+            if operator in ('<<=', '>>=') and self.rng.random() < 0.7:
+                return '%s %s %d' % (register, operator, self.rng.randint(0, 17))
+            return '%s %s %s' % (register, operator, self.value())
+        return 'mem.set(%d, %s)' % (DATA_START + self.rng.randrange(DATA_SIZE), self.value())
+
+    def block(self):
+        """
+        Lines copying, filling or comparing a block in the data words, the size
+        is often put in a register first.
+        """
+        size = self.rng.randint(*self.rng.choice(BLOCK_SIZES))
+        lines = []
+        if self.rng.random() < 0.5:
+            counter = self.rng.choice(REGISTERS)
+            lines.append('%s = %d' % (counter, size))
+        else:
+            counter = '%d' % size
+        address = lambda: DATA_START + self.rng.randint(0, DATA_SIZE - size)
+        kind = self.rng.choice(('copy', 'fill', 'compare'))
+        if kind == 'copy':
+            lines.append('mem.copy(%d, %d, %s)' % (address(), address(), counter))
+        elif kind == 'fill':
+            lines.append('mem.fill(%d, %s, %s)' % (address(), self.value(), counter))
+        else:
+            lines.append('mem.compare(%s, %d, %d, %s)' % (self.rng.choice(REGISTERS), address(), address(), counter))
+        return lines
+
+    def arithmetic(self):
+        name, count = self.rng.choice(FIXED)
+        return 'fixed.%s(%s)' % (name, ', '.join(self.rng.sample(REGISTERS, count)))
+
+    def statement(self, functions):
+        """
+        A statement as a list of lines.
+        """
+        kind = self.rng.random()
+        if kind < 0.5:
+            return [self.simple()]
+        if kind < 0.65 and functions:
+            name, args = self.rng.choice(functions)
+            return ['%s(%s)' % (name, ', '.join(self.value() for _ in args))]
+        if kind < 0.8:
+            return self.block()
+        if kind < 0.9:
+            return [self.arithmetic()]
+        return list(self.rng.choice(self.sequences))
+
+    def body(self, functions, indent=''):
+        lines = []
+        for _ in range(self.rng.randint(1, self.statements)):
+            lines.extend(indent + line for line in self.statement(functions))
+        return lines
+
+    def generate(self):
+        """
+        The source of a program. Functions only call the ones defined before
+        them, so every program terminates.
+        """
+        self.sequences = [
+            [self.simple() for _ in range(self.rng.randint(3, 6))] for _ in range(self.repeated)
+        ]
+        lines = ['import fixed', 'import mem', '']
+        functions = []
+        for index in range(self.functions):
+            name = 'f%d' % index
+            args = self.rng.sample(REGISTERS, self.rng.randint(0, MAX_ARGS))
+            lines.append('def %s(%s):' % (name, ', '.join(args)))
+            lines.extend(self.body(functions, '    '))
+            lines.append('')
+            functions.append((name, args))
+        lines.extend(self.body(functions))
+        return '\n'.join(lines) + '\n'
+
+
+def _percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+def _change(before, after):
+    return 100.0 * (after - before) / before if before else 0.0
+
+
+class LevelStatistics(object):
+    def __init__(self, level):
+        self.level = level
+        self.programs = 0
+        self.failures = 0
+        # percent changes against -O0
+        self.words = []
+        self.cycles = []
+
+    def add(self, reference, result):
+        (reference_words, reference_run), (words, run) = reference, result
+        self.words.append(_change(reference_words, words))
+        self.cycles.append(_change(reference_run.cycles, run.cycles))
+
+    def __str__(self):
+        columns = []
+        for values in (self.words, self.cycles):
+            if values:
+                columns.append('%+7.1f%% %+7.1f%% %+7.1f%% %+7.1f%%' % (
+                    min(values), _percentile(values, 0.5), max(values), sum(values) / len(values)
+                ))
+            else:
+                columns.append('%35s' % '-')
+        return '%-6s %8d %6d   %s   %s' % (self.level, self.programs, self.failures, columns[0], columns[1])
+
+
+def fuzz(count=100, levels=('1', '2', 's'), seed=0, max_steps=100000, stream=sys.stdout, generator=ProgramGenerator):
+    """
+    Check count random programs at every level, writing failing programs
+    and the statistics to stream. Returns the number of failures.
+    """
+    statistics = [LevelStatistics(level) for level in levels]
+    failures = 0
+    for index in range(count):
+        program_seed = seed + index
+        source = generator(random.Random(program_seed)).generate()
+        try:
+            reference = execute(source, '0', max_steps)
+        except Exception as exc:
+            failures += 1
+            _write_failure(stream, program_seed, '0', source, ['%s: %s' % (exc.__class__.__name__, exc)])
+            continue
+        for level in statistics:
+            level.programs += 1
+            try:
+                result = execute(source, level.level, max_steps)
+            except Exception as exc:
+                found = ['%s: %s' % (exc.__class__.__name__, exc)]
+            else:
+                found = differences(reference[1], result[1])
+                level.add(reference, result)
+            if found:
+                level.failures += 1
+                failures += 1
+                _write_failure(stream, program_seed, level.level, source, found)
+    stream.write('%-6s %8s %6s   %-35s   %-35s\n' % ('level', 'programs', 'failed', 'words', 'cycles'))
+    stream.write('%-6s %8s %6s   %8s %8s %8s %8s   %8s %8s %8s %8s\n' % (
+        '', '', '', 'min', 'median', 'max', 'mean', 'min', 'median', 'max', 'mean'
+    ))
+    for level in statistics:
+        stream.write('%s\n' % level)
+    return failures
+
+def _write_failure(stream, seed, level, source, found):
+    stream.write('seed %d fails at -O%s:\n' % (seed, level))
+    for line in found:
+        stream.write('  %s\n' % line)
+    stream.write(''.join('    %s\n' % line for line in source.splitlines()))
+    stream.write('\n')
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='Check the optimizations against -O0 on random programs.')
+    parser.add_argument('--count', type=int, default=100, help='number of programs (default: 100)')
+    parser.add_argument('--seed', type=int, default=0, help='seed of the first program (default: 0)')
+    parser.add_argument('-O', dest='levels', action='append',
+                        help='optimization level to check, can be repeated (default: 1, 2 and s)')
+    parser.add_argument('--max-steps', type=int, default=100000,
+                        help='instructions a program may run before it counts as hanging (default: 100000)')
+    args = parser.parse_args()
+    failed = fuzz(args.count, args.levels or ('1', '2', 's'), args.seed, args.max_steps)
+    sys.exit(1 if failed else 0)
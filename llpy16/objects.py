@@ -0,0 +1,167 @@
+# -*- coding: utf-8 -*-
+"""
+Relocatable object modules and the linker combining them into a program.
+
+An object module holds the compiled code of one llpy16 module: the code of
+its top level statements (spliced in where the module is imported), its
+labeled sections, the functions it exports and the digests of every source
+file that went into it, so stale objects are detected and recompiled.
+"""
+import hashlib
+import json
+from .assembler import Instruction, Label, section_digest
+from .passes import defined_labels, falls_through, referenced_labels
+
+OBJECT_EXTENSION = '.llo'
+OBJECT_VERSION = 2
+
+
+class LinkError(Exception):
+    def __init__(self, message, modules=()):
+        super(LinkError, self).__init__(message)
+        # names of the object modules that caused the error
+        self.modules = set(modules)
+
+
+def file_digest(path):
+    with open(path, 'rb') as fobj:
+        return hashlib.sha1(fobj.read()).hexdigest()
+
+def dump_item(item):
+    if isinstance(item, Label):
+        return ['label', item.name]
+    args = [arg if isinstance(arg, (int, long)) else str(arg) for arg in item.args]
+    return ['op', item.opcode, args, list(item.source) if item.source else None]
+
+def load_item(data):
+    if data[0] == 'label':
+        return Label(data[1])
+    return Instruction(data[1], tuple(data[2]), tuple(data[3]) if data[3] else None)
+
+
+class ObjectModule(object):
+    def __init__(self, name, body, sections, exports, imports, files):
+        self.name = name
+        self.body = body
+        self.sections = sections
+        self.exports = exports
+        self.imports = imports
+        self.files = files
+
+    @property
+    def definitions(self):
+        return defined_labels([self.body] + self.sections)
+
+    @property
+    def references(self):
+        definitions = set(self.definitions)
+        return sorted(set(
+            label for section in [self.body] + self.sections for item in section
+            for label in referenced_labels(item)
+        ) - definitions)
+
+    def is_current(self):
+        """
+        Whether all source files the object was built from are unchanged.
+        """
+        try:
+            return all(file_digest(path) == digest for path, digest in self.files.items())
+        except (IOError, OSError):
+            return False
+
+    def dump(self, fobj):
+        json.dump({
+            'version': OBJECT_VERSION,
+            'name': self.name,
+            'body': [dump_item(item) for item in self.body],
+            'sections': [[dump_item(item) for item in section] for section in self.sections],
+            'exports': self.exports,
+            'imports': self.imports,
+            'definitions': self.definitions,
+            'references': self.references,
+            'files': self.files,
+        }, fobj, indent=1, sort_keys=True)
+
+    @classmethod
+    def load(cls, fobj):
+        data = json.load(fobj)
+        if data.get('version') != OBJECT_VERSION:
+            raise ValueError('Unsupported object version %r' % data.get('version'))
+        return cls(
+            data['name'],
+            [load_item(item) for item in data['body']],
+            [[load_item(item) for item in section] for section in data['sections']],
+            data['exports'],
+            data['imports'],
+            data['files'],
+        )
+
+
+def load_object(path):
+    """
+    Load the object at path, returns None if it is missing, unreadable or
+    stale.
+    """
+    try:
+        with open(path) as fobj:
+            obj = ObjectModule.load(fobj)
+    except (IOError, OSError, ValueError, KeyError):
+        return None
+    if not obj.is_current():
+        return None
+    return obj
+
+
+def link(assembler, objects):
+    """
+    Append the sections of objects the program in assembler needs. Only
+    sections defining a referenced label (and the sections they fall through
+    into) are linked. Sections defined by several objects (for example code
+    emitted by the same extension) must be identical and are linked once.
+
+    Extensions keep their state per assembler, so an object and the program
+    may generate the same labels (mem.compare, interrupts.handler): labels
+    defined twice raise a LinkError naming the objects defining them.
+    """
+    existing = assembler.section_digests()
+    needed = assembler.references()
+    candidates = [(obj, index) for obj in objects for index in range(len(obj.sections))]
+    linked = set()
+    changed = True
+    while changed:
+        changed = False
+        for obj, index in candidates:
+            if (obj.name, index) in linked:
+                continue
+            section = obj.sections[index]
+            labels = set(defined_labels([section]))
+            if not labels & (needed - set(existing)):
+                continue
+            while True:
+                linked.add((obj.name, index))
+                digest = section_digest(section)
+                duplicates = [label for label in labels if label in existing]
+                if duplicates:
+                    if existing[duplicates[0]] != digest:
+                        raise LinkError('%s: %s is already defined differently' % (obj.name, duplicates[0]),
+                                        [obj.name])
+                else:
+                    assembler.append_section(section)
+                    for label in labels:
+                        existing[label] = digest
+                    for item in section:
+                        needed |= referenced_labels(item)
+                if not falls_through(section) or index + 1 >= len(obj.sections):
+                    break
+                index += 1
+                section = obj.sections[index]
+                labels = set(defined_labels([section]))
+            changed = True
+    missing = needed - set(existing)
+    if missing:
+        raise LinkError('Undefined labels: %s' % ', '.join(sorted(missing)))
+    if assembler.duplicates:
+        labels = sorted(assembler.duplicates)
+        raise LinkError('Labels defined twice: %s' % ', '.join(labels), [
+            obj.name for obj in objects if set(obj.definitions) & assembler.duplicates
+        ])
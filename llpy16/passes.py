@@ -0,0 +1,442 @@
+# -*- coding: utf-8 -*-
+"""
+Optimization passes over the assembled program.
+
+A pass is a function taking the list of sections of an Assembler (see
+Assembler.get_sections) and returning the new list of sections. Passes are
+registered in PASSES and grouped into optimization levels in LEVELS.
+"""
+import heapq
+import sys
+from collections import defaultdict
+from timeit import default_timer
+from .assembler import Assembler, Instruction, Label, IDENTIFIER
+
+REGISTERS = Assembler.registers + ['EX']
+
+OUTLINE_PREFIX = '__outlined_'
+# longest instruction sequence considered for outlining
+MAX_OUTLINE = 32
+# operands whose meaning changes inside a subroutine
+STACK_OPERANDS = set(['PC', 'SP', 'PUSH', 'POP', 'PEEK', 'PICK'])
+# words of a JSR to a label and of the SET PC, POP ending a subroutine
+CALL_WORDS = 2
+RETURN_WORDS = 1
+
+
+class VerificationError(Exception):
+    def __init__(self, name, message):
+        super(VerificationError, self).__init__('Pass %r produced invalid code: %s' % (name, message))
+
+
+def measure(sections):
+    """
+    Returns the size in words and the static cycle count of sections.
+    """
+    words = cycles = 0
+    for section in sections:
+        for item in section:
+            words += item.size
+            cycles += item.cycles
+    return words, cycles
+
+def instructions(section):
+    return [item for item in section if isinstance(item, Instruction)]
+
+def defined_labels(sections):
+    return [item.name for section in sections for item in section if isinstance(item, Label)]
+
+def referenced_labels(item):
+    """
+    Names of the labels referenced by the operands of an instruction.
+    """
+    if not isinstance(item, Instruction):
+        return set()
+    return item.references
+
+def falls_through(section):
+    """
+    Whether execution can run off the end of section into the next one.
+    """
+    items = instructions(section)
+    if not items or all(item.opcode == 'DAT' for item in items):
+        return False
+    if not items[-1].is_terminator:
+        return True
+    return len(items) > 1 and items[-2].is_conditional
+
+def verify(sections):
+    """
+    Raises ValueError if sections are not a well formed program.
+    """
+    if not sections:
+        raise ValueError("program has no sections")
+    seen = set()
+    for label in defined_labels(sections):
+        if label in seen:
+            raise ValueError("label %r defined twice" % label)
+        seen.add(label)
+    for section in sections:
+        for item in section:
+            if not isinstance(item, (Instruction, Label)):
+                raise ValueError("unexpected item %r" % item)
+            missing = referenced_labels(item) - seen
+            if missing:
+                raise ValueError("%r references undefined labels %s" % (str(item), ', '.join(sorted(missing))))
+
+
+def peephole(sections):
+    """
+    Local clean ups: self assignments, push/pop pairs of the same value,
+    jumps to the directly following label and unreachable instructions after
+    unconditional jumps.
+    """
+    return [peephole_section(section) for section in sections]
+
+def peephole_section(section):
+    """
+    peephole for a single section.
+    """
+    changed = True
+    while changed:
+        section, changed = _peephole_section(section)
+    return section
+
+def _peephole_section(section):
+    output = []
+    changed = False
+    index = 0
+    while index < len(section):
+        item = section[index]
+        following = section[index + 1] if index + 1 < len(section) else None
+        previous = output[-1] if output else None
+        guarded = isinstance(previous, Instruction) and previous.is_conditional
+        if isinstance(item, Instruction) and not guarded:
+            args = [str(arg).upper() for arg in item.args]
+            if item.opcode == 'SET' and args[0] == args[1] and args[0] in REGISTERS:
+                changed = True
+                index += 1
+                continue
+            if (item.opcode == 'SET' and args[0] == 'PUSH' and isinstance(following, Instruction) and
+                    following.opcode == 'SET' and str(following.args[1]).upper() == 'POP' and
+                    str(following.args[0]).upper() == args[1] and args[1] in REGISTERS):
+                changed = True
+                index += 2
+                continue
+            if isinstance(following, Label) and item.jump_target == following.name:
+                changed = True
+                index += 1
+                continue
+            if item.is_terminator:
+                output.append(item)
+                index += 1
+                while (index < len(section) and isinstance(section[index], Instruction) and
+                       section[index].opcode != 'DAT'):
+                    changed = True
+                    index += 1
+                continue
+        output.append(item)
+        index += 1
+    return output, changed
+
+def prune(sections):
+    """
+    Removes labeled sections nothing refers to, neither by name nor by
+    falling through into them.
+    """
+    referenced = set()
+    for section in sections:
+        for item in section:
+            referenced |= referenced_labels(item)
+    keep = [True]
+    for previous, section in zip(sections, sections[1:]):
+        labels = set(label.name for label in section if isinstance(label, Label))
+        keep.append(bool(labels & referenced) or (keep[-1] and falls_through(previous)))
+    result = [section for section, kept in zip(sections, keep) if kept]
+    if len(result) != len(sections):
+        # removed sections may have been the only users of other sections
+        return prune(result)
+    return result
+
+
+def basic_blocks(sections):
+    """
+    Splits sections into basic blocks, every label starts a new block.
+    Returns a list of (block, starts_section) pairs.
+    """
+    blocks = []
+    for section in sections:
+        block = []
+        starts_section = True
+        for item in section:
+            if isinstance(item, Label) and instructions(block):
+                blocks.append((block, starts_section))
+                block = []
+                starts_section = False
+            block.append(item)
+        if block:
+            blocks.append((block, starts_section))
+    return blocks
+
+def is_data(block):
+    """
+    Whether block holds DAT words and no code.
+    """
+    items = instructions(block)
+    return bool(items) and all(item.opcode == 'DAT' for item in items)
+
+def _jump(block):
+    """
+    The label block unconditionally jumps to at its end, if any.
+    """
+    items = instructions(block)
+    if not items or (len(items) > 1 and items[-2].is_conditional):
+        return None
+    target = items[-1].jump_target
+    if target is None or target.upper() == 'POP':
+        return None
+    return target
+
+def layout(sections):
+    """
+    Orders basic blocks so that the target of an unconditional jump at the
+    end of a block directly follows it, and removes those jumps.
+
+    Blocks that fall through into the next block (and consecutive data
+    blocks) are kept together as chains. Chains are placed in their original
+    order, each one followed by the chain its last block jumps to, as long as
+    that chain was not placed yet.
+    """
+    chains = []
+    previous = None
+    for block, starts_section in basic_blocks(sections):
+        if previous is not None and (falls_through(previous) or (is_data(previous) and is_data(block))):
+            chains[-1].append((block, starts_section))
+        else:
+            chains.append([(block, True)])
+        previous = block
+    heads = {}
+    for index, chain in enumerate(chains):
+        first = chain[0][0][0]
+        if isinstance(first, Label):
+            heads[first.name] = index
+    placed = set()
+    result = []
+    for index, chain in enumerate(chains):
+        if index in placed:
+            continue
+        placed.add(index)
+        while True:
+            for block, starts_section in chain:
+                if starts_section:
+                    result.append([])
+                result[-1].extend(block)
+            target = _jump(chain[-1][0])
+            following = heads.get(target)
+            if following is None or following in placed:
+                break
+            placed.add(following)
+            chain = chains[following]
+            result[-1].pop()
+    return result
+
+
+def _outlinable(item):
+    if not isinstance(item, Instruction) or item.opcode in ('DAT', 'RFI'):
+        return False
+    for arg in item.args:
+        if not isinstance(arg, (int, long)) and set(IDENTIFIER.findall(str(arg).upper())) & STACK_OPERANDS:
+            return False
+    return True
+
+def _windows(sections):
+    """
+    The occurrences (section index, start) of every outlinable instruction
+    sequence, by the text of the sequence.
+    """
+    windows = defaultdict(list)
+    for section_index, section in enumerate(sections):
+        for start in range(len(section)):
+            if not _outlinable(section[start]):
+                continue
+            if start and isinstance(section[start - 1], Instruction) and section[start - 1].is_conditional:
+                # the test would skip the call instead of the first instruction
+                continue
+            key = ()
+            for item in section[start:start + MAX_OUTLINE]:
+                if not _outlinable(item):
+                    break
+                key += (str(item),)
+                # a test at the end would skip the return
+                if len(key) > 1 and not item.is_conditional:
+                    windows[key].append((section_index, start))
+    return windows
+
+def _select(occurrences, length, claimed):
+    """
+    The occurrences that overlap neither each other nor a claimed
+    (section index, index) instruction.
+    """
+    selected = []
+    for section_index, start in occurrences:
+        if selected and selected[-1][0] == section_index and start < selected[-1][1] + length:
+            continue
+        if any((section_index, index) in claimed for index in range(start, start + length)):
+            continue
+        selected.append((section_index, start))
+    return selected
+
+def _saving(sections, occurrences, length):
+    if len(occurrences) < 2:
+        return 0
+    section_index, start = occurrences[0]
+    words = sum(item.size for item in sections[section_index][start:start + length])
+    count = len(occurrences)
+    return count * words - (count * CALL_WORDS + words + RETURN_WORDS)
+
+def _candidates(sections):
+    """
+    The repeated instruction sequences to outline, as (length, occurrences)
+    pairs that do not overlap. The windows are collected once; the sequence
+    saving the most words is taken first, the others lose the occurrences it
+    claimed and are ranked again (lazily, with a heap).
+    """
+    heap = []
+    for key, occurrences in _windows(sections).items():
+        if len(occurrences) < 2:
+            continue
+        selected = _select(occurrences, len(key), ())
+        saving = _saving(sections, selected, len(key))
+        if saving > 0:
+            heap.append((-saving, -len(key), key, selected))
+    heapq.heapify(heap)
+    claimed = set()
+    candidates = []
+    while heap:
+        _, _, key, occurrences = heapq.heappop(heap)
+        selected = _select(occurrences, len(key), claimed)
+        saving = _saving(sections, selected, len(key))
+        if saving <= 0:
+            continue
+        if heap and (saving, len(key)) < (-heap[0][0], -heap[0][1]):
+            heapq.heappush(heap, (-saving, -len(key), key, selected))
+            continue
+        for section_index, start in selected:
+            claimed.update((section_index, index) for index in range(start, start + len(key)))
+        candidates.append((len(key), selected))
+    return candidates
+
+def outline(sections):
+    """
+    Moves instruction sequences repeated often enough into shared
+    subroutines, replacing every occurrence with a JSR. Trades five cycles
+    per occurrence for (occurrences - 1) * words - 2 * occurrences - 1 words.
+
+    Sequences must not touch the stack or PC (a subroutine runs with its
+    return address pushed), not start directly after a test and not end with
+    a test. The subroutines themselves are not outlined again.
+    """
+    sections = [list(section) for section in sections]
+    taken = set(defined_labels(sections))
+    counter = 0
+    replacements = defaultdict(list)
+    subroutines = []
+    for length, occurrences in _candidates(sections):
+        while '%s%d' % (OUTLINE_PREFIX, counter) in taken:
+            counter += 1
+        label = '%s%d' % (OUTLINE_PREFIX, counter)
+        taken.add(label)
+        section_index, start = occurrences[0]
+        sequence = sections[section_index][start:start + length]
+        subroutines.append([Label(label)] + sequence + [Instruction('SET', ('PC', 'POP'))])
+        for section_index, start in occurrences:
+            replacements[section_index].append((start, length, label))
+    for section_index, changes in replacements.items():
+        section = sections[section_index]
+        for start, length, label in sorted(changes, reverse=True):
+            # the call is located at the first line it replaces
+            section[start:start + length] = [Instruction('JSR', (label,), section[start].source)]
+    return sections + subroutines
+
+
+PASSES = {
+    'peephole': peephole,
+    'prune': prune,
+    'layout': layout,
+    'outline': outline,
+}
+
+# passes that look at one section at a time, by name, with the function
+# running them on a section
+SECTION_PASSES = {
+    'peephole': peephole_section,
+}
+
+LEVELS = {
+    '0': [],
+    '1': ['peephole'],
+    '2': ['peephole', 'prune', 'layout'],
+    's': ['peephole', 'prune', 'outline', 'layout'],
+}
+
+
+class PassReport(object):
+    def __init__(self, name, seconds, before, after):
+        self.name = name
+        self.seconds = seconds
+        self.words_before, self.cycles_before = before
+        self.words_after, self.cycles_after = after
+
+    def __str__(self):
+        return '%-12s %8.2fms %6d words (%+d) %6d cycles (%+d)' % (
+            self.name, self.seconds * 1000,
+            self.words_after, self.words_after - self.words_before,
+            self.cycles_after, self.cycles_after - self.cycles_before,
+        )
+
+
+class PassManager(object):
+    def __init__(self, passes, verify=False):
+        self.passes = [(name, PASSES[name]) for name in passes]
+        self.verify = verify
+        self.reports = []
+
+    @classmethod
+    def for_level(cls, level, verify=False):
+        return cls(LEVELS[str(level)], verify)
+
+    def section_filter(self):
+        """
+        A function running the passes on a single section, for spooling
+        assemblers (see llpy16.assembler.Assembler). None if a pass needs
+        the whole program.
+        """
+        if any(name not in SECTION_PASSES for name, _ in self.passes):
+            return None
+        functions = [SECTION_PASSES[name] for name, _ in self.passes]
+        def run_section(section):
+            for function in functions:
+                section = function(section)
+            return section
+        return run_section
+
+    def run(self, assembler):
+        if not self.passes:
+            return
+        sections = assembler.get_sections()
+        for name, function in self.passes:
+            before = measure(sections)
+            start = default_timer()
+            sections = function(sections)
+            seconds = default_timer() - start
+            if self.verify:
+                try:
+                    verify(sections)
+                except ValueError as exc:
+                    raise VerificationError(name, exc)
+            self.reports.append(PassReport(name, seconds, before, measure(sections)))
+        assembler.set_sections(sections)
+
+    def write_report(self, stream=sys.stderr):
+        for report in self.reports:
+            stream.write('%s\n' % report)
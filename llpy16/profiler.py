@@ -0,0 +1,161 @@
+# -*- coding: utf-8 -*-
+"""
+Runtime profiling instrumentation.
+
+Every function written by the compiler (and optionally every labeled block)
+gets an entry in a DAT region at the end of the program. On entry the call
+counter of the entry is incremented; if the generic clock is used, the
+clock ticks are subtracted from the tick counter on entry and added back on
+exit, which accumulates the ticks spent in the function (including the
+functions it calls). The counters wrap at 16 bits. Function counters
+clobber EX, block counters save it since blocks may be entered by an
+interrupt (before its handler saved EX) or with EX still to be read.
+
+The symbol map written by write_map tells where the region and each entry
+are, so a memory dump of the running program can be turned into a ranked
+profile with:
+
+    python -m llpy16.profiler program.map.json memory.bin
+"""
+import json
+import struct
+import sys
+from .analysis import Analysis
+from .assembler import Instruction, Label
+from .passes import is_data, instructions
+
+# words per entry: calls and ticks
+ENTRY_WORDS = 2
+# HWI messages of the generic clock
+CLOCK_SET_RATE = 0
+CLOCK_GET_TICKS = 1
+
+
+class Profiler(object):
+    region_label = '__profile'
+
+    def __init__(self, clock_rate=1, blocks=False):
+        """
+        clock_rate is the generic clock divider (60 / clock_rate ticks per
+        second), 0 to only count calls. If blocks is set, labeled blocks are
+        counted too.
+        """
+        self.clock_rate = clock_rate
+        self.blocks = blocks
+        self.entries = []
+        self._indices = {}
+
+    def slot(self, name, kind, word):
+        if name not in self._indices:
+            self._indices[name] = len(self.entries)
+            self.entries.append((name, kind))
+        return '[%s + %d]' % (self.region_label, self._indices[name] * ENTRY_WORDS + word)
+
+    def start(self, assembler, context):
+        """
+        Detect the hardware and start the generic clock, at the start of the
+        program.
+        """
+        if not self.clock_rate:
+            return
+        context.find_import('dev.drivers', assembler)
+        with context.namespace('dev.drivers'):
+            context.get_extension('initialize')(assembler, context)
+            self.clock = '[%s]' % context.get_constant('generic_clock')
+        with assembler.preserve('A', 'B'):
+            assembler.SET('A', CLOCK_SET_RATE)
+            assembler.SET('B', self.clock_rate)
+            assembler.HWI(self.clock)
+
+    def _ticks(self, assembler, instruction, slot):
+        with assembler.preserve('A', 'C'):
+            assembler.SET('A', CLOCK_GET_TICKS)
+            assembler.HWI(self.clock)
+            instruction(slot, 'C')
+
+    def enter(self, assembler, name, kind='function'):
+        assembler.ADD(self.slot(name, kind, 0), 1)
+        if self.clock_rate and kind == 'function':
+            self._ticks(assembler, assembler.SUB, self.slot(name, kind, 1))
+
+    def leave(self, assembler, name):
+        if self.clock_rate:
+            self._ticks(assembler, assembler.ADD, self.slot(name, 'function', 1))
+
+    def instrument_blocks(self, assembler):
+        """
+        Count entries into every labeled code block that is not a function,
+        leaving EX alone.
+        """
+        sections = []
+        for section in assembler.get_sections():
+            first = section[0] if section else None
+            if (isinstance(first, Label) and first.name not in self._indices and
+                    first.name != assembler.halt_label and instructions(section) and not is_data(section)):
+                section = [
+                    first,
+                    Instruction('SET', ('PUSH', 'EX')),
+                    Instruction('ADD', (self.slot(first.name, 'block', 0), 1)),
+                    Instruction('SET', ('EX', 'POP')),
+                ] + section[1:]
+            sections.append(section)
+        assembler.set_sections(sections)
+
+    def write_region(self, assembler):
+        with assembler.label(self.region_label):
+            for _ in range(len(self.entries) * ENTRY_WORDS or 1):
+                assembler.write_instruction('DAT', 0)
+
+    def write_map(self, assembler, fobj):
+        analysis = Analysis(assembler.get_sections())
+        json.dump({
+            'region': self.region_label,
+            'address': analysis.addresses.get(self.region_label),
+            'entry_words': ENTRY_WORDS,
+            'clock_rate': self.clock_rate,
+            'entries': [
+                {'name': name, 'kind': kind, 'offset': index * ENTRY_WORDS}
+                for index, (name, kind) in enumerate(self.entries)
+            ],
+        }, fobj, indent=1, sort_keys=True)
+
+
+def read_profile(symbols, dump, little_endian=False):
+    """
+    Read the counters out of dump, a memory image (16 bit words from address
+    0), using the symbol map written by Profiler.write_map. Returns a list of
+    (name, kind, calls, ticks) sorted by ticks and calls, highest first.
+    """
+    start = symbols['address'] * 2
+    size = len(symbols['entries']) * symbols['entry_words']
+    words = struct.unpack('%s%dH' % ('<' if little_endian else '>', size), dump[start:start + size * 2])
+    profile = []
+    for entry in symbols['entries']:
+        calls = words[entry['offset']]
+        ticks = words[entry['offset'] + 1] if entry['kind'] == 'function' and symbols['clock_rate'] else 0
+        profile.append((entry['name'], entry['kind'], calls, ticks))
+    profile.sort(key=lambda row: (row[3], row[2]), reverse=True)
+    return profile
+
+
+def write_profile(profile, stream=sys.stdout):
+    total = sum(row[3] for row in profile) or 1
+    stream.write('%-40s %-8s %8s %8s %10s %6s\n' % ('name', 'kind', 'calls', 'ticks', 'ticks/call', '%'))
+    for name, kind, calls, ticks in profile:
+        stream.write('%-40s %-8s %8d %8d %10.2f %5.1f%%\n' % (
+            name, kind, calls, ticks, float(ticks) / calls if calls else 0, 100.0 * ticks / total
+        ))
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='Show the profile recorded by a program built with --profile.')
+    parser.add_argument('map', help='symbol map written by the compiler')
+    parser.add_argument('dump', help='memory dump of the running program')
+    parser.add_argument('--little-endian', action='store_true', help='words in the dump are little endian')
+    args = parser.parse_args()
+    with open(args.map) as fobj:
+        symbols = json.load(fobj)
+    with open(args.dump, 'rb') as fobj:
+        dump = fobj.read()
+    write_profile(read_profile(symbols, dump, args.little_endian))
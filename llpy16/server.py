@@ -0,0 +1,169 @@
+# -*- coding: utf-8 -*-
+"""
+Resident compiler for interactive development.
+
+A CompileServer keeps extension modules, parsed sources and object modules
+loaded (see llpy16.context.ModuleCache) so only files that changed are
+reloaded. Imported llpy16 modules are compiled into objects once and linked
+into every program using them until they change, modules whose objects
+define labels the program defines too are compiled from source (see
+llpy16.compiler.compile_program). What was loaded for files
+that no compiled source depends on anymore is dropped after every request.
+It answers requests on stdin or a local socket, one JSON object per line:
+
+    {"source": "game.llpy16", "output": "game.dasm", "optimization": "2"}
+
+output and optimization are optional, without output the assembly is
+returned in the response. Responses look like:
+
+    {"ok": true, "source": "game.llpy16", "output": "game.dasm", "seconds": 0.01}
+    {"ok": false, "source": "game.llpy16", "error": "..."}
+
+watch() instead polls a set of sources and recompiles those whose source or
+imported files changed.
+"""
+import json
+import os
+import SocketServer
+import sys
+import time
+from timeit import default_timer
+from . import STDLIB_PATH
+from .compiler import compile_object, compile_program
+from .context import Context, ModuleCache
+
+
+def find_sources(paths):
+    sources = []
+    for path in paths:
+        if not os.path.isdir(path):
+            sources.append(path)
+            continue
+        for directory, _, filenames in os.walk(path):
+            sources.extend(
+                os.path.join(directory, filename) for filename in sorted(filenames) if filename.endswith('.llpy16')
+            )
+    return sources
+
+
+class CompileServer(object):
+    def __init__(self, optimization='1', verify=False):
+        self.optimization = optimization
+        self.verify = verify
+        self.cache = ModuleCache(compile_object)
+        # files every compiled source depends on, by source
+        self.dependencies = {}
+
+    def compile(self, source, output=None, optimization=None):
+        """
+        Compile the file source and return the response for it.
+        """
+        start = default_timer()
+        response = {'source': source}
+        context = Context([STDLIB_PATH, os.path.dirname(source)], cache=self.cache)
+        try:
+            program = self.cache.read(source)
+            try:
+                assembler = compile_program(
+                    program, optimization=optimization or self.optimization, verify=self.verify, context=context,
+                    filename=source
+                )
+            finally:
+                self.dependencies[source] = dict(
+                    (path, os.stat(path).st_mtime) for path in [source] + sorted(context.files)
+                    if os.path.exists(path)
+                )
+                self.forget()
+            if output:
+                with open(output, 'w') as fobj:
+                    assembler.write_assembled(fobj)
+                response['output'] = output
+            else:
+                response['assembly'] = assembler.get_assembled() + '\n'
+        except Exception as exc:
+            response['ok'] = False
+            response['error'] = '%s: %s' % (exc.__class__.__name__, exc)
+        else:
+            response['ok'] = True
+        response['seconds'] = default_timer() - start
+        return response
+
+    def forget(self):
+        """
+        Drop the sources that were removed and everything cached for files no
+        compiled source depends on.
+        """
+        for source in list(self.dependencies):
+            if not os.path.exists(source):
+                del self.dependencies[source]
+        self.cache.forget(set(path for files in self.dependencies.values() for path in files))
+
+    def handle_request(self, line):
+        try:
+            request = json.loads(line)
+            source = request['source']
+        except (ValueError, KeyError, TypeError):
+            return {'ok': False, 'error': 'invalid request %r' % line}
+        return self.compile(source, request.get('output'), request.get('optimization'))
+
+    def serve(self, infile=sys.stdin, outfile=sys.stdout):
+        """
+        Answer requests read from infile until it is closed.
+        """
+        for line in iter(infile.readline, ''):
+            if not line.strip():
+                continue
+            outfile.write(json.dumps(self.handle_request(line)) + '\n')
+            outfile.flush()
+
+    def serve_socket(self, address):
+        """
+        Answer requests on a TCP socket, address is a (host, port) pair. Only
+        bind this to the loopback interface.
+        """
+        server = self
+
+        class Handler(SocketServer.StreamRequestHandler):
+            def handle(self):
+                server.serve(self.rfile, self.wfile)
+
+        class Server(SocketServer.TCPServer):
+            allow_reuse_address = True
+
+        socket_server = Server(address, Handler)
+        try:
+            socket_server.serve_forever()
+        finally:
+            socket_server.server_close()
+
+    def changed(self, source):
+        """
+        Whether source or one of the files it imported changed since it was
+        last compiled.
+        """
+        if source not in self.dependencies:
+            return True
+        for path, mtime in self.dependencies[source].items():
+            try:
+                if os.stat(path).st_mtime != mtime:
+                    return True
+            except OSError:
+                return True
+        return False
+
+    def watch(self, paths, output_for, interval=0.5, log=sys.stderr):
+        """
+        Compile the sources in paths (files or directories searched for
+        .llpy16 files) whenever they or their imports change, writing each to
+        output_for(source). Runs until interrupted.
+        """
+        while True:
+            for source in find_sources(paths):
+                if not self.changed(source):
+                    continue
+                response = self.compile(source, output_for(source))
+                if response['ok']:
+                    log.write('compiled %s -> %s (%.3fs)\n' % (source, response['output'], response['seconds']))
+                else:
+                    log.write('FAILED %s: %s\n' % (source, response['error']))
+            time.sleep(interval)
@@ -0,0 +1,78 @@
+# -*- coding: utf-8 -*-
+"""
+Attribution of the assembled program to the source lines it came from.
+
+Every instruction the compiler writes is tagged with the file and line of
+the statement it was compiled from (see Compiler.located). SourceReport sums
+the words and static cycles (see Instruction.cycles, skipped instructions and
+hardware are not accounted for) per line and per module, so a line that
+expands into a lot of code is easy to find. Instructions without a source,
+for example jumps added by the optimization passes, are counted as
+<generated>. Code outlined by -Os keeps the lines of its first occurrence
+and the calls replacing the others the lines they replace.
+"""
+import json
+import linecache
+from .assembler import Instruction
+
+GENERATED = '<generated>'
+
+
+class SourceReport(object):
+    def __init__(self, sections):
+        # (filename, line) -> [words, cycles]
+        self.lines = {}
+        # filename -> [words, cycles]
+        self.files = {}
+        # [start, size, filename, line], adjacent instructions of a line merged
+        self.ranges = []
+        address = 0
+        for section in sections:
+            for item in section:
+                size = item.size
+                if isinstance(item, Instruction):
+                    filename, line = item.source or (GENERATED, None)
+                    self._count(self.lines, (filename, line), size, item.cycles)
+                    self._count(self.files, filename, size, item.cycles)
+                    last = self.ranges[-1] if self.ranges else None
+                    if last is not None and last[0] + last[1] == address and last[2:] == [filename, line]:
+                        last[1] += size
+                    else:
+                        self.ranges.append([address, size, filename, line])
+                address += size
+        self.size = address
+
+    @staticmethod
+    def _count(totals, key, words, cycles):
+        total = totals.setdefault(key, [0, 0])
+        total[0] += words
+        total[1] += cycles
+
+    def write_report(self, stream, limit=20):
+        """
+        Write the words and cycles per module and of the limit largest lines.
+        """
+        stream.write('%6s %6s %5s  %s\n' % ('words', 'cycles', '%', 'module'))
+        for filename, (words, cycles) in sorted(self.files.items(), key=lambda item: -item[1][0]):
+            stream.write('%6d %6d %4.1f%%  %s\n' % (words, cycles, 100.0 * words / (self.size or 1), filename))
+        stream.write('\n%6s %6s %5s  %s\n' % ('words', 'cycles', '%', 'line'))
+        lines = sorted(self.lines.items(), key=lambda item: (-item[1][0], item[0]))
+        for (filename, line), (words, cycles) in lines[:limit]:
+            if line is None:
+                where = filename
+            else:
+                where = '%s:%d  %s' % (filename, line, linecache.getline(filename, line).strip())
+            stream.write('%6d %6d %4.1f%%  %s\n' % (words, cycles, 100.0 * words / (self.size or 1), where))
+
+    def write_map(self, fobj):
+        """
+        Write the source map: the address ranges of the program and the file
+        and line each was compiled from, as JSON.
+        """
+        json.dump({
+            'size': self.size,
+            'ranges': [
+                {'start': start, 'size': size, 'file': filename, 'line': line}
+                for start, size, filename, line in self.ranges
+            ],
+        }, fobj, indent=1, sort_keys=True)
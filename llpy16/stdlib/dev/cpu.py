@@ -1,12 +1,89 @@
 # -*- coding: utf-8 -*-
+from llpy16.utils import only_once
 
 LLPY16_EXTS = [
-    'interrupt'
+    'interrupt',
+    'install_handler',
+    'hold',
+    'release',
+    'held',
 ]
 
+LLPY16_DATA = [
+    'queue_depth',
+]
+
+# holds in effect, interrupts are queued while it is not 0
+queue_depth = 'queue_depth'
+
 def interrupt(assembler, context, hardware_id, number):
     with assembler.preserve('A'):
         assembler.SET('A', number)
         if isinstance(hardware_id, list):
             hardware_id = '[%s]' % hardware_id[0]
         assembler.HWI(hardware_id)
+
+@only_once
+def _return_from_interrupt(assembler, context):
+    with assembler.label(context.expand_name('return_from_interrupt')):
+        assembler.RFI(0)
+
+def install_handler(assembler, context, handler):
+    """
+    Make the label handler the interrupt handler. Handlers are chained: for
+    messages it does not handle a handler jumps to [<handler>_next], the
+    handler installed before it (or a plain RFI). Clobbers EX.
+    """
+    if isinstance(handler, list):
+        handler = handler[0]
+    _return_from_interrupt(assembler, context)
+    following = '%s_next' % handler
+    with assembler.label(following):
+        assembler.write_instruction('DAT', 0)
+    assembler.IAG('EX')
+    if assembler.IFE('EX', 0):
+        assembler.SET('EX', context.expand_name('return_from_interrupt'))
+    assembler.SET('[%s]' % following, 'EX')
+    assembler.IAS(handler)
+
+@only_once
+def _queue_depth(assembler, context):
+    with assembler.label(context.expand_name(queue_depth)):
+        assembler.write_instruction('DAT', 0)
+
+def hold(assembler, context):
+    """
+    Queue interrupts (IAQ) until the matching release. Holds nest and code
+    called through held counts as one, so a routine can hold and release
+    without knowing whether its caller already queues interrupts. Clobbers
+    EX.
+    """
+    _queue_depth(assembler, context)
+    assembler.IAQ(1)
+    assembler.ADD('[%s]' % context.expand_name(queue_depth), 1)
+
+def release(assembler, context):
+    """
+    End a hold, the outermost one dispatches the queued interrupts. Clobbers
+    EX.
+    """
+    _queue_depth(assembler, context)
+    depth = '[%s]' % context.expand_name(queue_depth)
+    assembler.SUB(depth, 1)
+    if assembler.IFE(depth, 0):
+        assembler.IAQ(0)
+
+def held(assembler, context, function):
+    """
+    Call the label function as if it held interrupts. The DCPU-16 queues
+    interrupts while a handler runs, handlers call what they run through
+    held so that a release in there leaves them queued.
+    """
+    if isinstance(function, list):
+        function = function[0]
+    _queue_depth(assembler, context)
+    depth = '[%s]' % context.expand_name(queue_depth)
+    assembler.push_stack(depth)
+    assembler.SET(depth, 1)
+    assembler.JSR(function)
+    assembler.pop_stack(depth)
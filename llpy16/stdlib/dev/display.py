@@ -1,9 +1,187 @@
 # -*- coding: utf-8 -*-
+"""
+LEM1802 display driver.
+
+write_static writes straight into screen memory. For flicker free redraws
+use double_buffer to set up two video buffers: drawing (put, write, fill,
+clear) goes to the back buffer and flip shows it with a single
+MEM_MAP_SCREEN, then copies the region drawn since the last flip into the
+new back buffer so both buffers stay in sync. Call clear once before the
+first flip so both buffers start out the same.
+
+The drawing routines clobber EX.
+"""
+from llpy16.stdlib.mem import _move, block_loop
+from llpy16.utils import only_once
 
 LLPY16_EXTS = [
     'write_static',
+    'double_buffer',
+    'flip',
+    'put',
+    'write',
+    'fill',
+    'clear',
+]
+
+LLPY16_CONST = [
+    'screen_width',
+    'screen_height',
+    'screen_size',
 ]
 
+screen_width = 32
+screen_height = 12
+screen_size = screen_width * screen_height
+
+# HWI messages of the LEM1802
+MEM_MAP_SCREEN = 0
+# empty dirty region
+DIRTY_START = 0xFFFF
+DIRTY_END = 0
+
+
 def write_static(assembler, context, text, location, color, highlight_color):
     for offset, char in enumerate(text):
         assembler.SET('[%s]' % (location + offset), ord(char) | (color << 12) | (highlight_color << 8))
+
+
+def _monitor(assembler, context):
+    context.find_import('dev.drivers', assembler)
+    with context.namespace('dev.drivers'):
+        context.get_extension('initialize')(assembler, context)
+        return '[%s]' % context.get_constant('display_monitor')
+
+@only_once
+def _runtime(assembler, context):
+    _ = context.expand_name
+    monitor = _monitor(assembler, context)
+    for name, value in [('front', 0), ('back', 0), ('dirty_start', DIRTY_START), ('dirty_end', DIRTY_END)]:
+        with assembler.label(_(name)):
+            assembler.write_instruction('DAT', value)
+
+    # fill C words from I with A
+    with assembler.label(_('fill')):
+        block_loop(assembler, _('fill_loop'), 'STI', '[I]', 'A')
+        assembler.return_from_subroutine()
+
+    with assembler.label(_('flip')):
+        with assembler.preserve('A', 'B', 'C', 'I', 'J'):
+            assembler.SET('A', '[%s]' % _('front'))
+            assembler.SET('B', '[%s]' % _('back'))
+            assembler.SET('[%s]' % _('front'), 'B')
+            assembler.SET('[%s]' % _('back'), 'A')
+            assembler.SET('A', MEM_MAP_SCREEN)
+            assembler.HWI(monitor)
+            # bring the new back buffer up to date with what was drawn
+            if assembler.IFL('[%s]' % _('dirty_start'), '[%s]' % _('dirty_end')):
+                assembler.goto_label(_('flip_copy'))
+            assembler.goto_label(_('flip_copy_loop_end'))
+            assembler.write_label(_('flip_copy'))
+            assembler.SET('I', '[%s]' % _('back'))
+            assembler.ADD('I', '[%s]' % _('dirty_start'))
+            assembler.SET('J', 'B')
+            assembler.ADD('J', '[%s]' % _('dirty_start'))
+            assembler.SET('C', '[%s]' % _('dirty_end'))
+            assembler.SUB('C', '[%s]' % _('dirty_start'))
+            block_loop(assembler, _('flip_copy_loop'), 'STI', '[I]', '[J]')
+            assembler.SET('[%s]' % _('dirty_start'), DIRTY_START)
+            assembler.SET('[%s]' % _('dirty_end'), DIRTY_END)
+        assembler.return_from_subroutine()
+
+def _mark(assembler, context, offset, size):
+    """
+    Add size words from offset to the dirty region, both numbers or
+    registers.
+    """
+    _ = context.expand_name
+    start = '[%s]' % _('dirty_start')
+    end = '[%s]' % _('dirty_end')
+    if assembler.IFG(start, offset):
+        assembler.SET(start, offset)
+    if isinstance(offset, (int, long)) and isinstance(size, (int, long)):
+        if assembler.IFL(end, offset + size):
+            assembler.SET(end, offset + size)
+        return
+    assembler.push_stack(offset)
+    assembler.ADD('PEEK', size)
+    if assembler.IFL(end, 'PEEK'):
+        assembler.SET(end, 'PEEK')
+    assembler.SET('EX', 'POP')
+
+def _scratch(*operands):
+    used = set(str(operand) for operand in operands)
+    return [register for register in ('I', 'J', 'Z') if register not in used][0]
+
+
+def double_buffer(assembler, context, first=0x8000, second=0x8000 + screen_size):
+    """
+    Use the buffers at first (shown) and second (drawn to).
+    """
+    _runtime(assembler, context)
+    _ = context.expand_name
+    assembler.reserve_region('display buffer', first, screen_size)
+    assembler.reserve_region('display buffer', second, screen_size)
+    assembler.SET('[%s]' % _('front'), first)
+    assembler.SET('[%s]' % _('back'), second)
+    with assembler.preserve('A', 'B'):
+        assembler.SET('A', MEM_MAP_SCREEN)
+        assembler.SET('B', first)
+        assembler.HWI(_monitor(assembler, context))
+
+def flip(assembler, context):
+    """
+    Show the back buffer.
+    """
+    assembler.JSR(context.expand_name('flip'))
+
+def put(assembler, context, offset, value):
+    """
+    Set the word at offset (a number or a register) of the back buffer.
+    """
+    scratch = _scratch(offset, value)
+    with assembler.preserve(scratch):
+        assembler.SET(scratch, '[%s]' % context.expand_name('back'))
+        if isinstance(offset, (int, long)):
+            assembler.SET('[%s + %d]' % (scratch, offset), value)
+        else:
+            assembler.ADD(scratch, offset)
+            assembler.SET('[%s]' % scratch, value)
+    _mark(assembler, context, offset, 1)
+
+def write(assembler, context, offset, text, color, highlight_color):
+    """
+    Write text at offset (a number or a register) of the back buffer.
+    """
+    scratch = _scratch(offset)
+    start = offset
+    with assembler.preserve(scratch):
+        assembler.SET(scratch, '[%s]' % context.expand_name('back'))
+        if not isinstance(offset, (int, long)):
+            assembler.ADD(scratch, offset)
+            start = 0
+        for index, char in enumerate(text):
+            assembler.SET('[%s + %d]' % (scratch, start + index), ord(char) | (color << 12) | (highlight_color << 8))
+    _mark(assembler, context, offset, len(text))
+
+def fill(assembler, context, offset, size, value):
+    """
+    Set size words from offset of the back buffer to value. The offset, size
+    and value are numbers or registers.
+    """
+    back = '[%s]' % context.expand_name('back')
+    with assembler.preserve('A', 'C', 'I', 'J'):
+        # as if all at once, the operands may be any of these registers
+        if offset:
+            _move(assembler, [('A', value), ('C', size), ('I', offset)])
+            assembler.ADD('I', back)
+        else:
+            _move(assembler, [('A', value), ('C', size), ('I', back)])
+        assembler.JSR(context.expand_name('fill'))
+    _mark(assembler, context, offset, size)
+
+def clear(assembler, context, color=0):
+    """
+    Clear the back buffer to the background color.
+    """
+    fill(assembler, context, 0, screen_size, color << 8)
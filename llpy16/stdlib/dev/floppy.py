@@ -0,0 +1,448 @@
+# -*- coding: utf-8 -*-
+"""
+M35FD floppy drive driver with a sector cache.
+
+cache sets up cache_slots sector buffers in RAM and installs an interrupt
+handler that completes transfers, so reads and writes never wait for the
+drive. Sectors are used through their buffer address:
+
+    request queues a read of a sector (prefetch) and returns at once,
+    lookup gives the address of a cached sector, or 0 (queueing a read) if
+    it is not in the cache yet,
+    load waits until the sector is cached and gives its address,
+    modified marks a cached sector as changed; changed sectors are written
+    back when their slot is reused or by flush, which waits until every
+    changed sector is on the disk.
+
+load and flush give up after polling the drive WAIT_LIMIT times. Transfers
+are started holding interrupts with dev.cpu.hold, so the driver can be used
+between interrupts.hold and release and from interrupts.handler functions.
+
+The least recently used slot is reused for a new sector. Queued reads are
+started one at a time by the calls into the driver (including busy), so
+an address stays valid until cache_slots - 1 other sectors have been used
+or read since it was last returned. Reads that cannot be started (no
+media) are dropped, sectors that cannot be written stay changed.
+
+The routines clobber EX.
+"""
+from llpy16.utils import only_once
+
+LLPY16_EXTS = [
+    'cache',
+    'request',
+    'lookup',
+    'load',
+    'modified',
+    'flush',
+    'busy',
+]
+
+LLPY16_CONST = [
+    'cache_slots',
+    'sector_size',
+]
+
+cache_slots = 4
+sector_size = 512
+SECTOR_SHIFT = 9
+# must be a power of two, one slot is always kept free
+QUEUE_SIZE = 8
+QUEUE_MASK = QUEUE_SIZE - 1
+# times load and flush poll before giving up
+WAIT_LIMIT = 0xFFFF
+# HWI messages of the M35FD
+POLL_DEVICE = 0
+SET_INTERRUPT = 1
+READ_SECTOR = 2
+WRITE_SECTOR = 3
+STATE_BUSY = 3
+ERROR_NONE = 0
+# interrupt message the drive is configured with
+FLOPPY_MESSAGE = 0x6664
+# sector number of an empty slot
+NO_SECTOR = 0xFFFF
+# states of a slot
+EMPTY = 0
+LOADING = 1
+CLEAN = 2
+DIRTY = 3
+SAVING = 4
+
+
+def _floppy(assembler, context, initialize=False):
+    """
+    The operand addressing the device, detecting the hardware first if
+    initialize is set.
+    """
+    context.find_import('dev.drivers', assembler)
+    with context.namespace('dev.drivers'):
+        if initialize:
+            context.get_extension('initialize')(assembler, context)
+        return '[%s]' % context.get_constant('floppy_drive')
+
+def _data(assembler, name, value, size=1):
+    with assembler.label(name):
+        for _index in range(size):
+            assembler.write_instruction('DAT', value)
+
+def _forget(assembler, context, slot):
+    _ = context.expand_name
+    assembler.SET('[%s + %s]' % (_('sectors'), slot), NO_SECTOR)
+    assembler.SET('[%s + %s]' % (_('states'), slot), EMPTY)
+    assembler.SET('[%s + %s]' % (_('stamps'), slot), 0)
+
+def _dequeue(assembler, context):
+    tail = '[%s]' % context.expand_name('queue_tail')
+    assembler.ADD(tail, 1)
+    assembler.AND(tail, QUEUE_MASK)
+
+def _cpu(assembler, context, name):
+    context.find_import('dev.cpu', assembler)
+    with context.namespace('dev.cpu'):
+        context.get_extension(name)(assembler, context)
+
+def _touch(assembler, context, slot):
+    clock = '[%s]' % context.expand_name('clock')
+    assembler.SET('[%s + %s]' % (context.expand_name('stamps'), slot), clock)
+    assembler.ADD(clock, 1)
+
+@only_once
+def _runtime(assembler, context):
+    _ = context.expand_name
+    floppy = _floppy(assembler, context)
+    sectors = _('sectors')
+    states = _('states')
+    stamps = _('stamps')
+    queue = _('queue')
+    busy = '[%s]' % _('busy')
+
+    _data(assembler, _('buffers'), 0)
+    _data(assembler, sectors, NO_SECTOR, cache_slots)
+    _data(assembler, states, EMPTY, cache_slots)
+    # last use of every slot, empty slots are the oldest
+    _data(assembler, stamps, 0, cache_slots)
+    _data(assembler, _('clock'), 1)
+    _data(assembler, queue, 0, QUEUE_SIZE)
+    for name in ('queue_head', 'queue_tail', 'busy', 'pending', 'pending_kind'):
+        _data(assembler, _(name), 0)
+
+    # A holds the interrupt message and is restored by RFI
+    with assembler.label(_('isr')):
+        if assembler.IFN('A', FLOPPY_MESSAGE):
+            assembler.goto_label('[%s_next]' % _('isr'))
+        with assembler.preserve('B', 'C', 'EX'):
+            assembler.SET('A', POLL_DEVICE)
+            assembler.HWI(floppy)
+            if assembler.IFE('B', STATE_BUSY):
+                assembler.goto_label(_('isr_done'))
+            if assembler.IFE(busy, 0):
+                assembler.goto_label(_('isr_done'))
+            assembler.SET(busy, 0)
+            assembler.SET('B', '[%s]' % _('pending'))
+            if assembler.IFE('[%s]' % _('pending_kind'), WRITE_SECTOR):
+                assembler.goto_label(_('isr_saved'))
+            assembler.SET('[%s + B]' % states, CLEAN)
+            if assembler.IFE('C', ERROR_NONE):
+                assembler.goto_label(_('isr_done'))
+            _forget(assembler, context, 'B')
+            assembler.goto_label(_('isr_done'))
+            assembler.write_label(_('isr_saved'))
+            # a sector changed while it was written stays changed
+            if assembler.IFE('[%s + B]' % states, SAVING):
+                assembler.SET('[%s + B]' % states, CLEAN)
+            if assembler.IFN('C', ERROR_NONE):
+                assembler.SET('[%s + B]' % states, DIRTY)
+            assembler.write_label(_('isr_done'))
+        assembler.RFI(0)
+
+    # slot of sector A in B, NO_SECTOR if it is not cached
+    with assembler.label(_('find')):
+        assembler.SET('B', cache_slots)
+        assembler.write_label(_('find_loop'))
+        if assembler.IFE('B', 0):
+            assembler.goto_label(_('find_none'))
+        assembler.SUB('B', 1)
+        if assembler.IFE('[%s + B]' % sectors, 'A'):
+            assembler.return_from_subroutine()
+        assembler.goto_label(_('find_loop'))
+        assembler.write_label(_('find_none'))
+        assembler.SET('B', NO_SECTOR)
+        assembler.return_from_subroutine()
+
+    # least recently used slot that is not transferring in B
+    with assembler.label(_('victim')):
+        with assembler.preserve('C', 'X'):
+            assembler.SET('B', NO_SECTOR)
+            assembler.SET('X', 0xFFFF)
+            assembler.SET('C', cache_slots)
+            assembler.write_label(_('victim_loop'))
+            if assembler.IFE('C', 0):
+                assembler.goto_label(_('victim_done'))
+            assembler.SUB('C', 1)
+            for state in (LOADING, SAVING):
+                if assembler.IFE('[%s + C]' % states, state):
+                    assembler.goto_label(_('victim_loop'))
+            if assembler.IFG('[%s + C]' % stamps, 'X'):
+                assembler.goto_label(_('victim_loop'))
+            assembler.SET('X', '[%s + C]' % stamps)
+            assembler.SET('B', 'C')
+            assembler.goto_label(_('victim_loop'))
+            assembler.write_label(_('victim_done'))
+        assembler.return_from_subroutine()
+
+    # start the transfer A (READ_SECTOR or WRITE_SECTOR) of slot C, B is 1
+    # if the drive took it
+    with assembler.label(_('transfer')):
+        with assembler.preserve('X', 'Y'):
+            assembler.SET('X', '[%s + C]' % sectors)
+            assembler.SET('Y', 'C')
+            assembler.SHL('Y', SECTOR_SHIFT)
+            assembler.ADD('Y', '[%s]' % _('buffers'))
+            # the transfer must not complete before busy is set
+            _cpu(assembler, context, 'hold')
+            assembler.SET('[%s]' % _('pending'), 'C')
+            assembler.SET('[%s]' % _('pending_kind'), 'A')
+            assembler.HWI(floppy)
+            assembler.SET(busy, 'B')
+            _cpu(assembler, context, 'release')
+        assembler.return_from_subroutine()
+
+    # queue a read of sector A unless it is queued already or the queue is
+    # full, clobbers B
+    with assembler.label(_('enqueue')):
+        with assembler.preserve('C'):
+            assembler.SET('B', '[%s]' % _('queue_tail'))
+            assembler.write_label(_('enqueue_scan'))
+            if assembler.IFE('B', '[%s]' % _('queue_head')):
+                assembler.goto_label(_('enqueue_add'))
+            if assembler.IFE('[%s + B]' % queue, 'A'):
+                assembler.goto_label(_('enqueue_done'))
+            assembler.ADD('B', 1)
+            assembler.AND('B', QUEUE_MASK)
+            assembler.goto_label(_('enqueue_scan'))
+            assembler.write_label(_('enqueue_add'))
+            assembler.SET('C', 'B')
+            assembler.ADD('C', 1)
+            assembler.AND('C', QUEUE_MASK)
+            if assembler.IFE('C', '[%s]' % _('queue_tail')):
+                assembler.goto_label(_('enqueue_done'))
+            assembler.SET('[%s + B]' % queue, 'A')
+            assembler.SET('[%s]' % _('queue_head'), 'C')
+            assembler.write_label(_('enqueue_done'))
+        assembler.return_from_subroutine()
+
+    # start the next queued read if the drive is idle, writing back the
+    # slot it replaces first
+    with assembler.label(_('start')):
+        if assembler.IFN(busy, 0):
+            assembler.return_from_subroutine()
+        with assembler.preserve('A', 'B', 'C'):
+            assembler.write_label(_('start_next'))
+            if assembler.IFE('[%s]' % _('queue_tail'), '[%s]' % _('queue_head')):
+                assembler.goto_label(_('start_done'))
+            assembler.SET('B', '[%s]' % _('queue_tail'))
+            assembler.SET('A', '[%s + B]' % queue)
+            assembler.JSR(_('find'))
+            if assembler.IFN('B', NO_SECTOR):
+                assembler.goto_label(_('start_drop'))
+            assembler.JSR(_('victim'))
+            assembler.SET('C', 'B')
+            if assembler.IFE('[%s + C]' % states, DIRTY):
+                assembler.goto_label(_('start_save'))
+            _dequeue(assembler, context)
+            assembler.SET('[%s + C]' % sectors, 'A')
+            assembler.SET('[%s + C]' % states, LOADING)
+            _touch(assembler, context, 'C')
+            assembler.SET('A', READ_SECTOR)
+            assembler.JSR(_('transfer'))
+            if assembler.IFE('B', 0):
+                _forget(assembler, context, 'C')
+            assembler.goto_label(_('start_done'))
+            # the read stays queued until the write is done
+            assembler.write_label(_('start_save'))
+            assembler.SET('[%s + C]' % states, SAVING)
+            assembler.SET('A', WRITE_SECTOR)
+            assembler.JSR(_('transfer'))
+            if assembler.IFN('B', 0):
+                assembler.goto_label(_('start_done'))
+            assembler.SET('[%s + C]' % states, DIRTY)
+            assembler.write_label(_('start_drop'))
+            _dequeue(assembler, context)
+            assembler.goto_label(_('start_next'))
+            assembler.write_label(_('start_done'))
+        assembler.return_from_subroutine()
+
+    # queue a read of sector A if it is not cached
+    with assembler.label(_('request')):
+        with assembler.preserve('B'):
+            assembler.JSR(_('find'))
+            if assembler.IFE('B', NO_SECTOR):
+                assembler.JSR(_('enqueue'))
+            assembler.JSR(_('start'))
+        assembler.return_from_subroutine()
+
+    # address of the buffer of sector A in A, 0 if it is not cached yet
+    with assembler.label(_('lookup')):
+        with assembler.preserve('B', 'C'):
+            assembler.JSR(_('find'))
+            if assembler.IFE('B', NO_SECTOR):
+                assembler.goto_label(_('lookup_miss'))
+            if assembler.IFE('[%s + B]' % states, LOADING):
+                assembler.goto_label(_('lookup_wait'))
+            _touch(assembler, context, 'B')
+            assembler.SET('A', 'B')
+            assembler.SHL('A', SECTOR_SHIFT)
+            assembler.ADD('A', '[%s]' % _('buffers'))
+            assembler.goto_label(_('lookup_done'))
+            assembler.write_label(_('lookup_miss'))
+            assembler.JSR(_('enqueue'))
+            assembler.write_label(_('lookup_wait'))
+            assembler.JSR(_('start'))
+            assembler.SET('A', 0)
+            assembler.write_label(_('lookup_done'))
+        assembler.return_from_subroutine()
+
+    # lookup until sector A is cached, at most WAIT_LIMIT times
+    with assembler.label(_('load')):
+        with assembler.preserve('B'):
+            assembler.SET('B', WAIT_LIMIT)
+            assembler.push_stack('A')
+            assembler.write_label(_('load_loop'))
+            assembler.SET('A', 'PEEK')
+            assembler.JSR(_('lookup'))
+            if assembler.IFN('A', 0):
+                assembler.goto_label(_('load_done'))
+            assembler.SUB('B', 1)
+            if assembler.IFN('B', 0):
+                assembler.goto_label(_('load_loop'))
+            assembler.write_label(_('load_done'))
+            assembler.ADD('SP', 1)
+        assembler.return_from_subroutine()
+
+    # mark sector A as changed if it is cached
+    with assembler.label(_('modified')):
+        with assembler.preserve('B'):
+            assembler.JSR(_('find'))
+            if assembler.IFE('B', NO_SECTOR):
+                assembler.goto_label(_('modified_done'))
+            if assembler.IFN('[%s + B]' % states, LOADING):
+                assembler.SET('[%s + B]' % states, DIRTY)
+            assembler.write_label(_('modified_done'))
+        assembler.return_from_subroutine()
+
+    # write back every changed slot and wait for the drive, A is 0 if they
+    # were all written
+    with assembler.label(_('flush')):
+        with assembler.preserve('B', 'C', 'X'):
+            assembler.SET('X', WAIT_LIMIT)
+            assembler.write_label(_('flush_loop'))
+            assembler.SUB('X', 1)
+            if assembler.IFE('X', 0):
+                assembler.goto_label(_('flush_failed'))
+            if assembler.IFN(busy, 0):
+                assembler.goto_label(_('flush_loop'))
+            assembler.SET('C', cache_slots)
+            assembler.write_label(_('flush_scan'))
+            if assembler.IFE('C', 0):
+                assembler.goto_label(_('flush_written'))
+            assembler.SUB('C', 1)
+            if assembler.IFN('[%s + C]' % states, DIRTY):
+                assembler.goto_label(_('flush_scan'))
+            assembler.SET('[%s + C]' % states, SAVING)
+            assembler.SET('A', WRITE_SECTOR)
+            assembler.JSR(_('transfer'))
+            if assembler.IFN('B', 0):
+                assembler.goto_label(_('flush_loop'))
+            # no media or write protected, give up
+            assembler.SET('[%s + C]' % states, DIRTY)
+            assembler.write_label(_('flush_failed'))
+            assembler.SET('A', 1)
+            assembler.goto_label(_('flush_done'))
+            assembler.write_label(_('flush_written'))
+            assembler.SET('A', 0)
+            assembler.write_label(_('flush_done'))
+        assembler.return_from_subroutine()
+
+def _call(assembler, context, label, sector, into=None):
+    """
+    Call the routine label with the sector (if any) in A, storing its result
+    (A) in the register into.
+    """
+    _runtime(assembler, context)
+    if isinstance(sector, list):
+        sector = '[%s]' % sector[0]
+    saved = [] if str(into) == 'A' else ['A']
+    with assembler.preserve(*saved):
+        if sector is not None and str(sector) != 'A':
+            assembler.SET('A', sector)
+        assembler.JSR(context.expand_name(label))
+        if into is not None and str(into) != 'A':
+            assembler.SET(into, 'A')
+
+
+def cache(assembler, context, start=0xB000):
+    """
+    Cache sectors in the cache_slots * sector_size words from start.
+    Installs the interrupt handler, see dev.cpu.install_handler.
+    """
+    floppy = _floppy(assembler, context, initialize=True)
+    _runtime(assembler, context)
+    _ = context.expand_name
+    assembler.reserve_region('floppy cache', start, cache_slots * sector_size)
+    assembler.SET('[%s]' % _('buffers'), start)
+    isr = _('isr')
+    context.find_import('dev.cpu', assembler)
+    with context.namespace('dev.cpu'):
+        context.get_extension('install_handler')(assembler, context, isr)
+    with assembler.preserve('A', 'X'):
+        assembler.SET('A', SET_INTERRUPT)
+        assembler.SET('X', FLOPPY_MESSAGE)
+        assembler.HWI(floppy)
+
+def request(assembler, context, sector):
+    """
+    Start reading sector into the cache, without waiting.
+    """
+    _call(assembler, context, 'request', sector)
+
+def lookup(assembler, context, into, sector):
+    """
+    Set the register into to the address of the cached sector, 0 if it is
+    not cached yet (its read is queued).
+    """
+    _call(assembler, context, 'lookup', sector, into)
+
+def load(assembler, context, into, sector):
+    """
+    Set the register into to the address of the cached sector, waiting for
+    the drive if needed. It is 0 if the sector was not cached after
+    WAIT_LIMIT tries (no media).
+    """
+    _call(assembler, context, 'load', sector, into)
+
+def modified(assembler, context, sector):
+    """
+    Mark the cached sector as changed, it is written back later.
+    """
+    _call(assembler, context, 'modified', sector)
+
+def flush(assembler, context, into=None):
+    """
+    Write back all changed sectors, waiting for the drive. The register
+    into, if given, is set to 0 if they were all written and to 1 if the
+    drive did not take a write or did not finish in time.
+    """
+    _call(assembler, context, 'flush', None, into)
+
+def busy(assembler, context, into):
+    """
+    Start the next queued read and set the register into to non zero while
+    reads are queued or the drive is transferring.
+    """
+    _runtime(assembler, context)
+    _ = context.expand_name
+    assembler.JSR(_('start'))
+    assembler.SET(into, '[%s]' % _('queue_head'))
+    assembler.SUB(into, '[%s]' % _('queue_tail'))
+    assembler.BOR(into, '[%s]' % _('busy'))
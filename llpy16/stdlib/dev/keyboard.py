@@ -0,0 +1,133 @@
+# -*- coding: utf-8 -*-
+"""
+Interrupt driven keyboard input.
+
+buffered installs an interrupt handler that drains the keyboard into a ring
+buffer whenever a key is typed, so the program never has to poll the
+device: available tells how many keys are waiting and read takes the next
+one (0 if there is none) without blocking. The handler only writes the head
+and read only writes the tail of the ring, so neither needs to disable
+interrupts. Keys typed while the ring is full are dropped.
+"""
+from llpy16.utils import only_once
+
+LLPY16_EXTS = [
+    'buffered',
+    'available',
+    'read',
+]
+
+LLPY16_CONST = [
+    'buffer_size',
+]
+
+# must be a power of two, one slot is always kept free
+buffer_size = 16
+BUFFER_MASK = buffer_size - 1
+# HWI messages of the generic keyboard
+CLEAR_BUFFER = 0
+GET_NEXT_KEY = 1
+SET_INTERRUPT = 3
+# interrupt message the keyboard is configured with
+KEYBOARD_MESSAGE = 0x6b
+
+
+def _keyboard(assembler, context, initialize=False):
+    """
+    The operand addressing the device, detecting the hardware first if
+    initialize is set.
+    """
+    context.find_import('dev.drivers', assembler)
+    with context.namespace('dev.drivers'):
+        if initialize:
+            context.get_extension('initialize')(assembler, context)
+        return '[%s]' % context.get_constant('generic_keyboard')
+
+@only_once
+def _runtime(assembler, context):
+    _ = context.expand_name
+    keyboard = _keyboard(assembler, context)
+    with assembler.label(_('buffer')):
+        for _index in range(buffer_size):
+            assembler.write_instruction('DAT', 0)
+    for name in ('head', 'tail'):
+        with assembler.label(_(name)):
+            assembler.write_instruction('DAT', 0)
+
+    # A holds the interrupt message and is restored by RFI
+    with assembler.label(_('isr')):
+        if assembler.IFN('A', KEYBOARD_MESSAGE):
+            assembler.goto_label('[%s_next]' % _('isr'))
+        with assembler.preserve('B', 'C', 'EX'):
+            assembler.write_label(_('isr_drain'))
+            assembler.SET('A', GET_NEXT_KEY)
+            assembler.HWI(keyboard)
+            if assembler.IFE('C', 0):
+                assembler.goto_label(_('isr_done'))
+            assembler.SET('B', '[%s]' % _('head'))
+            # the slot at head is always free
+            assembler.SET('[%s + B]' % _('buffer'), 'C')
+            assembler.ADD('B', 1)
+            assembler.AND('B', BUFFER_MASK)
+            if assembler.IFE('B', '[%s]' % _('tail')):
+                # full, drop the key
+                assembler.goto_label(_('isr_drain'))
+            assembler.SET('[%s]' % _('head'), 'B')
+            assembler.goto_label(_('isr_drain'))
+            assembler.write_label(_('isr_done'))
+        assembler.RFI(0)
+
+    # next key in C, 0 if there is none
+    with assembler.label(_('read')):
+        assembler.SET('C', 0)
+        if assembler.IFE('[%s]' % _('tail'), '[%s]' % _('head')):
+            assembler.return_from_subroutine()
+        with assembler.preserve('B'):
+            assembler.SET('B', '[%s]' % _('tail'))
+            assembler.SET('C', '[%s + B]' % _('buffer'))
+            assembler.ADD('B', 1)
+            assembler.AND('B', BUFFER_MASK)
+            assembler.SET('[%s]' % _('tail'), 'B')
+        assembler.return_from_subroutine()
+
+
+def buffered(assembler, context):
+    """
+    Start buffering keys. Installs the interrupt handler, see
+    dev.cpu.install_handler.
+    """
+    keyboard = _keyboard(assembler, context, initialize=True)
+    _runtime(assembler, context)
+    isr = context.expand_name('isr')
+    context.find_import('dev.cpu', assembler)
+    with context.namespace('dev.cpu'):
+        context.get_extension('install_handler')(assembler, context, isr)
+    with assembler.preserve('A', 'B'):
+        assembler.SET('A', CLEAR_BUFFER)
+        assembler.HWI(keyboard)
+        assembler.SET('A', SET_INTERRUPT)
+        assembler.SET('B', KEYBOARD_MESSAGE)
+        assembler.HWI(keyboard)
+
+def available(assembler, context, into):
+    """
+    Set the register into to the number of buffered keys. Clobbers EX.
+    """
+    _runtime(assembler, context)
+    _ = context.expand_name
+    assembler.SET(into, '[%s]' % _('head'))
+    assembler.SUB(into, '[%s]' % _('tail'))
+    assembler.AND(into, BUFFER_MASK)
+
+def read(assembler, context, into):
+    """
+    Take the next key into the register into, 0 if no key is buffered.
+    """
+    _runtime(assembler, context)
+    label = context.expand_name('read')
+    if str(into) == 'C':
+        assembler.JSR(label)
+        return
+    with assembler.preserve('C'):
+        assembler.JSR(label)
+        assembler.SET(into, 'C')
@@ -0,0 +1,323 @@
+# -*- coding: utf-8 -*-
+"""
+32 bit and fixed point arithmetic.
+
+32 bit values are held in a pair of operands, the high word first: registers
+or memory words (written as [address]). Fixed point numbers are 8.8 (one
+word, 0x0100 is 1.0) or 16.16 (a 32 bit pair, the high word is the integer
+part). 16.16 numbers are added, subtracted and shifted with the 32 bit
+operations.
+
+The carry between the words goes through EX (ADX, SBX and the EX result of
+MUL, MLI, DIV, SHL and SHR), so everything here clobbers EX. Cycle counts
+are for register operands, each memory or literal operand that needs the
+next word costs one more; routines (JSR) count the call and return.
+"""
+import math
+from llpy16.stdlib.mem import _registers
+from llpy16.utils import only_once
+
+LLPY16_EXTS = [
+    'add32',
+    'sub32',
+    'neg32',
+    'shl32',
+    'shr32',
+    'asr32',
+    'mul16',
+    'mul32',
+    'div32',
+    'fmul',
+    'fdiv',
+    'fmul16',
+    'sin',
+    'cos',
+]
+
+# the angle of sin and cos is in 1/256 turns
+ANGLES = 256
+FRACTION_BITS = 8
+
+
+def _operand(value):
+    if isinstance(value, list):
+        return '[%s]' % value[0]
+    return value
+
+def _call(assembler, context, label, results, arguments, clobbers):
+    """
+    Call the routine label with arguments, a list of (register, value), and
+    store its results, a list of (register, target). The registers in
+    clobbers, except the targets, are saved around the call.
+    """
+    targets = [str(target) for _, target in results]
+    saved = [register for register in clobbers if register not in targets]
+    with assembler.preserve(*saved):
+        for register, value in arguments:
+            value = _operand(value)
+            if str(value) != register:
+                assembler.push_stack(value)
+        for register, value in reversed(arguments):
+            if str(_operand(value)) != register:
+                assembler.pop_stack(register)
+        assembler.JSR(context.expand_name(label))
+        for register, target in results:
+            target = _operand(target)
+            if str(target) != register:
+                assembler.SET(target, register)
+
+
+def add32(assembler, context, hi, lo, other_hi, other_lo):
+    """
+    (hi, lo) += (other_hi, other_lo). 5 cycles.
+    """
+    assembler.ADD(_operand(lo), _operand(other_lo))
+    assembler.ADX(_operand(hi), _operand(other_hi))
+
+def sub32(assembler, context, hi, lo, other_hi, other_lo):
+    """
+    (hi, lo) -= (other_hi, other_lo). 5 cycles.
+    """
+    assembler.SUB(_operand(lo), _operand(other_lo))
+    assembler.SBX(_operand(hi), _operand(other_hi))
+
+def neg32(assembler, context, hi, lo):
+    """
+    (hi, lo) = -(hi, lo). 6 cycles.
+    """
+    hi, lo = _operand(hi), _operand(lo)
+    assembler.XOR(hi, 0xFFFF)
+    assembler.XOR(lo, 0xFFFF)
+    assembler.ADD(lo, 1)
+    assembler.ADD(hi, 'EX')
+
+def shl32(assembler, context, hi, lo, bits):
+    """
+    (hi, lo) <<= bits, a number. 3 cycles (2 for 16 bits or more).
+    """
+    hi, lo = _operand(hi), _operand(lo)
+    if bits >= 16:
+        assembler.SET(hi, lo)
+        assembler.SET(lo, 0)
+        if bits > 16:
+            assembler.SHL(hi, bits - 16)
+        return
+    assembler.SHL(hi, bits)
+    assembler.SHL(lo, bits)
+    assembler.BOR(hi, 'EX')
+
+def _shr32(assembler, hi, lo, bits, opcode, fill):
+    hi, lo = _operand(hi), _operand(lo)
+    if bits >= 16:
+        assembler.SET(lo, hi)
+        if fill:
+            assembler.write_instruction(opcode, hi, 15)
+        else:
+            assembler.SET(hi, 0)
+        if bits > 16:
+            assembler.write_instruction(opcode, lo, bits - 16)
+        return
+    assembler.SHR(lo, bits)
+    assembler.write_instruction(opcode, hi, bits)
+    assembler.BOR(lo, 'EX')
+
+def shr32(assembler, context, hi, lo, bits):
+    """
+    (hi, lo) >>= bits, a number, unsigned. 3 cycles (2 for 16 bits or more).
+    """
+    _shr32(assembler, hi, lo, bits, 'SHR', False)
+
+def asr32(assembler, context, hi, lo, bits):
+    """
+    (hi, lo) >>= bits, a number, signed. 3 cycles (2 for 16 bits or more).
+    """
+    _shr32(assembler, hi, lo, bits, 'ASR', True)
+
+def mul16(assembler, context, hi, lo, factor, signed=0):
+    """
+    (hi, lo) = lo * factor, the full 32 bit product (signed if signed is
+    set). 3 cycles.
+    """
+    assembler.write_instruction('MLI' if signed else 'MUL', _operand(lo), _operand(factor))
+    assembler.SET(_operand(hi), 'EX')
+
+def mul32(assembler, context, hi, lo, other_hi, other_lo):
+    """
+    (hi, lo) *= (other_hi, other_lo), the low 32 bits of the product.
+    11 cycles, 12 if other_lo is (or is addressed by) hi.
+    """
+    hi, lo, other_hi, other_lo = map(_operand, (hi, lo, other_hi, other_lo))
+    if str(hi) == str(lo):
+        raise ValueError('fixed.mul32 product needs two operands, got %s twice' % hi)
+    # (hi * other_lo + lo * other_hi) << 16 + lo * other_lo
+    assembler.push_stack(lo)
+    assembler.MUL('PEEK', other_hi)
+    if str(hi) == str(other_lo) or str(hi) in _registers(other_lo):
+        # other_lo is read again once hi was written, multiply a copy
+        assembler.push_stack(other_lo)
+        assembler.MUL(hi, 'PEEK')
+        assembler.MUL(lo, 'POP')
+        assembler.ADD(hi, 'EX')
+        assembler.ADD(hi, 'POP')
+        return
+    assembler.MUL(hi, other_lo)
+    assembler.ADD(hi, 'POP')
+    assembler.MUL(lo, other_lo)
+    assembler.ADD(hi, 'EX')
+
+def div32(assembler, context, hi, lo, divisor):
+    """
+    (hi, lo) /= divisor, unsigned, divisor must not be above 0x8000.
+    40 cycles, 42 if the remainders carry.
+    """
+    _routines(assembler, context)
+    _call(assembler, context, 'div32', [('A', hi), ('B', lo)], [('A', hi), ('B', lo), ('C', divisor)],
+          ('A', 'B', 'C'))
+
+def fmul(assembler, context, value, factor):
+    """
+    value *= factor, signed 8.8. 6 cycles.
+    """
+    value = _operand(value)
+    assembler.MLI(value, _operand(factor))
+    assembler.push_stack('EX')
+    assembler.SHL('PEEK', 16 - FRACTION_BITS)
+    assembler.SHR(value, FRACTION_BITS)
+    assembler.BOR(value, 'POP')
+
+def fdiv(assembler, context, value, divisor):
+    """
+    value /= divisor, signed 8.8, rounded towards 0. 20 cycles for
+    positive, up to 26 for negative operands.
+    """
+    _routines(assembler, context)
+    _call(assembler, context, 'fdiv', [('A', value)], [('A', value), ('B', divisor)], ('A', 'B', 'C'))
+
+def fmul16(assembler, context, hi, lo, other_hi, other_lo):
+    """
+    (hi, lo) *= (other_hi, other_lo), signed 16.16. 51 cycles for positive,
+    up to 84 for negative operands.
+    """
+    _routines(assembler, context)
+    _call(assembler, context, 'fmul16', [('A', hi), ('B', lo)],
+          [('A', hi), ('B', lo), ('C', other_hi), ('X', other_lo)], ('A', 'B', 'C', 'X'))
+
+def sin(assembler, context, into, angle):
+    """
+    into = sin(angle) as 8.8, angle in 1/256 turns. 12 cycles, 15 for
+    the second half turn.
+    """
+    _routines(assembler, context)
+    _call(assembler, context, 'sin', [('A', into)], [('A', angle)], ('A',))
+
+def cos(assembler, context, into, angle):
+    """
+    into = cos(angle) as 8.8, angle in 1/256 turns. 15 cycles, 18 for
+    the second half turn.
+    """
+    _routines(assembler, context)
+    _call(assembler, context, 'cos', [('A', into)], [('A', angle)], ('A',))
+
+
+def _negate(assembler, register):
+    assembler.MLI(register, 0xFFFF)
+
+@only_once
+def _routines(assembler, context):
+    _ = context.expand_name
+
+    # (A, B) /= C, long division: the remainder of the high word carries
+    # into the low word through the EX of DIV
+    with assembler.label(_('div32')):
+        with assembler.preserve('X', 'Y'):
+            assembler.SET('X', 'A')
+            assembler.MOD('X', 'C')
+            assembler.DIV('A', 'C')
+            # EX = (remainder << 16) / C
+            assembler.DIV('X', 'C')
+            assembler.SET('Y', 'EX')
+            # X = (remainder << 16) % C
+            assembler.SET('X', 'Y')
+            assembler.MUL('X', 'C')
+            _negate(assembler, 'X')
+            # low word quotient, plus one if the remainders add up to C
+            assembler.push_stack('B')
+            assembler.MOD('PEEK', 'C')
+            assembler.DIV('B', 'C')
+            assembler.ADD('B', 'Y')
+            assembler.ADD('X', 'POP')
+            assembler.SUB('X', 'C')
+            if assembler.IFE('EX', 0):
+                assembler.ADD('B', 1)
+        assembler.return_from_subroutine()
+
+    # A /= B as signed 8.8
+    with assembler.label(_('fdiv')):
+        assembler.SET('C', 'A')
+        assembler.XOR('C', 'B')
+        if assembler.IFU('A', 0):
+            _negate(assembler, 'A')
+        if assembler.IFU('B', 0):
+            _negate(assembler, 'B')
+        assembler.DIV('A', 'B')
+        # EX is the fraction
+        assembler.push_stack('EX')
+        assembler.SHR('PEEK', 16 - FRACTION_BITS)
+        assembler.SHL('A', FRACTION_BITS)
+        assembler.BOR('A', 'POP')
+        if assembler.IFU('C', 0):
+            _negate(assembler, 'A')
+        assembler.return_from_subroutine()
+
+    # (A, B) *= (C, X) as signed 16.16, the middle 32 bits of the product
+    # of the magnitudes
+    with assembler.label(_('fmul16')):
+        with assembler.preserve('Y', 'Z', 'I', 'J'):
+            assembler.SET('I', 'A')
+            assembler.XOR('I', 'C')
+            assembler.push_stack('I')
+            for high, low in (('A', 'B'), ('C', 'X')):
+                if assembler.IFU(high, 0):
+                    assembler.JSR(_('neg32_%s%s' % (high, low)))
+            assembler.SET('Z', 'B')
+            assembler.MUL('Z', 'X')
+            assembler.SET('Z', 'EX')
+            assembler.SET('Y', 0)
+            for first, second in (('A', 'X'), ('B', 'C')):
+                assembler.SET('J', first)
+                assembler.MUL('J', second)
+                assembler.SET('I', 'EX')
+                assembler.ADD('Z', 'J')
+                assembler.ADX('Y', 'I')
+            assembler.MUL('A', 'C')
+            assembler.ADD('Y', 'A')
+            assembler.SET('A', 'Y')
+            assembler.SET('B', 'Z')
+            assembler.pop_stack('I')
+            if assembler.IFU('I', 0):
+                assembler.JSR(_('neg32_AB'))
+        assembler.return_from_subroutine()
+    for high, low in (('A', 'B'), ('C', 'X')):
+        with assembler.label(_('neg32_%s%s' % (high, low))):
+            neg32(assembler, context, high, low)
+            assembler.return_from_subroutine()
+
+    # the first half turn of sin, 8.8
+    with assembler.label(_('sin_table')):
+        for angle in range(ANGLES // 2):
+            value = int(round(math.sin(2 * math.pi * angle / ANGLES) * (1 << FRACTION_BITS)))
+            assembler.write_instruction('DAT', value)
+
+    with assembler.label(_('cos')):
+        assembler.ADD('A', ANGLES // 4)
+        assembler.write_label(_('sin'))
+        if assembler.IFB('A', ANGLES // 2):
+            assembler.goto_label(_('sin_negative'))
+        assembler.AND('A', ANGLES // 2 - 1)
+        assembler.SET('A', '[%s + A]' % _('sin_table'))
+        assembler.return_from_subroutine()
+    with assembler.label(_('sin_negative')):
+        assembler.AND('A', ANGLES // 2 - 1)
+        assembler.SET('A', '[%s + A]' % _('sin_table'))
+        _negate(assembler, 'A')
+        assembler.return_from_subroutine()
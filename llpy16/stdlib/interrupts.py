@@ -0,0 +1,126 @@
+# -*- coding: utf-8 -*-
+"""
+Vectored interrupt dispatch.
+
+Handlers are functions registered for a range of interrupt messages:
+
+    @interrupts.handler(4, 2)
+    def on_device():
+        ...
+
+handler(first[, count]) gives the handler the messages first to
+first + count - 1 (count defaults to 1); the message is in A. The first
+registration installs a dispatcher (see dev.cpu.install_handler) that jumps
+through a table indexed by the message, so the latency is the same however
+many handlers there are. Messages from 0 to vector_size - 1 can be
+registered, others and the ones without a handler go to the handler
+installed before the dispatcher.
+
+Every handler gets an entry that saves only the registers (and EX) the
+handler and the routines it calls change, as found by
+llpy16.analysis.Analysis.clobbers. A is restored by RFI.
+
+Handlers run with interrupts queued. hold and release bracket a critical
+section of the program: interrupts that arrive in between are queued
+(IAQ) and dispatched one after the other by the outermost release, see
+dev.cpu.hold. Handlers are called through dev.cpu.held, so holds in them
+leave interrupts queued.
+"""
+from weakref import WeakKeyDictionary
+from llpy16.analysis import Analysis, REGISTERS
+from llpy16.utils import only_once
+
+LLPY16_EXTS = [
+    'handler',
+    'hold',
+    'release',
+]
+
+LLPY16_CONST = [
+    'vector_size',
+]
+
+vector_size = 32
+
+# (first, count, label) of the registered handlers, by assembler
+_handlers = WeakKeyDictionary()
+
+
+def _handler_label(handler):
+    return handler[0] if isinstance(handler, list) else handler
+
+def _cpu(assembler, context, name, *args):
+    context.find_import('dev.cpu', assembler)
+    with context.namespace('dev.cpu'):
+        context.get_extension(name)(assembler, context, *args)
+
+@only_once
+def _runtime(assembler, context):
+    _ = context.expand_name
+    # the entry for every message, 0 for none
+    with assembler.label(_('table')):
+        for _index in range(vector_size):
+            assembler.write_instruction('DAT', 0)
+
+    with assembler.label(_('dispatch')):
+        if assembler.IFG('A', vector_size - 1):
+            assembler.goto_label(_('chain'))
+        if assembler.IFE('[%s + A]' % _('table'), 0):
+            assembler.goto_label(_('chain'))
+        assembler.goto_label('[%s + A]' % _('table'))
+    with assembler.label(_('chain')):
+        assembler.goto_label('[%s_next]' % _('dispatch'))
+
+def _clobbers(assembler, label):
+    if assembler.spooling:
+        return [register for register in REGISTERS if register != 'A']
+    clobbers = Analysis(assembler.get_sections()).clobbers(label)
+    return [register for register in clobbers if register != 'A']
+
+def _entry(assembler, context, label):
+    """
+    Write the entry of the handler label, returns the entry label.
+    """
+    entry = context.expand_name('entry_%d' % len(_handlers[assembler]))
+    with assembler.label(entry):
+        with assembler.preserve(*_clobbers(assembler, label)):
+            _cpu(assembler, context, 'held', label)
+        assembler.RFI(0)
+    return entry
+
+
+def handler(assembler, context, first, *args):
+    """
+    @interrupts.handler(first[, count]) handles the messages first to
+    first + count - 1.
+    """
+    count, function = args if len(args) == 2 else (1, args[0])
+    label = _handler_label(function)
+    if first < 0 or first + count > vector_size:
+        raise ValueError('interrupts.handler messages %d to %d, only 0 to %d can be vectored' % (
+            first, first + count - 1, vector_size - 1
+        ))
+    for other_first, other_count, other in _handlers.get(assembler, []):
+        if first < other_first + other_count and other_first < first + count:
+            raise ValueError('interrupts.handler messages of %s overlap the ones of %s' % (label, other))
+    _runtime(assembler, context)
+    if assembler not in _handlers:
+        _handlers[assembler] = []
+        _cpu(assembler, context, 'install_handler', context.expand_name('dispatch'))
+    entry = _entry(assembler, context, label)
+    _handlers[assembler].append((first, count, label))
+    for message in range(first, first + count):
+        assembler.SET('[%s + %d]' % (context.expand_name('table'), message), entry)
+
+def hold(assembler, context):
+    """
+    Queue interrupts until release. Clobbers EX.
+    """
+    _cpu(assembler, context, 'hold')
+
+def release(assembler, context):
+    """
+    Dispatch the interrupts queued since hold, unless an outer hold is still
+    in effect. Clobbers EX.
+    """
+    _cpu(assembler, context, 'release')
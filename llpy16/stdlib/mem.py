@@ -1,14 +1,402 @@
 # -*- coding: utf-8 -*-
+"""
+Memory access, block operations and a heap allocator.
+
+copy, fill and compare work on blocks of words. Small blocks with a size
+known at compile time are unrolled into one SET per word (or one STI for
+medium sizes), anything else calls a loop using STI (STD when copying
+backwards), eight words per iteration. Only the registers a routine
+clobbers are saved. copy handles overlapping blocks.
+
+heap declares the memory from start to start + size as the heap. Blocks are
+allocated from size classes (see DEFAULT_CLASSES): every class has its own
+free list, so alloc and free are O(1) unless the free list of a class is
+empty and a new block has to be cut off the untouched rest of the heap.
+Every block has a one word header holding its class, which is how free
+finds the list to put it back on. Allocating from an exhausted heap
+returns 0. So does allocating more than the largest class when the size is
+in a register; a literal size that large is a compile time ValueError. The
+heap routines clobber EX.
+
+heap_statistics writes the internal fragmentation of the allocations with a
+size known at compile time to stderr.
+"""
 import ast
+import sys
+from weakref import WeakKeyDictionary
+from llpy16.assembler import IDENTIFIER
+from llpy16.utils import only_once
 
 LLPY16_EXTS = [
     'set_string',
     'set',
+    'heap',
+    'alloc',
+    'free',
+    'heap_statistics',
+    'copy',
+    'fill',
+    'compare',
 ]
 
+# block sizes in words, without the header
+DEFAULT_CLASSES = (2, 4, 8, 16, 32, 64)
+HEADER_WORDS = 1
+# blocks up to this size are written with one SET per word
+DIRECT_LIMIT = 4
+# blocks up to this size are written with STI inline
+UNROLL_LIMIT = 16
+# words per iteration of the block loops
+UNROLL = 8
+
+# (classes, start, size) of the heap, by assembler
+_heaps = WeakKeyDictionary()
+# requested sizes of the allocations of every class (None if only known at
+# run time), by assembler
+_allocations = WeakKeyDictionary()
+# labels made unique per call site so far, by assembler
+_labels = WeakKeyDictionary()
+
+REGISTERS = ('A', 'B', 'C', 'X', 'Y', 'Z', 'I', 'J')
+
+
 def set_string(assembler, context, start, text, color, highlight_color):
     for offset, char in enumerate(text):
         assembler.SET('[%s]' % (start + offset), ord(char) | (color << 12) | (highlight_color << 8))
 
 def set(assembler, context, location, value):
     assembler.SET('[%s]' % location, value)
+
+
+@only_once
+def _heap_runtime(assembler, context, classes, start, size):
+    _ = context.expand_name
+    with assembler.label(_('heap_top')):
+        assembler.write_instruction('DAT', start)
+    with assembler.label(_('heap_remaining')):
+        assembler.write_instruction('DAT', size)
+    with assembler.label(_('free_lists')):
+        for _class in classes:
+            assembler.write_instruction('DAT', 0)
+
+    with assembler.label(_('alloc_failed')):
+        assembler.SET('A', 0)
+        assembler.return_from_subroutine()
+
+    # a block of class index into A, 0 if the heap is exhausted
+    for index, words in enumerate(classes):
+        head = '[%s + %d]' % (_('free_lists'), index)
+        new_block = _('alloc_%d_new' % index)
+        with assembler.label(_('alloc_%d' % index)):
+            assembler.SET('A', head)
+            if assembler.IFE('A', 0):
+                assembler.goto_label(new_block)
+            assembler.SET(head, '[A]')
+            assembler.return_from_subroutine()
+            assembler.write_label(new_block)
+            if assembler.IFL('[%s]' % _('heap_remaining'), words + HEADER_WORDS):
+                assembler.goto_label(_('alloc_failed'))
+            assembler.SUB('[%s]' % _('heap_remaining'), words + HEADER_WORDS)
+            assembler.SET('A', '[%s]' % _('heap_top'))
+            assembler.ADD('[%s]' % _('heap_top'), words + HEADER_WORDS)
+            assembler.SET('[A]', index)
+            assembler.ADD('A', HEADER_WORDS)
+            assembler.return_from_subroutine()
+
+    # a block of at least A words into A
+    with assembler.label(_('alloc')):
+        for index, words in enumerate(classes):
+            if assembler.IFL('A', words + 1):
+                assembler.goto_label(_('alloc_%d' % index))
+        assembler.goto_label(_('alloc_failed'))
+
+    # put the block at A back on the free list of its class
+    with assembler.label(_('free')):
+        if assembler.IFE('A', 0):
+            assembler.return_from_subroutine()
+        with assembler.preserve('B'):
+            assembler.SET('B', 'A')
+            assembler.SUB('B', HEADER_WORDS)
+            assembler.SET('B', '[B]')
+            assembler.ADD('B', _('free_lists'))
+            assembler.SET('[A]', '[B]')
+            assembler.SET('[B]', 'A')
+        assembler.return_from_subroutine()
+
+def _call(assembler, into, argument, label):
+    """
+    Call label with argument in A and store its result (A) in into.
+    """
+    if str(into) == 'A':
+        if argument is not None:
+            assembler.SET('A', argument)
+        assembler.JSR(label)
+        return
+    with assembler.preserve('A'):
+        if argument is not None:
+            assembler.SET('A', argument)
+        assembler.JSR(label)
+        if into is not None:
+            assembler.SET(into, 'A')
+
+
+def heap(assembler, context, start, size, classes=DEFAULT_CLASSES):
+    """
+    Use size words from start as the heap, allocating blocks of the given
+    sizes (in words, ascending).
+    """
+    if assembler in _heaps:
+        raise ValueError('mem.heap can only be declared once')
+    classes = tuple(classes)
+    if list(classes) != sorted(classes):
+        raise ValueError('mem.heap classes must be ascending, got %r' % (classes,))
+    _heaps[assembler] = (classes, start, size)
+    _allocations[assembler] = dict((index, []) for index in range(len(classes)))
+    assembler.reserve_region('heap', start, size)
+    _heap_runtime(assembler, context, classes, start, size)
+
+def _heap(assembler):
+    try:
+        return _heaps[assembler]
+    except KeyError:
+        raise ValueError('mem.heap must be declared before allocating')
+
+def alloc(assembler, context, into, size):
+    """
+    Allocate a block of size (a number or a register) words and store its
+    address in the register into. The address is 0 if the heap is exhausted
+    or size is a register holding more than the largest class; a larger
+    number raises ValueError.
+    """
+    classes = _heap(assembler)[0]
+    if not isinstance(size, (int, long)):
+        _allocations[assembler].setdefault(None, []).append(None)
+        _call(assembler, into, size, context.expand_name('alloc'))
+        return
+    for index, words in enumerate(classes):
+        if size <= words:
+            # the class is known at compile time, skip the size lookup
+            _allocations[assembler][index].append(size)
+            _call(assembler, into, None, context.expand_name('alloc_%d' % index))
+            return
+    raise ValueError('mem.alloc of %d words, the largest heap class is %d' % (size, classes[-1]))
+
+def free(assembler, context, address):
+    """
+    Free the block at address (a register), which must have been returned by
+    alloc.
+    """
+    _heap(assembler)
+    _call(assembler, None, address, context.expand_name('free'))
+
+def heap_statistics(assembler, context):
+    """
+    Write the words wasted by rounding the allocations up to their class and
+    by the block headers to stderr.
+    """
+    classes, start, size = _heap(assembler)
+    allocations = _allocations[assembler]
+    stream = sys.stderr
+    stream.write('Heap 0x%04x-0x%04x (%d words)\n' % (start, start + size - 1, size))
+    stream.write('  %6s %6s %9s %8s %7s %10s\n' % ('class', 'sites', 'requested', 'occupied', 'waste', 'max blocks'))
+    requested_total = occupied_total = 0
+    for index, words in enumerate(classes):
+        sizes = allocations.get(index, [])
+        requested = sum(sizes)
+        occupied = len(sizes) * (words + HEADER_WORDS)
+        requested_total += requested
+        occupied_total += occupied
+        stream.write('  %6d %6d %9d %8d %6.1f%% %10d\n' % (
+            words, len(sizes), requested, occupied,
+            100.0 * (occupied - requested) / occupied if occupied else 0, size // (words + HEADER_WORDS)
+        ))
+    if occupied_total:
+        stream.write('  internal fragmentation %.1f%% (one block per site)\n' % (
+            100.0 * (occupied_total - requested_total) / occupied_total
+        ))
+    dynamic = len(allocations.get(None, []))
+    if dynamic:
+        stream.write('  %d allocations with a size only known at run time\n' % dynamic)
+
+
+def _registers(operand):
+    return [name for name in IDENTIFIER.findall(str(operand)) if name in REGISTERS]
+
+def _at(address, offset):
+    """
+    The operand addressing the word offset words from address (a number or a
+    register).
+    """
+    if isinstance(address, (int, long)):
+        return '[%d]' % (address + offset)
+    if offset:
+        return '[%s + %d]' % (address, offset)
+    return '[%s]' % address
+
+def _move(assembler, moves):
+    """
+    SET every register to its value as if all at once, moves is a list of
+    (register, value) pairs.
+    """
+    pending = [(register, value) for register, value in moves if str(value) != register]
+    while pending:
+        for index, (register, value) in enumerate(pending):
+            if not any(register in _registers(other) for _, other in pending[:index] + pending[index + 1:]):
+                assembler.SET(register, value)
+                del pending[index]
+                break
+        else:
+            # the values depend on each other, go through the stack
+            for register, value in pending:
+                assembler.push_stack(value)
+            for register, value in reversed(pending):
+                assembler.pop_stack(register)
+            return
+
+def block_loop(assembler, label, opcode, b, a, returns=False):
+    """
+    Run opcode b, a C times, UNROLL at a time, then return from the
+    subroutine if returns is set, otherwise go on at <label>_end. opcode is
+    STI or STD, so this clobbers C, I, J and EX.
+    """
+    tail = label + '_tail'
+    end = label + '_end'
+    assembler.write_label(label)
+    if assembler.IFL('C', UNROLL):
+        assembler.goto_label(tail)
+    for _ in range(UNROLL):
+        assembler.write_instruction(opcode, b, a)
+    assembler.SUB('C', UNROLL)
+    assembler.goto_label(label)
+    assembler.write_label(tail)
+    if assembler.IFE('C', 0):
+        if returns:
+            assembler.return_from_subroutine()
+        else:
+            assembler.goto_label(end)
+    assembler.write_instruction(opcode, b, a)
+    assembler.SUB('C', 1)
+    assembler.goto_label(tail)
+    if not returns:
+        assembler.write_label(end)
+
+@only_once
+def _block_runtime(assembler, context):
+    _ = context.expand_name
+    # copy C words from J to I
+    with assembler.label(_('copy_words')):
+        if assembler.IFG('I', 'J'):
+            assembler.goto_label(_('copy_backward'))
+        block_loop(assembler, _('copy_forward'), 'STI', '[I]', '[J]', returns=True)
+    with assembler.label(_('copy_backward')):
+        if assembler.IFE('C', 0):
+            assembler.return_from_subroutine()
+        assembler.ADD('I', 'C')
+        assembler.SUB('I', 1)
+        assembler.ADD('J', 'C')
+        assembler.SUB('J', 1)
+        block_loop(assembler, _('copy_backward_loop'), 'STD', '[I]', '[J]', returns=True)
+
+    # set C words from I to A
+    with assembler.label(_('fill_words')):
+        block_loop(assembler, _('fill_loop'), 'STI', '[I]', 'A', returns=True)
+
+    # A is 0 if the C words from I and J are equal, otherwise the difference
+    # of the first words that are not
+    with assembler.label(_('compare_words')):
+        assembler.SET('A', 0)
+        assembler.write_label(_('compare_loop'))
+        if assembler.IFE('C', 0):
+            assembler.return_from_subroutine()
+        assembler.SET('A', '[I]')
+        assembler.SUB('A', '[J]')
+        if assembler.IFN('A', 0):
+            assembler.return_from_subroutine()
+        # A is 0 here, STI only advances I and J
+        assembler.STI('A', 'A')
+        assembler.SUB('C', 1)
+        assembler.goto_label(_('compare_loop'))
+
+def _call_block(assembler, context, label, moves, clobbers, into=None):
+    _block_runtime(assembler, context)
+    saved = [register for register in clobbers if register != str(into)]
+    with assembler.preserve(*saved):
+        _move(assembler, moves)
+        assembler.JSR(context.expand_name(label))
+        if into is not None and str(into) != 'A':
+            assembler.SET(into, 'A')
+
+def _unique_label(assembler, context, name):
+    _labels[assembler] = index = _labels.get(assembler, 0) + 1
+    return context.expand_name('%s_%d' % (name, index))
+
+
+def copy(assembler, context, destination, source, size):
+    """
+    Copy size words from source to destination. The addresses and size are
+    numbers or registers. Clobbers EX.
+    """
+    constant = all(isinstance(value, (int, long)) for value in (destination, source, size))
+    if constant and size <= UNROLL_LIMIT:
+        # copy backwards if the end of source would be overwritten first
+        offsets = range(size)
+        if source < destination < source + size:
+            offsets.reverse()
+        if size <= DIRECT_LIMIT:
+            for offset in offsets:
+                assembler.SET(_at(destination, offset), _at(source, offset))
+            return
+        opcode, last = ('STD', size - 1) if offsets[0] else ('STI', 0)
+        with assembler.preserve('I', 'J'):
+            assembler.SET('I', destination + last)
+            assembler.SET('J', source + last)
+            for offset in offsets:
+                assembler.write_instruction(opcode, '[I]', '[J]')
+        return
+    if size == 1:
+        assembler.SET(_at(destination, 0), _at(source, 0))
+        return
+    _call_block(assembler, context, 'copy_words', [('I', destination), ('J', source), ('C', size)], 'IJC')
+
+def fill(assembler, context, destination, value, size):
+    """
+    Set size words from destination to value. The address, value and size
+    are numbers or registers. Clobbers EX.
+    """
+    if isinstance(size, (int, long)) and size <= DIRECT_LIMIT:
+        for offset in range(size):
+            assembler.SET(_at(destination, offset), value)
+        return
+    if isinstance(size, (int, long)) and size <= UNROLL_LIMIT and \
+            not any(register in ('I', 'J') for register in _registers(value)):
+        # STI advances J too
+        with assembler.preserve('I', 'J'):
+            assembler.SET('I', destination)
+            for offset in range(size):
+                assembler.STI('[I]', value)
+        return
+    _call_block(assembler, context, 'fill_words', [('I', destination), ('A', value), ('C', size)], 'AIJC')
+
+def compare(assembler, context, into, first, second, size):
+    """
+    Compare size words at first and second: into is set to 0 if they are
+    equal, otherwise to the difference of the first words that are not.
+    The addresses and size are numbers or registers. Clobbers EX.
+    """
+    operands = _registers(first) + _registers(second)
+    if isinstance(size, (int, long)) and size <= DIRECT_LIMIT and str(into) not in operands:
+        if not size:
+            assembler.SET(into, 0)
+            return
+        done = _unique_label(assembler, context, 'compare_done')
+        for offset in range(size):
+            assembler.SET(into, _at(first, offset))
+            assembler.SUB(into, _at(second, offset))
+            if offset < size - 1:
+                if assembler.IFN(into, 0):
+                    assembler.goto_label(done)
+        assembler.write_label(done)
+        return
+    _call_block(
+        assembler, context, 'compare_words', [('I', first), ('J', second), ('C', size)], 'AIJC', into
+    )
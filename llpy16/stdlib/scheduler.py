@@ -0,0 +1,144 @@
+# -*- coding: utf-8 -*-
+"""
+Clock driven cooperative task scheduler.
+
+Tasks are functions registered with a decorator:
+
+    @scheduler.every(6)
+    def poll_input():
+        ...
+
+    @scheduler.idle
+    def background():
+        ...
+
+    scheduler.run()
+
+run starts the generic clock, whose interrupt handler only counts ticks,
+and never returns: it calls the first task (in order of registration) whose
+deadline has passed, moves that deadline on by the task's period and starts
+over. If no task is due the idle function (if any) is called. Deadlines
+advance by whole periods, so a late task is not drifted but run again until
+it caught up.
+
+Every task has its own saved registers: they are restored before and saved
+after each run, so a task finds them the way it left them.
+"""
+from weakref import WeakKeyDictionary
+from llpy16.utils import only_once
+
+LLPY16_EXTS = [
+    'every',
+    'idle',
+    'run',
+]
+
+# HWI messages of the generic clock
+SET_RATE = 0
+SET_INTERRUPT = 2
+# interrupt message the clock is configured with
+CLOCK_MESSAGE = 0x63
+# registers saved per task, in context order
+CONTEXT = ('A', 'B', 'C', 'X', 'Y', 'Z', 'I', 'J')
+
+# (label, period, first deadline) of the tasks, by assembler
+_tasks = WeakKeyDictionary()
+_idle = WeakKeyDictionary()
+
+
+def _task_label(task):
+    return task[0] if isinstance(task, list) else task
+
+@only_once
+def _runtime(assembler, context):
+    _ = context.expand_name
+    with assembler.label(_('ticks')):
+        assembler.write_instruction('DAT', 0)
+
+    with assembler.label(_('isr')):
+        if assembler.IFN('A', CLOCK_MESSAGE):
+            assembler.goto_label('[%s_next]' % _('isr'))
+        with assembler.preserve('EX'):
+            assembler.ADD('[%s]' % _('ticks'), 1)
+        assembler.RFI(0)
+
+    # call the task on top of the stack with the context below it
+    with assembler.label(_('call_task')):
+        assembler.SET('J', '[SP + 2]')
+        for index, register in enumerate(CONTEXT):
+            if register != 'J':
+                assembler.SET(register, '[J + %d]' % index)
+        assembler.SET('J', '[J + %d]' % CONTEXT.index('J'))
+        assembler.SET('EX', '[SP + 1]')
+        assembler.JSR('EX')
+        assembler.push_stack('J')
+        assembler.SET('J', '[SP + 3]')
+        for index, register in enumerate(CONTEXT):
+            if register != 'J':
+                assembler.SET('[J + %d]' % index, register)
+        assembler.pop_stack('[J + %d]' % CONTEXT.index('J'))
+        assembler.return_from_subroutine()
+
+
+def every(assembler, context, period, *args):
+    """
+    @scheduler.every(period[, first]) runs the task every period ticks,
+    the first time at tick first (default 0).
+    """
+    first, task = args if len(args) == 2 else (0, args[0])
+    _tasks.setdefault(assembler, []).append((_task_label(task), period, first))
+
+def idle(assembler, context, task):
+    """
+    @scheduler.idle runs the task whenever no other task is due.
+    """
+    _idle[assembler] = _task_label(task)
+
+def run(assembler, context, divider=1):
+    """
+    Start the clock at 60 / divider ticks per second and run the tasks
+    forever.
+    """
+    _runtime(assembler, context)
+    _ = context.expand_name
+    context.find_import('dev.drivers', assembler)
+    with context.namespace('dev.drivers'):
+        context.get_extension('initialize')(assembler, context)
+        clock = '[%s]' % context.get_constant('generic_clock')
+    isr = _('isr')
+    context.find_import('dev.cpu', assembler)
+    with context.namespace('dev.cpu'):
+        context.get_extension('install_handler')(assembler, context, isr)
+    assembler.SET('A', SET_RATE)
+    assembler.SET('B', divider)
+    assembler.HWI(clock)
+    assembler.SET('A', SET_INTERRUPT)
+    assembler.SET('B', CLOCK_MESSAGE)
+    assembler.HWI(clock)
+
+    loop = _('loop')
+    assembler.write_label(loop)
+    for index, (task, period, first) in enumerate(_tasks.get(assembler, [])):
+        due = _('due_%d' % index)
+        saved = _('context_%d' % index)
+        skip = _('skip_%d' % index)
+        with assembler.label(due):
+            assembler.write_instruction('DAT', first)
+        with assembler.label(saved):
+            for _register in CONTEXT:
+                assembler.write_instruction('DAT', 0)
+        # signed difference, so the tick counter may wrap
+        assembler.SET('A', '[%s]' % _('ticks'))
+        assembler.SUB('A', '[%s]' % due)
+        if assembler.IFU('A', 0):
+            assembler.goto_label(skip)
+        assembler.ADD('[%s]' % due, period)
+        assembler.push_stack(saved)
+        assembler.push_stack(task)
+        assembler.JSR(_('call_task'))
+        assembler.ADD('SP', 2)
+        assembler.goto_label(loop)
+        assembler.write_label(skip)
+    if assembler in _idle:
+        assembler.JSR(_idle[assembler])
+    assembler.goto_label(loop)
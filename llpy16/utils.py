@@ -1,14 +1,19 @@
 # -*- coding: utf-8 -*-
 from functools import update_wrapper
+from weakref import WeakKeyDictionary
 
 def only_once(func):
-    func.__called__ = False
-    def wrap(*args, **kwargs):
-        if func.__called__:
+    """
+    Only call the extension func once per assembler, so extension modules can
+    be kept loaded across compilations.
+    """
+    func.__called__ = WeakKeyDictionary()
+    def wrap(assembler, *args, **kwargs):
+        if assembler in func.__called__:
             return
         else:
-            func(*args, **kwargs)
-            func.__called__ = True
+            func(assembler, *args, **kwargs)
+            func.__called__[assembler] = True
     update_wrapper(wrap, func)
     return wrap
 
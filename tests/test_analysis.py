@@ -0,0 +1,95 @@
+# -*- coding: utf-8 -*-
+import unittest
+from llpy16.analysis import REGISTERS, Analysis
+from llpy16.assembler import Instruction, Label
+from llpy16.compiler import compile_program
+
+# a dispatcher jumping through a table, one entry is only written at runtime
+DISPATCH = [
+    [Instruction('SET', ('[table + 1]', 'entry_1')), Instruction('JSR', ('dispatch',)),
+     Instruction('IAS', ('entry_0',)), Label('halt'), Instruction('SET', ('PC', 'halt'))],
+    [Label('dispatch'), Instruction('SET', ('PC', '[table + A]'))],
+    [Label('table'), Instruction('DAT', ('entry_0', 0))],
+    [Label('entry_0'), Instruction('SET', ('PUSH', 'B')), Instruction('SET', ('B', 'POP')),
+     Instruction('RFI', (0,))],
+    [Label('entry_1'), Instruction('JSR', ('deep',)), Instruction('SET', ('PC', 'POP'))],
+    [Label('deep'), Instruction('SET', ('PUSH', 'A')), Instruction('SET', ('PUSH', 'B')),
+     Instruction('SET', ('B', 'POP')), Instruction('SET', ('A', 'POP')), Instruction('SET', ('PC', 'POP'))],
+]
+
+HANDLER = '''import interrupts
+import mem
+
+@interrupts.handler(4)
+def on_bell():
+    mem.set(0x9000, A)
+    B = 1
+    C += 2
+'''
+
+
+def analyze(source):
+    return Analysis(compile_program(source, optimization='0').get_sections())
+
+
+class StackDepthTests(unittest.TestCase):
+    def test_calls_push_their_return_address(self):
+        analysis = analyze('def inner():\n    B = 1\n\ndef outer():\n    inner()\n\nouter()\n')
+        self.assertEqual(analysis.stack_depth('__inner'), 0)
+        self.assertEqual(analysis.stack_depth('__outer'), 1)
+        self.assertEqual(analysis.stack_depth(None), 2)
+
+    def test_recursion_is_unbounded(self):
+        analysis = Analysis([
+            [Instruction('JSR', ('__again',))],
+            [Label('__again'), Instruction('JSR', ('__again',)), Instruction('SET', ('PC', 'POP'))],
+        ])
+        self.assertIsNone(analysis.stack_depth(None))
+        self.assertIsNone(analysis.worst_case_stack())
+        self.assertIn('recursive call to __again', analysis.warnings)
+
+    def test_jump_tables_are_followed(self):
+        analysis = Analysis(DISPATCH)
+        self.assertEqual(analysis.table_targets('[table + A]'), ['entry_0', 'entry_1'])
+        self.assertEqual(analysis.table_targets('[halt + A]'), None)
+        self.assertEqual(analysis.stack_depth('dispatch'), 3)
+        self.assertEqual(analysis.warnings, [])
+
+    def test_worst_case_adds_the_deepest_interrupt(self):
+        analysis = Analysis(DISPATCH)
+        self.assertEqual(analysis.worst_case_stack(), 4 + 2 + 1)
+
+    def test_interrupt_dispatch_is_followed(self):
+        analysis = analyze(HANDLER)
+        self.assertEqual(analysis.table_targets('[interrupts__table + A]'), ['interrupts__entry_0'])
+        # the entry saves B, C and EX and calls the handler through dev.cpu.held
+        self.assertGreaterEqual(analysis.stack_depth('interrupts__dispatch'), 4)
+        self.assertFalse([warning for warning in analysis.warnings if 'interrupts__table' in warning])
+        analysis = analyze(HANDLER + 'def work():\n    B = 2\n\nwork()\n')
+        self.assertEqual(analysis.worst_case_stack(),
+                         analysis.stack_depth(None) + 2 + analysis.stack_depth('interrupts__dispatch'))
+
+
+class ClobberTests(unittest.TestCase):
+    def test_written_registers_and_ex(self):
+        analysis = analyze('def change():\n    B = 1\n    C += 2\n\nchange()\n')
+        self.assertEqual(analysis.clobbers('__change'), ['B', 'C', 'EX'])
+
+    def test_callees_are_included(self):
+        analysis = analyze('def inner():\n    Z = 1\n\ndef outer():\n    X = 1\n    inner()\n\nouter()\n')
+        self.assertEqual(analysis.clobbers('__outer'), ['X', 'Z'])
+
+    def test_hardware_interrupts_change_everything(self):
+        analysis = analyze('import dev.cpu\n\ndef ring():\n    dev.cpu.interrupt(0, 4)\n\nring()\n')
+        self.assertEqual(analysis.clobbers('__ring'), list(REGISTERS))
+
+    def test_handler_entries_save_what_the_handler_changes(self):
+        analysis = analyze(HANDLER)
+        self.assertEqual(analysis.clobbers('__on_bell'), ['B', 'C', 'EX'])
+        # the dispatcher chains to the handler installed before it
+        self.assertEqual(analysis.clobbers('interrupts__dispatch'), list(REGISTERS))
+        self.assertEqual(analysis.clobbers('interrupts__entry_0'), ['B', 'C', 'EX'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,103 @@
+# -*- coding: utf-8 -*-
+import os
+import shutil
+import tempfile
+import unittest
+from StringIO import StringIO
+from llpy16.batch import CACHE_DIRECTORY, compile_batch, read_manifest
+from llpy16.compiler import compile_program
+from llpy16.context import ImportIndex
+from llpy16.objects import OBJECT_EXTENSION
+
+PROGRAMS = {
+    'store.llpy16': 'import mem\n\nmem.set(0x9000, 3)\n',
+    'screen.llpy16': 'import dev.display\n\ndev.display.map_screen(0x8000)\n',
+    'broken.llpy16': 'import missing\n',
+}
+
+
+class BatchTests(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.output = os.path.join(self.directory, 'out')
+        self.jobs = []
+        for name, source in sorted(PROGRAMS.items()):
+            path = os.path.join(self.directory, name)
+            with open(path, 'w') as fobj:
+                fobj.write(source)
+            self.jobs.append((path, None))
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def compile(self, processes=1):
+        return dict((os.path.basename(result.source), result)
+                    for result in compile_batch(self.jobs, self.output, processes))
+
+    def test_outputs_match_single_compiles(self):
+        results = self.compile()
+        self.assertIn('ImportError', results['broken.llpy16'].error)
+        cache = os.path.join(self.output, CACHE_DIRECTORY)
+        for name in ('store.llpy16', 'screen.llpy16'):
+            result = results[name]
+            self.assertEqual(result.error, None)
+            self.assertEqual(result.output, os.path.join(self.output, name.replace('.llpy16', '.dasm')))
+            output = StringIO()
+            compile_program(PROGRAMS[name], [self.directory], object_dir=cache).write_assembled(output)
+            with open(result.output) as fobj:
+                self.assertEqual(fobj.read(), output.getvalue())
+
+    def test_pool_compiles_like_one_process(self):
+        single = self.compile()
+        outputs = {}
+        for name in ('store.llpy16', 'screen.llpy16'):
+            with open(single[name].output) as fobj:
+                outputs[name] = fobj.read()
+        pooled = self.compile(processes=2)
+        for name in outputs:
+            with open(pooled[name].output) as fobj:
+                self.assertEqual(fobj.read(), outputs[name])
+
+    def test_stdlib_objects_are_built_once(self):
+        self.compile()
+        display = os.path.join(self.output, CACHE_DIRECTORY, 'dev', 'display' + OBJECT_EXTENSION)
+        modified = int(os.stat(display).st_mtime) - 10
+        os.utime(display, (modified, modified))
+        self.compile()
+        self.assertEqual(os.stat(display).st_mtime, modified)
+
+    def test_outputs_written_twice_fail(self):
+        source = os.path.join(self.directory, 'store.llpy16')
+        results = list(compile_batch([(source, None), (source, None)], self.output, 1))
+        self.assertEqual([result.error is None for result in results].count(True), 1)
+        self.assertIn('written by another source', [result.error for result in results if result.error][0])
+
+    def test_manifest(self):
+        manifest = os.path.join(self.directory, 'manifest')
+        with open(manifest, 'w') as fobj:
+            fobj.write('# programs\nstore.llpy16 store.out\n\nscreen.llpy16\n')
+        self.assertEqual(read_manifest(manifest), [
+            (os.path.join(self.directory, 'store.llpy16'), os.path.join(self.directory, 'store.out')),
+            (os.path.join(self.directory, 'screen.llpy16'), None),
+        ])
+
+
+class ImportIndexTests(unittest.TestCase):
+    def test_paths_outside_the_roots_are_probed(self):
+        directory = tempfile.mkdtemp()
+        try:
+            for name in ('lib', 'library'):
+                os.makedirs(os.path.join(directory, name))
+                with open(os.path.join(directory, name, 'module.py'), 'w') as fobj:
+                    fobj.write('')
+            index = ImportIndex([os.path.join(directory, 'lib') + os.sep])
+            self.assertTrue(index.exists(os.path.join(directory, 'lib', 'module.py')))
+            self.assertFalse(index.exists(os.path.join(directory, 'lib', 'other.py')))
+            # not below lib although lib is a prefix of the path
+            self.assertTrue(index.exists(os.path.join(directory, 'library', 'module.py')))
+        finally:
+            shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,67 @@
+# -*- coding: utf-8 -*-
+import unittest
+from llpy16.emulator import execute
+from llpy16.passes import LEVELS
+from llpy16.stdlib.dev.display import screen_size
+from llpy16.stdlib.dev.drivers import DISPLAY_MONITOR_ID
+
+FRONT = 0x8000
+BACK = FRONT + screen_size
+
+
+class Monitor(object):
+    """
+    A LEM1802 remembering where its screen memory was mapped.
+    """
+    id = DISPLAY_MONITOR_ID[0] << 16 | DISPLAY_MONITOR_ID[1]
+    version = 0x1802
+    manufacturer = 0x1c6c8b36
+
+    def __init__(self):
+        self.screen = 0
+
+    def interrupt(self, emulator):
+        if emulator.registers['A'] == 0:
+            self.screen = emulator.registers['B']
+
+
+def run(source, optimization='1'):
+    monitor = Monitor()
+    source = 'import dev.display\n\ndev.display.double_buffer()\ndev.display.clear()\n' + source
+    return execute(source, optimization, 100000, [monitor])[1], monitor
+
+
+class DisplayTests(unittest.TestCase):
+    def test_fill_reads_its_operands_at_once(self):
+        # offset, size and value in the registers fill uses itself
+        for level in sorted(LEVELS):
+            for registers in ('ACI', 'CIA', 'IAC', 'JCA'):
+                offset, size, value = registers
+                emulator, _ = run('%s = 10\n%s = 3\n%s = 0x41\ndev.display.fill(%s, %s, %s)\n' % (
+                    offset, size, value, offset, size, value
+                ), level)
+                self.assertEqual(emulator.memory[BACK + 9:BACK + 14], [0, 0x41, 0x41, 0x41, 0], (level, registers))
+                self.assertEqual(
+                    [emulator.registers[register] for register in registers], [10, 3, 0x41], (level, registers)
+                )
+
+    def test_write_at_a_register_offset(self):
+        for offset in ('I', 'X'):
+            emulator, _ = run('%s = 40\ndev.display.write(%s, "hi", 15, 0)\n' % (offset, offset))
+            self.assertEqual(emulator.memory[BACK + 40:BACK + 42], [0xF068, 0xF069], offset)
+            self.assertEqual(emulator.registers[offset], 40)
+
+    def test_flip_shows_the_back_buffer_and_syncs_the_other(self):
+        for level in sorted(LEVELS):
+            emulator, monitor = run('X = 7\ndev.display.put(X, 0x1234)\ndev.display.flip()\n'
+                                    'dev.display.put(2, 0x5678)\n', level)
+            self.assertEqual(monitor.screen, BACK, level)
+            self.assertEqual(emulator.memory[BACK + 7], 0x1234, level)
+            # the drawing since the last flip was copied into the new back buffer
+            self.assertEqual(emulator.memory[FRONT + 7], 0x1234, level)
+            self.assertEqual(emulator.memory[FRONT + 2], 0x5678, level)
+            self.assertEqual(emulator.memory[BACK + 2], 0, level)
+
+
+if __name__ == '__main__':
+    unittest.main()
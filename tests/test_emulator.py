@@ -0,0 +1,40 @@
+# -*- coding: utf-8 -*-
+import unittest
+from llpy16.emulator import execute
+from llpy16.stdlib.dev.drivers import FLOPPY_DRIVE_ID, GENERIC_KEYBOARD_ID
+
+
+class Device(object):
+    def __init__(self, (high, low), version=1, manufacturer=0x1c6c8b36):
+        self.id = high << 16 | low
+        self.version = version
+        self.manufacturer = manufacturer
+        self.interrupts = []
+        self.ticks = 0
+
+    def interrupt(self, emulator):
+        self.interrupts.append(emulator.registers['A'])
+
+    def tick(self, emulator):
+        self.ticks += 1
+
+
+class HardwareTests(unittest.TestCase):
+    def test_drivers_find_the_devices(self):
+        _, emulator = execute('import dev.drivers\ndev.drivers.initialize()\n', '0', 10000,
+                              [Device(FLOPPY_DRIVE_ID), Device(GENERIC_KEYBOARD_ID)])
+        data = lambda name: emulator.memory[emulator.labels['dev__drivers__%s' % name]]
+        self.assertEqual(data('floppy_drive'), 0)
+        self.assertEqual(data('generic_keyboard'), 1)
+        self.assertEqual(data('generic_clock'), 0xFFFF)
+
+    def test_HWI_interrupts_the_device(self):
+        keyboard = Device(GENERIC_KEYBOARD_ID)
+        source = 'import dev.cpu\nimport dev.drivers\ndev.drivers.initialize()\ndev.cpu.interrupt([dev.drivers.generic_keyboard], 3)\n'
+        _, emulator = execute(source, '1', 10000, [Device(FLOPPY_DRIVE_ID), keyboard])
+        self.assertEqual(keyboard.interrupts, [3])
+        self.assertEqual(keyboard.ticks, emulator.steps - 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
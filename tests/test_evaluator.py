@@ -0,0 +1,57 @@
+# -*- coding: utf-8 -*-
+import unittest
+from llpy16.compiler import compile_program
+from llpy16.emulator import differences, execute
+
+FOLDED = '''
+def f(A, B):
+    A += B
+    C = A
+    C <<= 3
+
+def g(X):
+    X *= 300
+    X |= 1
+
+def h(Y):
+    Y -= 7
+    g(Y)
+
+f(0xFFFF, 2)
+h(5)
+'''
+
+
+def opcodes(source, optimization='1'):
+    assembler = compile_program(source, optimization=optimization)
+    return [item.opcode for section in assembler.get_sections() for item in section if hasattr(item, 'opcode')]
+
+
+class FoldingTests(unittest.TestCase):
+    def test_folded_calls_match_O0(self):
+        _, reference = execute(FOLDED, '0', 1000)
+        _, folded = execute(FOLDED, '1', 1000)
+        self.assertEqual(differences(reference, folded), [])
+        self.assertTrue(folded.steps < reference.steps)
+
+    def test_folded_calls_are_not_emitted(self):
+        self.assertNotIn('JSR', opcodes(FOLDED))
+        self.assertIn('JSR', opcodes(FOLDED, '0'))
+
+    def test_EX_is_set_by_the_last_instruction(self):
+        # BOR leaves EX alone, it comes from the MUL before it
+        _, emulator = execute('def g(X):\n    X *= 300\n    X |= 1\n\ng(1000)\n', '1', 1000)
+        self.assertEqual(emulator.registers['X'], (1000 * 300) & 0xFFFF | 1)
+        self.assertEqual(emulator.registers['EX'], (1000 * 300) >> 16)
+
+    def test_impure_calls_are_not_folded(self):
+        source = 'import mem\n\ndef f(A):\n    mem.set(0x9000, A)\n\nf(1)\n'
+        self.assertIn('JSR', opcodes(source))
+
+    def test_register_arguments_are_not_folded(self):
+        source = 'def f(A):\n    A += 1\n\nf(B)\n'
+        self.assertIn('JSR', opcodes(source))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,115 @@
+# -*- coding: utf-8 -*-
+import math
+import random
+import unittest
+from llpy16.emulator import REGISTERS, execute
+
+MASK = 0xFFFF
+EDGES = (0, 1, 2, 0x7FFF, 0x8000, 0x8001, 0xFFFF)
+
+
+def signed(value, bits=16):
+    return value - (1 << bits) if value & (1 << (bits - 1)) else value
+
+def pair(value):
+    value &= 0xFFFFFFFF
+    return value >> 16, value & MASK
+
+def truncated(left, right):
+    quotient = abs(left) // abs(right)
+    return -quotient if (left < 0) != (right < 0) else quotient
+
+
+class FixedTests(unittest.TestCase):
+    def setUp(self):
+        rng = random.Random(42)
+        words = lambda count: [rng.choice(EDGES) if rng.random() < 0.3 else rng.randint(0, MASK) for _ in range(count)]
+        self.words = words
+        self.pairs = [(words(1)[0] << 16 | words(1)[0]) for _ in range(8)]
+
+    def run_fixed(self, call, **registers):
+        source = 'import fixed\n%s%s\n' % (''.join('%s = %d\n' % item for item in sorted(registers.items())), call)
+        result = execute(source, '0', 10000)[1].registers
+        optimized = execute(source, '2', 10000)[1].registers
+        for register in REGISTERS + ('EX',):
+            self.assertEqual(optimized[register], result[register], source)
+        return result
+
+    def check32(self, call, expected, first, second=0):
+        (hi, lo), (other_hi, other_lo) = pair(first), pair(second)
+        registers = self.run_fixed(call, A=hi, B=lo, C=other_hi, X=other_lo, Y=0x1234)
+        self.assertEqual((registers['A'], registers['B']), pair(expected), (call, hex(first), hex(second)))
+        self.assertEqual((registers['C'], registers['X'], registers['Y']), (other_hi, other_lo, 0x1234))
+
+    def test_add_sub_neg(self):
+        for first in self.pairs:
+            for second in self.pairs:
+                self.check32('fixed.add32(A, B, C, X)', first + second, first, second)
+                self.check32('fixed.sub32(A, B, C, X)', first - second, first, second)
+            self.check32('fixed.neg32(A, B)', -first, first)
+
+    def test_shifts(self):
+        for first in self.pairs:
+            for bits in (1, 7, 15, 16, 17, 31):
+                self.check32('fixed.shl32(A, B, %d)' % bits, first << bits, first)
+                self.check32('fixed.shr32(A, B, %d)' % bits, first >> bits, first)
+                self.check32('fixed.asr32(A, B, %d)' % bits, signed(first, 32) >> bits, first)
+
+    def test_mul(self):
+        for first in self.pairs:
+            for second in self.pairs:
+                self.check32('fixed.mul32(A, B, C, X)', first * second, first, second)
+            # the operands alias the product
+            hi, lo = pair(first)
+            registers = self.run_fixed('fixed.mul32(A, B, A, B)', A=hi, B=lo)
+            self.assertEqual((registers['A'], registers['B']), pair(first * first), hex(first))
+            for call, second in (('fixed.mul32(A, B, C, A)', 0x1234 << 16 | hi),
+                                 ('fixed.mul32(A, B, B, C)', lo << 16 | 0x1234)):
+                registers = self.run_fixed(call, A=hi, B=lo, C=0x1234)
+                self.assertEqual((registers['A'], registers['B']), pair(first * second), (call, hex(first)))
+            lo, factor = first & MASK, first >> 16
+            registers = self.run_fixed('fixed.mul16(A, B, C)', B=lo, C=factor)
+            self.assertEqual((registers['A'], registers['B']), pair(lo * factor))
+            registers = self.run_fixed('fixed.mul16(A, B, C, 1)', B=lo, C=factor)
+            self.assertEqual((registers['A'], registers['B']), pair(signed(lo) * signed(factor)))
+
+    def test_mul32_needs_two_operands(self):
+        with self.assertRaises(ValueError):
+            execute('import fixed\nfixed.mul32(A, A, C, X)\n', '0', 10000)
+
+    def test_div32(self):
+        for first in self.pairs:
+            for divisor in (1, 3, 10, 0x1234, 0x7FFF, 0x8000):
+                registers = self.run_fixed('fixed.div32(A, B, C)', A=first >> 16, B=first & MASK, C=divisor)
+                self.assertEqual((registers['A'], registers['B']), pair(first // divisor), (hex(first), divisor))
+                self.assertEqual(registers['C'], divisor)
+
+    def test_fmul_fdiv(self):
+        for value in self.words(12):
+            for other in self.words(12):
+                registers = self.run_fixed('fixed.fmul(A, B)', A=value, B=other)
+                self.assertEqual(registers['A'], (signed(value) * signed(other) >> 8) & MASK)
+                if other:
+                    registers = self.run_fixed('fixed.fdiv(A, B)', A=value, B=other)
+                    expected = truncated(signed(value) << 8, signed(other))
+                    if -0x8000 <= expected <= 0x7FFF:
+                        self.assertEqual(registers['A'], expected & MASK, (hex(value), hex(other)))
+
+    def test_fmul16(self):
+        for first in self.pairs:
+            for second in self.pairs:
+                product = signed(first, 32) * signed(second, 32)
+                expected = truncated(product, 1 << 16)
+                if -0x80000000 <= expected <= 0x7FFFFFFF:
+                    self.check32('fixed.fmul16(A, B, C, X)', expected, first, second)
+
+    def test_sin_cos(self):
+        for angle in range(0, 256, 5):
+            registers = self.run_fixed('fixed.sin(A, B)\nfixed.cos(C, B)', B=angle)
+            turn = 2 * math.pi * angle / 256
+            self.assertTrue(abs(signed(registers['A']) - 256 * math.sin(turn)) <= 1, angle)
+            self.assertTrue(abs(signed(registers['C']) - 256 * math.cos(turn)) <= 1, angle)
+
+
+if __name__ == '__main__':
+    unittest.main()
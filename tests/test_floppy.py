@@ -0,0 +1,159 @@
+# -*- coding: utf-8 -*-
+import unittest
+from llpy16.emulator import execute
+from llpy16.passes import LEVELS
+from llpy16.stdlib.dev.drivers import FLOPPY_DRIVE_ID
+from llpy16.stdlib.dev.floppy import cache_slots, sector_size
+
+BUFFERS = 0xB000
+STATE_NO_MEDIA = 0
+STATE_READY = 1
+STATE_READY_WP = 2
+STATE_BUSY = 3
+ERROR_NONE = 0
+ERROR_BUSY = 1
+ERROR_NO_MEDIA = 2
+ERROR_PROTECTED = 3
+
+
+def sector(number):
+    return [(number * 1000 + index) & 0xFFFF for index in range(sector_size)]
+
+
+class Floppy(object):
+    """
+    An M35FD whose transfers complete (and interrupt) delay ticks after
+    they were started.
+    """
+    id = FLOPPY_DRIVE_ID[0] << 16 | FLOPPY_DRIVE_ID[1]
+    version = 0x000b
+    manufacturer = 0x1eb37e91
+
+    def __init__(self, state=STATE_READY, delay=30):
+        self.state = state
+        self.delay = delay
+        self.error = ERROR_NONE
+        self.message = 0
+        self.disk = {}
+        self.transfer = None
+        self.reads = []
+
+    def interrupt(self, emulator):
+        registers = emulator.registers
+        if registers['A'] == 0:
+            registers['B'] = STATE_BUSY if self.transfer else self.state
+            registers['C'] = self.error
+        elif registers['A'] == 1:
+            self.message = registers['X']
+        elif registers['A'] in (2, 3):
+            writing = registers['A'] == 3
+            if self.transfer:
+                self.error = ERROR_BUSY
+            elif self.state == STATE_NO_MEDIA:
+                self.error = ERROR_NO_MEDIA
+            elif writing and self.state == STATE_READY_WP:
+                self.error = ERROR_PROTECTED
+            else:
+                self.error = ERROR_NONE
+                self.transfer = [self.delay, writing, registers['X'], registers['Y']]
+            registers['B'] = int(self.error == ERROR_NONE)
+            if self.message:
+                emulator.trigger(self.message)
+
+    def tick(self, emulator):
+        if not self.transfer:
+            return
+        self.transfer[0] -= 1
+        if self.transfer[0]:
+            return
+        _, writing, number, address = self.transfer
+        self.transfer = None
+        if writing:
+            self.disk[number] = emulator.memory[address:address + sector_size]
+        else:
+            self.reads.append(number)
+            emulator.memory[address:address + sector_size] = self.disk.get(number, sector(number))
+        if self.message:
+            emulator.trigger(self.message)
+
+
+def run(source, floppy, optimization='1'):
+    source = 'import dev.floppy\nimport mem\n\ndev.floppy.cache()\n' + source
+    return execute(source, optimization, 200000, [floppy])[1]
+
+
+class FloppyCacheTests(unittest.TestCase):
+    def test_load(self):
+        for level in sorted(LEVELS):
+            floppy = Floppy()
+            emulator = run('B = 0x2222\nC = 0x3333\ndev.floppy.load(X, 7)\n', floppy, level)
+            registers = emulator.registers
+            address = registers['X']
+            self.assertTrue(BUFFERS <= address < BUFFERS + cache_slots * sector_size, level)
+            self.assertEqual(emulator.memory[address:address + sector_size], sector(7), level)
+            self.assertEqual((registers['B'], registers['C']), (0x2222, 0x3333), level)
+            self.assertEqual(floppy.reads, [7])
+
+    def test_lookup(self):
+        floppy = Floppy()
+        emulator = run('dev.floppy.lookup(Y, 7)\ndev.floppy.load(X, 7)\ndev.floppy.lookup(Z, 7)\n', floppy)
+        registers = emulator.registers
+        self.assertEqual(registers['Y'], 0)
+        self.assertNotEqual(registers['X'], 0)
+        self.assertEqual(registers['Z'], registers['X'])
+        self.assertEqual(floppy.reads, [7])
+
+    def test_request_prefetches(self):
+        floppy = Floppy()
+        emulator = run('dev.floppy.request(3)\n' + 'I = 1\n' * 40 + 'dev.floppy.lookup(X, 3)\n', floppy)
+        self.assertNotEqual(emulator.registers['X'], 0)
+        self.assertEqual(floppy.reads, [3])
+
+    def test_the_handler_preserves_the_registers(self):
+        for level in sorted(LEVELS):
+            floppy = Floppy()
+            emulator = run('dev.floppy.request(3)\nB = 0x2222\nC = 0x3333\nZ = 1\nZ -= 2\n' + 'I = 1\n' * 40,
+                           floppy, level)
+            registers = emulator.registers
+            self.assertEqual(floppy.reads, [3], level)
+            self.assertEqual((registers['B'], registers['C'], registers['EX']), (0x2222, 0x3333, 0xFFFF), level)
+
+    def test_modified_sectors_are_flushed(self):
+        for level in sorted(LEVELS):
+            floppy = Floppy()
+            emulator = run('dev.floppy.load(X, 3)\nmem.fill(X, 0xABCD, 4)\ndev.floppy.modified(3)\n'
+                           'dev.floppy.load(Y, 4)\ndev.floppy.flush(A)\n', floppy, level)
+            self.assertEqual(emulator.registers['A'], 0, level)
+            self.assertEqual(floppy.disk.keys(), [3], level)
+            self.assertEqual(floppy.disk[3], [0xABCD] * 4 + sector(3)[4:], level)
+
+    def test_evicted_sectors_are_written_back(self):
+        loads = ''.join('dev.floppy.load(Y, %d)\n' % number for number in range(10, 10 + cache_slots))
+        floppy = Floppy()
+        emulator = run('dev.floppy.load(X, 3)\nmem.set(0xB000, 0)\nmem.fill(X, 0xABCD, 2)\ndev.floppy.modified(3)\n'
+                       + loads + 'dev.floppy.lookup(Z, 3)\n', floppy)
+        self.assertEqual(floppy.disk[3][:3], [0xABCD, 0xABCD, sector(3)[2]])
+        self.assertEqual(emulator.registers['Z'], 0)
+
+    def test_write_protected_flush_fails(self):
+        floppy = Floppy(STATE_READY_WP)
+        emulator = run('dev.floppy.load(X, 3)\ndev.floppy.modified(3)\ndev.floppy.flush(A)\n'
+                       'dev.floppy.flush(B)\n', floppy)
+        self.assertEqual((emulator.registers['A'], emulator.registers['B']), (1, 1))
+        self.assertEqual(floppy.disk, {})
+
+    def test_transfers_keep_holds(self):
+        emulator = run('import interrupts\n\ninterrupts.hold()\ndev.floppy.request(3)\n', Floppy())
+        self.assertTrue(emulator.queueing)
+        emulator = run('import interrupts\n\ninterrupts.hold()\ndev.floppy.request(3)\ninterrupts.release()\n',
+                       Floppy())
+        self.assertFalse(emulator.queueing)
+
+    def test_flush_without_changes(self):
+        floppy = Floppy(STATE_READY_WP)
+        emulator = run('dev.floppy.load(X, 3)\ndev.floppy.flush(A)\n', floppy)
+        self.assertEqual(emulator.registers['A'], 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,29 @@
+# -*- coding: utf-8 -*-
+import random
+import unittest
+from StringIO import StringIO
+from llpy16.emulator import differences, execute
+from llpy16.fuzz import ProgramGenerator, fuzz
+
+
+class FuzzTests(unittest.TestCase):
+    def test_levels_match_O0(self):
+        stream = StringIO()
+        self.assertEqual(fuzz(count=20, seed=1000, stream=stream), 0, stream.getvalue())
+
+    def test_passes_change_the_programs(self):
+        sizes = dict((level, 0) for level in '12s')
+        for seed in range(10):
+            source = ProgramGenerator(random.Random(seed)).generate()
+            for level in sizes:
+                sizes[level] += execute(source, level, 100000)[0]
+        self.assertTrue(sizes['1'] > sizes['2'] > sizes['s'], sizes)
+
+    def test_EX_is_compared(self):
+        _, reference = execute('A = 1\nA -= 2\n', '0', 1000)
+        _, other = execute('A = 0xFFFF\n', '0', 1000)
+        self.assertEqual(differences(reference, other), ['EX is 0x0000, expected 0xffff'])
+
+
+if __name__ == '__main__':
+    unittest.main()
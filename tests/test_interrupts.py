@@ -0,0 +1,103 @@
+# -*- coding: utf-8 -*-
+import unittest
+from llpy16.emulator import REGISTERS, execute
+from llpy16.passes import LEVELS
+
+# handlers write the message they got to SEEN + message
+SEEN = 0x9000
+
+HANDLERS = '''import dev.cpu
+import interrupts
+import mem
+
+def helper():
+    Y += 1
+    X = 0x7777
+
+@interrupts.handler(4, 2)
+def on_bell():
+    mem.set(0x9000 + A, A)
+    B = A
+    helper()
+
+@interrupts.handler(8)
+def on_nested():
+    interrupts.hold()
+    interrupts.release()
+    dev.cpu.interrupt(0, 9)
+    mem.set(0x9010, 1)
+
+@interrupts.handler(9)
+def on_after():
+    mem.copy(0x9011, 0x9010, 1)
+
+'''
+
+VALUES = '''A = 0x1111
+B = 0x2222
+C = 0x3333
+X = 0x4444
+Y = 0x5555
+Z = 0x6666
+I = 0x7777
+J = 0x8888
+'''
+
+
+class Doorbell(object):
+    """
+    A device triggering the message in A when it is interrupted.
+    """
+    id = 0x12345678
+    version = 1
+    manufacturer = 0
+
+    def interrupt(self, emulator):
+        emulator.trigger(emulator.registers['A'])
+
+
+def run(source, optimization):
+    return execute(HANDLERS + source, optimization, 100000, [Doorbell()])[1]
+
+
+class DispatchTests(unittest.TestCase):
+    def check_registers(self, emulator, level):
+        for register, value in zip(REGISTERS, range(0x1111, 0x9999, 0x1111)):
+            self.assertEqual(emulator.registers[register], value, (level, register))
+
+    def test_handlers_preserve_the_registers(self):
+        for level in sorted(LEVELS):
+            emulator = run(VALUES + 'dev.cpu.interrupt(0, 4)\ndev.cpu.interrupt(0, 5)\n', level)
+            self.assertEqual(emulator.memory[SEEN + 4:SEEN + 6], [4, 5], level)
+            self.check_registers(emulator, level)
+            self.assertFalse(emulator.queueing)
+
+    def test_unhandled_messages_are_dropped(self):
+        for message in (3, 6, 31, 40):
+            emulator = run(VALUES + 'dev.cpu.interrupt(0, %d)\n' % message, '2')
+            self.assertEqual(emulator.memory[SEEN:SEEN + 32], [0] * 32, message)
+            self.check_registers(emulator, message)
+
+    def test_hold_defers_the_handlers(self):
+        for level in sorted(LEVELS):
+            emulator = run('interrupts.hold()\ndev.cpu.interrupt(0, 4)\nmem.copy(0x9020, 0x9004, 1)\n'
+                           'interrupts.release()\n', level)
+            self.assertEqual(emulator.memory[0x9020], 0, level)
+            self.assertEqual(emulator.memory[SEEN + 4], 4, level)
+
+    def test_nested_holds_defer_the_release(self):
+        emulator = run('interrupts.hold()\ninterrupts.hold()\ndev.cpu.interrupt(0, 4)\ninterrupts.release()\n'
+                       'mem.copy(0x9020, 0x9004, 1)\ninterrupts.release()\n', '1')
+        self.assertEqual(emulator.memory[0x9020], 0)
+        self.assertEqual(emulator.memory[SEEN + 4], 4)
+
+    def test_releases_in_handlers_keep_interrupts_queued(self):
+        for level in sorted(LEVELS):
+            emulator = run('dev.cpu.interrupt(0, 8)\n', level)
+            # on_after only ran once on_nested was done
+            self.assertEqual(emulator.memory[0x9010:0x9012], [1, 1], level)
+            self.assertFalse(emulator.queueing)
+
+
+if __name__ == '__main__':
+    unittest.main()
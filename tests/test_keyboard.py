@@ -0,0 +1,96 @@
+# -*- coding: utf-8 -*-
+import unittest
+from llpy16.emulator import execute
+from llpy16.passes import LEVELS
+from llpy16.stdlib.dev.drivers import GENERIC_KEYBOARD_ID
+from llpy16.stdlib.dev.keyboard import buffer_size
+
+# instructions that leave the registers read by the tests and EX alone, the
+# keys are typed while they run
+FILLER = ''.join('I = %d\n' % index for index in range(80))
+
+
+class Keyboard(object):
+    """
+    A generic keyboard typing keys, at_once of them every few ticks once its
+    interrupts are on, so that they arrive while the program runs.
+    """
+    id = GENERIC_KEYBOARD_ID[0] << 16 | GENERIC_KEYBOARD_ID[1]
+    version = 1
+    manufacturer = 0x1c6c8b36
+
+    def __init__(self, keys, at_once=1, every=12):
+        self.keys = list(keys)
+        self.at_once = at_once
+        self.every = every
+        self.ticks = 0
+        self.buffer = []
+        self.message = 0
+
+    def interrupt(self, emulator):
+        registers = emulator.registers
+        if registers['A'] == 0:
+            self.buffer = []
+        elif registers['A'] == 1:
+            registers['C'] = self.buffer.pop(0) if self.buffer else 0
+        elif registers['A'] == 3:
+            self.message = registers['B']
+
+    def tick(self, emulator):
+        if not self.message:
+            return
+        self.ticks += 1
+        if self.keys and not self.ticks % self.every:
+            self.buffer.extend(self.keys[:self.at_once])
+            del self.keys[:self.at_once]
+            emulator.trigger(self.message)
+
+
+class Doorbell(object):
+    id = 0x12345678
+    version = 1
+    manufacturer = 0
+
+    def interrupt(self, emulator):
+        emulator.trigger(emulator.registers['A'])
+
+
+def run(source, keyboard, optimization='1', prefix=''):
+    source = '%simport dev.keyboard\n\ndev.keyboard.buffered()\n%s' % (prefix, source)
+    return execute(source, optimization, 100000, [Doorbell(), keyboard])[1]
+
+
+class BufferedKeyboardTests(unittest.TestCase):
+    def test_keys_are_read_in_order(self):
+        for level in sorted(LEVELS):
+            for at_once in (1, 2):
+                emulator = run(FILLER + 'dev.keyboard.available(X)\ndev.keyboard.read(A)\ndev.keyboard.read(B)\n'
+                               'dev.keyboard.read(C)\ndev.keyboard.read(Y)\ndev.keyboard.available(Z)\n',
+                               Keyboard([0x61, 0x62, 0x63], at_once), level)
+                registers = emulator.registers
+                self.assertEqual([registers[register] for register in 'XABCYZ'], [3, 0x61, 0x62, 0x63, 0, 0],
+                                 (level, at_once))
+
+    def test_keys_are_dropped_when_full(self):
+        keys = range(1, 2 * buffer_size)
+        emulator = run(FILLER * 2 + 'dev.keyboard.available(X)\ndev.keyboard.read(A)\n', Keyboard(keys, 3))
+        self.assertEqual(emulator.registers['X'], buffer_size - 1)
+        self.assertEqual(emulator.registers['A'], 1)
+
+    def test_the_handler_preserves_the_registers(self):
+        for level in sorted(LEVELS):
+            emulator = run('B = 0x2222\nC = 0x3333\nZ = 1\nZ -= 2\n' + FILLER, Keyboard([0x61] * 5), level)
+            registers = emulator.registers
+            self.assertEqual((registers['B'], registers['C'], registers['EX']), (0x2222, 0x3333, 0xFFFF), level)
+
+    def test_other_messages_are_chained(self):
+        handler = 'import interrupts\nimport mem\n\n@interrupts.handler(4)\ndef on_bell():\n    mem.set(0x9000, A)\n\n'
+        program = FILLER + 'dev.cpu.interrupt(0, 4)\ndev.keyboard.available(X)\n'
+        # the keyboard handler installed after the dispatcher and before it
+        for prefix, source in ((handler, program), ('', handler + program)):
+            emulator = run(source, Keyboard([0x61, 0x62]), prefix=prefix)
+            self.assertEqual((emulator.memory[0x9000], emulator.registers['X']), (4, 2))
+
+
+if __name__ == '__main__':
+    unittest.main()
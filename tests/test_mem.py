@@ -0,0 +1,109 @@
+# -*- coding: utf-8 -*-
+import random
+import unittest
+from llpy16.compiler import compile_program
+from llpy16.emulator import Emulator
+from llpy16.passes import LEVELS
+
+DATA = 0x9000
+SENTINELS = (('X', 0x1111), ('Y', 0x2222), ('Z', 0x3333))
+
+
+def run(source, optimization='1', data=()):
+    """
+    Run source with data loaded at DATA, X, Y and Z set to SENTINELS.
+    """
+    setup = ''.join('%s = 0x%04x\n' % sentinel for sentinel in SENTINELS)
+    assembler = compile_program('import mem\n' + setup + source, optimization=optimization, verify=True)
+    emulator = Emulator(assembler.get_sections())
+    emulator.memory[DATA:DATA + len(data)] = data
+    return emulator.run(100000)
+
+
+class HeapTests(unittest.TestCase):
+    HEAP = 'mem.heap(0xA000, 0x100)\n'
+
+    def test_freed_blocks_are_reused(self):
+        emulator = run(self.HEAP + 'mem.alloc(A, 3)\nmem.alloc(B, 3)\nmem.free(A)\nmem.alloc(C, 4)\nmem.alloc(I, 2)\n')
+        registers = emulator.registers
+        self.assertEqual(registers['A'], 0xA001)
+        self.assertEqual(registers['B'], 0xA006)
+        # same class (4 words) as A
+        self.assertEqual(registers['C'], 0xA001)
+        self.assertEqual(registers['I'], 0xA00B)
+        self.assertEqual([registers[register] for register, _ in SENTINELS], [value for _, value in SENTINELS])
+
+    def test_register_sizes_pick_the_class(self):
+        registers = run(self.HEAP + 'C = 20\nmem.alloc(A, C)\nmem.free(A)\nmem.alloc(B, 32)\n').registers
+        self.assertEqual(registers['A'], registers['B'])
+
+    def test_exhausted_heaps_return_0(self):
+        # two blocks of 16 words and their headers fit
+        registers = run('mem.heap(0xA000, 34)\nmem.alloc(A, 10)\nmem.alloc(B, 16)\nmem.alloc(C, 9)\n').registers
+        self.assertEqual((registers['A'], registers['B'], registers['C']), (0xA001, 0xA012, 0))
+
+    def test_oversize_allocations(self):
+        self.assertEqual(run(self.HEAP + 'C = 65\nmem.alloc(A, C)\n').registers['A'], 0)
+        self.assertRaises(ValueError, run, self.HEAP + 'mem.alloc(A, 65)\n')
+
+    def test_heap_must_be_declared(self):
+        self.assertRaises(ValueError, run, 'mem.alloc(A, 4)\n')
+
+
+class BlockTests(unittest.TestCase):
+    # sizes inlined with SET, inlined with STI and looping
+    SIZES = (0, 1, 3, 4, 5, 12, 16, 17, 23, 40)
+
+    def setUp(self):
+        rng = random.Random(0)
+        self.data = [rng.randint(0, 0xFFFF) for _ in range(128)]
+
+    def check(self, source, expected, registers=()):
+        for level in sorted(LEVELS):
+            emulator = run(source, level, self.data)
+            self.assertEqual(emulator.memory[DATA:DATA + len(self.data)], expected, (source, level))
+            for register, value in registers + SENTINELS:
+                self.assertEqual(emulator.registers[register], value, (source, level, register))
+
+    def test_copy(self):
+        for size in self.SIZES:
+            for destination, source in ((0, 60), (10, 5), (5, 10)):
+                expected = list(self.data)
+                expected[destination:destination + size] = self.data[source:source + size]
+                args = (DATA + destination, DATA + source)
+                self.check('mem.copy(%d, %d, %d)\n' % (args + (size,)), expected)
+                self.check('C = %d\nmem.copy(%d, %d, C)\n' % ((size,) + args), expected, (('C', size),))
+
+    def test_copy_register_addresses(self):
+        expected = list(self.data)
+        expected[20:40] = self.data[0:20]
+        self.check('I = %d\nJ = %d\nmem.copy(I, J, 20)\n' % (DATA + 20, DATA), expected,
+                   (('I', DATA + 20), ('J', DATA)))
+
+    def test_fill(self):
+        for size in self.SIZES:
+            expected = list(self.data)
+            expected[7:7 + size] = [0xBEEF] * size
+            self.check('mem.fill(%d, 0xBEEF, %d)\n' % (DATA + 7, size), expected)
+            self.check('B = 0xBEEF\nC = %d\nmem.fill(%d, B, C)\n' % (size, DATA + 7), expected,
+                       (('B', 0xBEEF), ('C', size)))
+
+    def test_compare(self):
+        for size in self.SIZES:
+            for difference in (None, 0, size // 2, size - 1):
+                data = self.data[:64] + self.data[:64]
+                if difference is not None and 0 <= difference < size:
+                    data[64 + difference] = (data[64 + difference] + 5) & 0xFFFF
+                    result = (data[difference] - data[64 + difference]) & 0xFFFF
+                else:
+                    result = 0
+                for into in ('A', 'B'):
+                    source = 'mem.compare(%s, %d, %d, %d)\n' % (into, DATA, DATA + 64, size)
+                    for level in sorted(LEVELS):
+                        emulator = run(source, level, data)
+                        self.assertEqual(emulator.registers[into], result, (source, level))
+                        self.assertEqual(emulator.memory[DATA:DATA + 128], data)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,155 @@
+# -*- coding: utf-8 -*-
+import os
+import shutil
+import tempfile
+import unittest
+from llpy16.compiler import STDLIB_PATH, build_objects, compile_program
+from llpy16.context import Context
+from llpy16.emulator import Emulator, differences
+from llpy16.objects import OBJECT_EXTENSION, LinkError, link, load_object
+
+LIBRARY = '''import mem
+
+def scale(A, B):
+    A *= B
+    A += 1
+
+def store(A):
+    scale(A, 3)
+    mem.set(0x9000, A)
+
+def unused():
+    B = 2
+'''
+
+PROGRAM = '''import lib
+import mem
+
+lib.store(7)
+lib.scale(B, 5)
+mem.fill(0x9010, 4, 6)
+'''
+
+# both modules generate labels numbered per assembler
+CLASHING = '''import interrupts
+import mem
+
+mem.compare(X, 0x9000, 0x9010, 2)
+
+@interrupts.handler(4)
+def on_bell():
+    mem.set(0x9020, A)
+
+def bump(A):
+    A += 1
+'''
+
+CLASHING_PROGRAM = '''import dev.cpu
+import clash
+import interrupts
+import mem
+
+mem.set(0x9001, 3)
+mem.compare(Y, 0x9000, 0x9010, 2)
+clash.bump(B)
+
+@interrupts.handler(5)
+def on_other():
+    mem.set(0x9021, A)
+
+dev.cpu.interrupt(0, 4)
+dev.cpu.interrupt(0, 5)
+'''
+
+
+class Doorbell(object):
+    """
+    A device triggering the message in A when it is interrupted.
+    """
+    id = 0x12345678
+    version = 1
+    manufacturer = 0
+
+    def interrupt(self, emulator):
+        emulator.trigger(emulator.registers['A'])
+
+
+class ObjectTests(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.sources = os.path.join(self.directory, 'src')
+        self.objects = os.path.join(self.directory, 'obj')
+        os.makedirs(self.sources)
+        with open(os.path.join(self.sources, 'lib.llpy16'), 'w') as fobj:
+            fobj.write(LIBRARY)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def compile(self, optimization='1', source=PROGRAM):
+        context = Context([STDLIB_PATH, self.sources], object_dir=self.objects)
+        assembler = compile_program(source, optimization=optimization, verify=True, context=context)
+        return context, Emulator(assembler.get_sections(), [Doorbell()]).run(10000)
+
+    def test_linked_objects_run_like_the_source(self):
+        for optimization in ('0', '1', 's'):
+            context, reference = self.compile(optimization)
+            self.assertEqual(context.objects, [])
+            self.assertEqual(build_objects(self.sources, object_dir=self.objects), ['lib'])
+            context, linked = self.compile(optimization)
+            self.assertEqual([obj.name for obj in context.objects], ['lib'])
+            self.assertEqual(differences(reference, linked), [])
+            self.assertEqual(linked.memory[0x9000], 22)
+            shutil.rmtree(self.objects)
+
+    def test_unused_sections_are_not_linked(self):
+        build_objects(self.sources, object_dir=self.objects)
+        _, linked = self.compile()
+        self.assertNotIn('lib__unused', linked.labels)
+
+    def test_objects_round_trip(self):
+        build_objects(self.sources, object_dir=self.objects)
+        obj = load_object(os.path.join(self.objects, 'lib' + OBJECT_EXTENSION))
+        self.assertEqual(sorted(obj.exports), ['scale', 'store', 'unused'])
+        self.assertEqual(obj.imports, ['mem'])
+        self.assertTrue(obj.is_current())
+
+    def test_changed_sources_make_objects_stale(self):
+        build_objects(self.sources, object_dir=self.objects)
+        with open(os.path.join(self.sources, 'lib.llpy16'), 'a') as fobj:
+            fobj.write('\ndef more():\n    C = 1\n')
+        obj = load_object(os.path.join(self.objects, 'lib' + OBJECT_EXTENSION))
+        self.assertTrue(obj is None or not obj.is_current())
+        context, _ = self.compile()
+        self.assertEqual(context.objects, [])
+
+    def test_clashing_objects_are_compiled_from_source(self):
+        with open(os.path.join(self.sources, 'clash.llpy16'), 'w') as fobj:
+            fobj.write(CLASHING)
+        for optimization in ('0', '1', 's'):
+            _, reference = self.compile(optimization, CLASHING_PROGRAM)
+            build_objects(self.sources, object_dir=self.objects)
+            context, linked = self.compile(optimization, CLASHING_PROGRAM)
+            self.assertNotIn('clash', [obj.name for obj in context.objects])
+            self.assertEqual(differences(reference, linked), [], optimization)
+            self.assertEqual(linked.memory[0x9020:0x9022], [4, 5], optimization)
+            self.assertEqual(linked.registers['Y'], 3, optimization)
+            shutil.rmtree(self.objects)
+
+    def test_labels_defined_twice_do_not_link(self):
+        with open(os.path.join(self.sources, 'clash.llpy16'), 'w') as fobj:
+            fobj.write(CLASHING)
+        build_objects(self.sources, object_dir=self.objects)
+        obj = load_object(os.path.join(self.objects, 'clash' + OBJECT_EXTENSION))
+        context = Context([STDLIB_PATH, self.sources], use_objects=False)
+        assembler = compile_program('import mem\nmem.compare(X, 0x9000, 0x9010, 2)\n', context=context)
+        # splice the object in as an import would
+        for item in obj.body:
+            assembler.write_item(item)
+        with self.assertRaises(LinkError) as raised:
+            link(assembler, [obj])
+        self.assertEqual(raised.exception.modules, set(['clash']))
+
+
+if __name__ == '__main__':
+    unittest.main()
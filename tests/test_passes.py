@@ -0,0 +1,148 @@
+# -*- coding: utf-8 -*-
+import unittest
+from llpy16.assembler import SPOOL_CHUNK, Assembler, Instruction, Label
+from llpy16.compiler import compile_program
+from llpy16.emulator import Emulator, differences, execute
+from llpy16.passes import (LEVELS, OUTLINE_PREFIX, layout, measure, outline, peephole, peephole_section, prune,
+                           verify)
+
+# loops and branches come from the mem and fixed runtimes
+PROGRAM = '''import fixed
+import mem
+
+def fill(A, B):
+    mem.fill(0x9000, A, B)
+    fixed.mul32(A, B, C, X)
+
+fill(7, 20)
+mem.copy(0x9010, 0x9000, 30)
+mem.compare(Y, 0x9000, 0x9010, 12)
+fixed.div32(A, B, C)
+'''
+
+
+def section(*lines):
+    """
+    A section from lines of assembly, ':name' for a label.
+    """
+    items = []
+    for line in lines:
+        if line.startswith(':'):
+            items.append(Label(line[1:]))
+        else:
+            opcode, args = line.split(' ', 1)
+            items.append(Instruction(opcode, tuple(arg.strip() for arg in args.split(','))))
+    return items
+
+def run(sections):
+    return Emulator(sections).run(1000)
+
+
+class LevelTests(unittest.TestCase):
+    def test_levels_match_O0(self):
+        _, reference = execute(PROGRAM, '0', 100000)
+        for level in sorted(LEVELS):
+            words, emulator = execute(PROGRAM, level, 100000)
+            self.assertEqual(differences(reference, emulator), [], level)
+
+    def test_levels_shrink_the_program(self):
+        sizes = dict((level, execute(PROGRAM, level, 100000)[0]) for level in LEVELS)
+        self.assertTrue(sizes['0'] >= sizes['1'] > sizes['2'], sizes)
+
+
+class LayoutTests(unittest.TestCase):
+    SECTIONS = [
+        section('SET A, 1', 'SET PC, second', ':halt', 'SET PC, halt'),
+        section(':first', 'ADD A, 4', 'SET PC, halt'),
+        section(':second', 'MUL A, 3', 'SET PC, first'),
+    ]
+
+    def test_jumps_become_fall_throughs(self):
+        sections = layout(self.SECTIONS)
+        verify(sections)
+        self.assertTrue(measure(sections)[0] < measure(self.SECTIONS)[0])
+        self.assertEqual(run(sections).registers['A'], run(self.SECTIONS).registers['A'])
+        items = [str(item) for section in sections for item in section]
+        self.assertEqual(items, ['SET A, 0x0001', ':second', 'MUL A, 0x0003', ':first', 'ADD A, 0x0004', ':halt',
+                                 'SET PC, halt'])
+
+    def test_conditional_jumps_are_kept(self):
+        sections = [
+            section('IFE A, 0', 'SET PC, second', ':halt', 'SET PC, halt'),
+            section(':second', 'SET A, 2', 'SET PC, halt'),
+        ]
+        self.assertEqual(run(layout(sections)).registers['A'], 2)
+
+
+class PruneTests(unittest.TestCase):
+    def test_unreferenced_sections_are_removed(self):
+        sections = [
+            section('JSR used', ':halt', 'SET PC, halt'),
+            section(':used', 'SET A, 1', 'SET PC, POP'),
+            section(':unused', 'JSR only_from_unused', 'SET PC, POP'),
+            section(':only_from_unused', 'SET PC, POP'),
+        ]
+        self.assertEqual(prune(sections), sections[:2])
+
+    def test_sections_fallen_into_are_kept(self):
+        sections = [
+            section('SET A, 1'),
+            section(':next', 'SET A, 2', ':halt', 'SET PC, halt'),
+        ]
+        self.assertEqual(prune(sections), sections)
+
+
+class OutlineTests(unittest.TestCase):
+    REPEATED = ('ADD A, B', 'MUL A, 3', 'XOR A, C', 'SHL A, 1')
+
+    def test_repeated_sequences_become_subroutines(self):
+        sections = [section(*(self.REPEATED + ('ADD B, 1',)) * 4 + (':halt', 'SET PC, halt'))]
+        outlined = outline(sections)
+        verify(outlined)
+        self.assertTrue(measure(outlined)[0] < measure(sections)[0])
+        self.assertEqual([str(item) for item in outlined[0]].count('JSR %s0' % OUTLINE_PREFIX), 4)
+        self.assertEqual(differences(run(sections), run(outlined)), [])
+
+    def test_sequences_after_tests_are_kept(self):
+        lines = ('IFE B, 0',) + self.REPEATED
+        sections = [section(*lines * 4 + (':halt', 'SET PC, halt'))]
+        outlined = outline(sections)
+        for previous, item in zip(outlined[0], outlined[0][1:]):
+            if str(previous).startswith('IF'):
+                self.assertFalse(str(item).startswith('JSR'))
+        self.assertEqual(differences(run(sections), run(outlined)), [])
+
+    def test_stack_operands_are_not_outlined(self):
+        lines = ('SET PUSH, A', 'ADD A, PEEK', 'SET B, POP', 'MUL A, B') * 4
+        sections = [section(*lines + (':halt', 'SET PC, halt'))]
+        self.assertEqual(outline(sections), sections)
+
+
+class SpoolTests(unittest.TestCase):
+    def test_streamed_output_matches(self):
+        # a main body of several chunks, with self assignments for the peephole
+        source = PROGRAM + ''.join('X = %d\nY = Y\n' % index for index in range(SPOOL_CHUNK))
+        for level, streams in (('0', True), ('1', True), ('2', False)):
+            streamed = compile_program(source, optimization=level, spool=True)
+            self.assertEqual(streamed.spooling, streams, level)
+            kept = compile_program(source, optimization=level)
+            self.assertEqual(streamed.get_assembled(), kept.get_assembled(), level)
+
+    def test_chunk_boundaries_do_not_change_the_peephole(self):
+        for extra in range(-4, 2):
+            assemblers = Assembler(spool=True, section_filter=peephole_section), Assembler()
+            for assembler in assemblers:
+                for index in range(SPOOL_CHUNK + extra):
+                    assembler.SET('X', index)
+                assembler.IFE('A', 0)
+                assembler.SET('A', 'A')
+                assembler.SET('PUSH', 'B')
+                assembler.SET('B', 'POP')
+            streamed, kept = assemblers
+            kept.set_sections(peephole(kept.get_sections()))
+            self.assertEqual(streamed.get_assembled(), kept.get_assembled(), extra)
+            self.assertIn('IFE A, 0x0000\nSET A, A\n', streamed.get_assembled())
+
+
+if __name__ == '__main__':
+    unittest.main()
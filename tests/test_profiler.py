@@ -0,0 +1,100 @@
+# -*- coding: utf-8 -*-
+import unittest
+from llpy16.assembler import Assembler
+from llpy16.compiler import compile_program
+from llpy16.emulator import Emulator
+from llpy16.passes import LEVELS
+from llpy16.profiler import ENTRY_WORDS, Profiler
+
+# instructions that leave EX alone, the interrupts arrive while they run
+FILLER = ''.join('I = %d\n' % index for index in range(80))
+
+PROGRAM = '''import dev.cpu
+import interrupts
+import mem
+
+@interrupts.handler(4)
+def on_tick():
+    mem.set(0x9000, A)
+
+dev.cpu.interrupt(0, 4)
+Z = 1
+Z -= 2
+''' + FILLER
+
+
+class Ticker(object):
+    """
+    A device triggering the message it was interrupted with every few ticks,
+    a few times.
+    """
+    id = 0x12345678
+    version = 1
+    manufacturer = 0
+
+    def __init__(self, every=12, times=3):
+        self.every = every
+        self.times = times
+        self.ticks = 0
+        self.message = 0
+
+    def interrupt(self, emulator):
+        self.message = emulator.registers['A']
+
+    def tick(self, emulator):
+        if self.message and self.times:
+            self.ticks += 1
+            if not self.ticks % self.every:
+                self.times -= 1
+                emulator.trigger(self.message)
+
+
+def counts(profiler, emulator):
+    start = emulator.labels[profiler.region_label]
+    return dict(
+        (name, emulator.memory[start + index * ENTRY_WORDS])
+        for index, (name, _) in enumerate(profiler.entries)
+    )
+
+
+class ProfilerTests(unittest.TestCase):
+    def test_calls_are_counted(self):
+        for level in sorted(LEVELS):
+            profiler = Profiler(clock_rate=0)
+            assembler = compile_program('def work():\n    B += 1\n\nwork()\nwork()\nwork()\n', optimization=level,
+                                        verify=True, profiler=profiler)
+            emulator = Emulator(assembler.get_sections()).run(1000)
+            self.assertEqual(emulator.registers['B'], 3, level)
+            self.assertEqual(counts(profiler, emulator), {'__work': 3}, level)
+
+    def test_block_counters_preserve_ex(self):
+        assembler = Assembler()
+        assembler.SET('A', 0xFFFF)
+        assembler.ADD('A', 2)
+        assembler.goto_label('block')
+        with assembler.label('block'):
+            # the carry of the ADD before the jump
+            assembler.SET('B', 'EX')
+            assembler.goto_label(assembler.halt_label)
+        profiler = Profiler(clock_rate=0, blocks=True)
+        profiler.instrument_blocks(assembler)
+        profiler.write_region(assembler)
+        emulator = Emulator(assembler.get_sections()).run(1000)
+        self.assertEqual(emulator.registers['B'], 1)
+        self.assertEqual(counts(profiler, emulator), {'block': 1})
+
+    def test_block_counters_preserve_ex_in_interrupts(self):
+        for level in sorted(LEVELS):
+            profiler = Profiler(clock_rate=0, blocks=True)
+            assembler = compile_program(PROGRAM, optimization=level, verify=True, profiler=profiler)
+            emulator = Emulator(assembler.get_sections(), [Ticker()]).run(100000)
+            self.assertEqual(emulator.memory[0x9000], 4, level)
+            self.assertEqual(emulator.registers['EX'], 0xFFFF, level)
+            # the entry of the handler was counted before it saved EX
+            entries = dict((name, count) for name, count in counts(profiler, emulator).items() if 'entry' in name)
+            self.assertTrue(entries, level)
+            self.assertTrue(all(count > 1 for count in entries.values()), (level, entries))
+
+
+if __name__ == '__main__':
+    unittest.main()
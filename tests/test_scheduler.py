@@ -0,0 +1,109 @@
+# -*- coding: utf-8 -*-
+import random
+import unittest
+from llpy16.assembler import Instruction
+from llpy16.compiler import compile_program
+from llpy16.emulator import Emulator
+from llpy16.passes import LEVELS
+from llpy16.stdlib.dev.drivers import GENERIC_CLOCK_ID
+
+# instructions that leave the registers alone, the clock ticks while they run
+FILLER = ''.join('    mem.set(0x9000, %d)\n' % index for index in range(40))
+# what each task adds to A, B, C, X, Y, I and J per run
+STEPS = {
+    'first': (1, 2, 3, 4, 5, 7, 8),
+    'second': (0x100, 0x200, 0x300, 0x400, 0x500, 0x700, 0x800),
+}
+ADDED = ('A', 'B', 'C', 'X', 'Y', 'I', 'J')
+
+
+def task(name, marker, ex):
+    """
+    A task adding its STEPS, leaving ex in EX (through Z) and reaching
+    the marker instruction after the filler.
+    """
+    lines = ['@scheduler.every(3, %d)' % sorted(STEPS).index(name), 'def %s():' % name]
+    lines.extend('    %s += %d' % pair for pair in zip(ADDED, STEPS[name]))
+    lines.append('    Z = %d' % (ex + 2 & 0xFFFF))
+    lines.append('    Z -= 2')
+    return '\n'.join(lines) + '\n' + FILLER + '    mem.set(0x9100, %d)\n\n' % marker
+
+PROGRAM = 'import mem\nimport scheduler\n\n%s%sscheduler.run()\n' % (task('first', 1, 0xFFFF), task('second', 2, 0))
+
+
+class Clock(object):
+    """
+    A generic clock ticking after a random number of instructions, from
+    shortest to longest, once its interrupts are on.
+    """
+    id = GENERIC_CLOCK_ID[0] << 16 | GENERIC_CLOCK_ID[1]
+    version = 1
+    manufacturer = 0x904b3115
+
+    def __init__(self, shortest=40, longest=160):
+        self.random = random.Random(7)
+        self.shortest = shortest
+        self.longest = longest
+        self.steps = 0
+        self.message = 0
+
+    def interrupt(self, emulator):
+        if emulator.registers['A'] == 2:
+            self.message = emulator.registers['B']
+
+    def tick(self, emulator):
+        if self.message:
+            self.steps -= 1
+            if self.steps <= 0:
+                self.steps = self.random.randint(self.shortest, self.longest)
+                emulator.trigger(self.message)
+
+
+def markers(sections):
+    """
+    The addresses of the marker instructions of the tasks, by task.
+    """
+    found = {}
+    address = 0
+    for section in sections:
+        for item in section:
+            if isinstance(item, Instruction) and item.args and str(item.args[0]) == '[%d]' % 0x9100:
+                found[address] = 'first' if item.args[1] == 1 else 'second'
+            address += item.size
+    return found
+
+
+class SchedulerTests(unittest.TestCase):
+    def test_tasks_keep_their_registers(self):
+        for level in sorted(LEVELS):
+            sections = compile_program(PROGRAM, optimization=level, verify=True).get_sections()
+            emulator = Emulator(sections, [Clock()])
+            runs = {'first': 0, 'second': 0}
+            tasks = markers(sections)
+            self.assertEqual(sorted(tasks.values()), ['first', 'second'], level)
+            starts = dict((emulator.labels['__' + name], name) for name in runs)
+            running = None
+            interrupted = set()
+            for _ in range(30000):
+                address = emulator.registers['PC']
+                if address in starts:
+                    running = starts[address]
+                elif address == emulator.labels['scheduler__isr'] and running:
+                    interrupted.add(running)
+                name = tasks.get(address)
+                if name is not None:
+                    running = None
+                    runs[name] += 1
+                    registers = emulator.registers
+                    self.assertEqual([registers[register] for register in ADDED],
+                                     [step * runs[name] & 0xFFFF for step in STEPS[name]], (level, name))
+                    self.assertEqual((registers['Z'], registers['EX']), (0xFFFF, 0xFFFF) if name == 'first' else
+                                     (0, 0), (level, name))
+                emulator.step()
+            # both tasks ran several times, and were interrupted by the clock
+            self.assertGreater(min(runs.values()), 5, level)
+            self.assertEqual(interrupted, set(runs), level)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,113 @@
+# -*- coding: utf-8 -*-
+import json
+import os
+import shutil
+import tempfile
+import unittest
+from StringIO import StringIO
+from llpy16.compiler import compile_object
+from llpy16.context import ModuleCache
+from llpy16.server import CompileServer
+
+LIBRARY = 'def scale(A, B):\n    A *= B\n'
+PROGRAM = 'import lib\n\nlib.scale(A, 3)\n'
+# both generate the labels of mem.compare and interrupts.handler
+CLASHING = '''import interrupts
+import mem
+
+mem.compare(X, 0x9000, 0x9010, 2)
+
+@interrupts.handler(4)
+def on_bell():
+    mem.set(0x9020, A)
+'''
+CLASHING_PROGRAM = '''import clash
+import interrupts
+import mem
+
+mem.compare(Y, 0x9000, 0x9010, 2)
+
+@interrupts.handler(5)
+def on_other():
+    mem.set(0x9021, A)
+'''
+
+
+class CompileServerTests(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.program = self.write('program.llpy16', PROGRAM)
+        self.library = self.write('lib.llpy16', LIBRARY)
+        self.built = []
+        self.server = CompileServer()
+        self.server.cache = ModuleCache(self.build)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def write(self, name, source, mtime=None):
+        path = os.path.join(self.directory, name)
+        with open(path, 'w') as fobj:
+            fobj.write(source)
+        if mtime is not None:
+            os.utime(path, (mtime, mtime))
+        return path
+
+    def build(self, name, paths):
+        self.built.append(name)
+        return compile_object(name, paths)
+
+    def test_requests_round_trip(self):
+        output = os.path.join(self.directory, 'program.dasm')
+        requests = [
+            {'source': self.program},
+            {'source': self.program, 'output': output, 'optimization': '0'},
+            {'source': os.path.join(self.directory, 'missing.llpy16')},
+        ]
+        outfile = StringIO()
+        self.server.serve(StringIO('\n'.join(json.dumps(request) for request in requests) + '\nnot json\n'), outfile)
+        responses = [json.loads(line) for line in outfile.getvalue().splitlines()]
+        self.assertEqual([response['ok'] for response in responses], [True, True, False, False])
+        self.assertIn('JSR lib__scale', responses[0]['assembly'])
+        self.assertEqual(responses[1]['output'], output)
+        with open(output) as fobj:
+            self.assertIn('JSR lib__scale', fobj.read())
+        self.assertIn('invalid request', responses[3]['error'])
+
+    def test_objects_are_reused_until_their_source_changes(self):
+        first = self.server.compile(self.program)['assembly']
+        self.assertEqual(self.server.compile(self.program)['assembly'], first)
+        self.assertEqual(self.built, ['lib'])
+        self.assertFalse(self.server.changed(self.program))
+        self.write('lib.llpy16', LIBRARY + '    A += 1\n', os.stat(self.library).st_mtime + 10)
+        self.assertTrue(self.server.changed(self.program))
+        second = self.server.compile(self.program)['assembly']
+        self.assertEqual(self.built, ['lib', 'lib'])
+        self.assertNotEqual(second, first)
+        self.assertIn('ADD A, 0x0001', second)
+
+    def test_removed_sources_are_forgotten(self):
+        self.server.compile(self.program)
+        other = self.write('other.llpy16', 'A = 1\n')
+        os.remove(self.program)
+        self.server.compile(other)
+        self.assertEqual(list(self.server.dependencies), [other])
+        # lib was dropped with the program, importing it again builds it again
+        self.write('program.llpy16', PROGRAM)
+        self.server.compile(self.program)
+        self.assertEqual(self.built, ['lib', 'lib'])
+
+    def test_clashing_modules_are_compiled_from_source(self):
+        clash = self.write('clash.llpy16', CLASHING)
+        program = self.write('clashing.llpy16', CLASHING_PROGRAM)
+        for optimization in ('0', '1'):
+            response = self.server.compile(program, optimization=optimization)
+            self.assertTrue(response['ok'], response.get('error'))
+            labels = [line for line in response['assembly'].splitlines() if line.startswith(':')]
+            self.assertEqual(len(labels), len(set(labels)), optimization)
+            self.assertIn(':mem__compare_done_2', labels)
+            self.assertIn(clash, self.server.dependencies[program])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,120 @@
+# -*- coding: utf-8 -*-
+import json
+import os
+import shutil
+import tempfile
+import unittest
+from StringIO import StringIO
+from llpy16.assembler import Instruction, Label
+from llpy16.compiler import STDLIB_PATH, compile_program
+from llpy16.context import Context
+from llpy16.passes import OUTLINE_PREFIX
+
+# the marked lines compile to instructions found by their operands
+LIBRARY = '''import mem
+
+def mark():
+    Z = 0x4242
+    mem.set(0x9000, 1)
+    mem.set(0x9001, 2)
+    mem.set(0x9002, 3)
+'''
+
+# the runtime of dev.display has a block that layout moves
+PROGRAM = '''import dev.display
+import lib
+import mem
+
+dev.display.double_buffer()
+dev.display.flip()
+lib.mark()
+I = 0x4343
+mem.set(0x9000, 1)
+mem.set(0x9001, 2)
+mem.set(0x9002, 3)
+'''
+MOVED = ('[dev__display__dirty_start]', 0xFFFF)
+
+
+class SourceMapTests(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.library = os.path.join(self.directory, 'lib.llpy16')
+        self.program = os.path.join(self.directory, 'main.llpy16')
+        for path, source in ((self.library, LIBRARY), (self.program, PROGRAM)):
+            with open(path, 'w') as fobj:
+                fobj.write(source)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def compile(self, optimization):
+        context = Context([STDLIB_PATH, self.directory], use_objects=False)
+        source_map = StringIO()
+        assembler = compile_program(PROGRAM, optimization=optimization, context=context, filename=self.program,
+                                    source_map=source_map)
+        return assembler.get_sections(), json.loads(source_map.getvalue())
+
+    def address(self, sections, operands):
+        """
+        The address of the instruction with operands.
+        """
+        address = 0
+        for section in sections:
+            for item in section:
+                if isinstance(item, Instruction) and tuple(item.args) == operands:
+                    return address
+                address += item.size
+        self.fail('no instruction %r' % (operands,))
+
+    def located(self, sections, source_map, operands):
+        """
+        The (file, line) of the source map range holding the instruction
+        with operands.
+        """
+        address = self.address(sections, operands)
+        for entry in source_map['ranges']:
+            if entry['start'] <= address < entry['start'] + entry['size']:
+                return entry['file'], entry['line']
+
+    def test_lines_of_both_modules(self):
+        for optimization in ('0', '1', '2', 's'):
+            sections, source_map = self.compile(optimization)
+            self.assertEqual(self.located(sections, source_map, ('Z', 0x4242)), (self.library, 4), optimization)
+            self.assertEqual(self.located(sections, source_map, ('I', 0x4343)), (self.program, 8), optimization)
+            # the runtime is located at the statement it was written for
+            self.assertEqual(self.located(sections, source_map, MOVED), (self.program, 5), optimization)
+            self.assertEqual(source_map['size'], sum(entry['size'] for entry in source_map['ranges']) +
+                             sum(item.size for section in sections for item in section
+                                 if not isinstance(item, Instruction)))
+
+    def test_outlined_and_moved_code_keeps_its_lines(self):
+        # layout moved the block holding MOVED up to the jump to it
+        for optimization, moved in (('1', False), ('2', True)):
+            labels = [item.name for section in self.compile(optimization)[0] for item in section
+                      if isinstance(item, Label)]
+            self.assertEqual(labels.index('dev__display__flip_copy_loop_end') <
+                             labels.index('dev__display__flip_copy'), moved, optimization)
+        sections, source_map = self.compile('s')
+        outlined = [section for section in sections
+                    if isinstance(section[0], Label) and section[0].name.startswith(OUTLINE_PREFIX)]
+        self.assertTrue(outlined)
+        # the repeated mem.set lines were outlined, the copy keeps the lines
+        # of the first occurrence, the calls to it the lines they replace
+        for section in outlined:
+            self.assertEqual([item.source for item in section[1:-1]], [(self.program, line) for line in (9, 10, 11)])
+        calls = set()
+        for section in sections:
+            for item in section:
+                if isinstance(item, Instruction) and item.opcode == 'JSR' and \
+                        str(item.args[0]).startswith(OUTLINE_PREFIX):
+                    calls.add(item.source)
+        self.assertEqual(calls, set([(self.program, 9), (self.library, 5)]))
+        for entry in source_map['ranges']:
+            if entry['line'] is not None:
+                with open(entry['file']) as fobj:
+                    self.assertLessEqual(entry['line'], len(fobj.readlines()))
+
+
+if __name__ == '__main__':
+    unittest.main()